@@ -0,0 +1,250 @@
+"""
+Submission of homogeneous jobs as SLURM job arrays.
+
+Jobs sharing the same template and the same resources (i.e. the same `#SBATCH` options,
+except the job name and the output files) are grouped into job arrays. For each
+array, `build` writes an array sbatch script and a tasks file mapping each task index
+to the sbatch script and output file of the corresponding job. Each task of the array runs the
+(already rendered) sbatch script of its job, redirecting its output to the output file of the job.
+
+Jobs keep their array and index across builds (the tasks already in the queue are found by
+the name of their array and their index, see `reconcile_jobs`): new jobs are appended to the arrays
+of their group, and the indices of removed jobs are not reused.
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+
+ARRAYS_FILENAME = ".autoexperiment_arrays.json"
+
+# sbatch options that are specific to each job, and thus are not part of the resources
+JOB_SPECIFIC_OPTIONS = ("--job-name", "-J", "--output", "-o", "--error", "-e", "--array", "-a")
+
+ARRAY_SCRIPT_TEMPLATE = """#!/bin/bash
+{resources}
+#SBATCH --job-name={name}
+#SBATCH --output=/dev/null
+# Each task runs the sbatch script of the job given in the tasks file,
+# i.e. one line per task index, with the sbatch script and output file separated by a tab
+IFS=$'\\t' read -r script output_file < <(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "{tasks_file}")
+interpreter=$(head -n 1 "$script" | sed -n 's/^#!//p')
+exec ${{interpreter:-/bin/bash}} "$script" > "$output_file" 2>&1
+"""
+
+
+@dataclass
+class ArrayTask:
+    # name of the SLURM job array
+    name: str
+    # path of the array sbatch script
+    script: str
+    # index of the task in the array
+    index: int
+
+
+def get_resources(sbatch):
+    """
+    Returns the `#SBATCH` lines of an sbatch script that define the resources of the job,
+    i.e. all the options except the ones that are specific to the job (name, output files).
+    """
+    resources = []
+    for line in sbatch.split("\n"):
+        line = line.strip()
+        if line.startswith("#!") or line == "":
+            continue
+        if not line.startswith("#"):
+            # SLURM stops reading #SBATCH options after the first command
+            break
+        if not line.startswith("#SBATCH"):
+            continue
+        option = line[len("#SBATCH"):].strip().split("=", 1)[0].split(" ", 1)[0]
+        if option not in JOB_SPECIFIC_OPTIONS:
+            resources.append(line)
+    return tuple(resources)
+
+
+class ArrayBuilder:
+    """
+    Group jobs into job arrays, then write the array sbatch scripts and tasks files.
+    Jobs are added one at a time with `add` (e.g., while the sbatch scripts are built),
+    and the arrays are written with `write`.
+    """
+    def __init__(self, max_array_size=1000):
+        self.max_array_size = max_array_size
+        # (script dir, template, resources) -> list of (name, sbatch script, output file)
+        self.groups = {}
+        # directories of the sbatch scripts of all the jobs added, including the ones that cannot be part of an array
+        self.script_dirs = set()
+
+    def add(self, jobdef, sbatch):
+        """
+        Add a job, with `sbatch` its rendered sbatch script. Returns False if the job
+        cannot be part of an array, i.e. if it uses a custom submission command.
+        """
+        script_dir = os.path.dirname(jobdef.sbatch_script) or "."
+        self.script_dirs.add(script_dir)
+        if jobdef.cmd.strip() != f"sbatch {jobdef.sbatch_script}":
+            return False
+        key = (script_dir, jobdef.params.get("template"), get_resources(sbatch))
+        self.groups.setdefault(key, []).append((jobdef.name, jobdef.sbatch_script, jobdef.output_file))
+        return True
+
+    def write(self, verbose=0):
+        """
+        Write the array sbatch scripts, the tasks files, and in each directory of sbatch scripts,
+        a file mapping the name of each job to its array and index (see `load_array_tasks`).
+        The tasks of the arrays of the previous build that have no task anymore are removed from their tasks file,
+        and the file mapping the jobs to their arrays is removed from the directories without arrays.
+        Returns the number of arrays.
+        """
+        # script dir -> {job name: [array name, array script, index]}
+        arrays = {}
+        previous = {}
+        nb_arrays = 0
+        written = set()
+        for (script_dir, template, resources), tasks in self.groups.items():
+            if script_dir not in previous:
+                previous[script_dir] = _load_arrays(script_dir)
+            for name, chunk in self._assign(script_dir, template, resources, tasks, previous[script_dir]):
+                script = os.path.join(script_dir, f"{name}.sbatch")
+                tasks_file = os.path.join(script_dir, f"{name}.tasks")
+                # indices of removed jobs are left empty
+                _write_if_changed(tasks_file, "".join(f"{task[1]}\t{task[2]}\n" if task else "\t\n" for task in chunk))
+                _write_if_changed(script, ARRAY_SCRIPT_TEMPLATE.format(resources="\n".join(resources), name=name, tasks_file=tasks_file))
+                for index, task in enumerate(chunk):
+                    if task:
+                        arrays.setdefault(script_dir, {})[task[0]] = [name, script, index]
+                if verbose:
+                    print(f"Building array '{script}' with {sum(1 for task in chunk if task)} task(s)...")
+                written.add(os.path.join(script_dir, name))
+                nb_arrays += 1
+        for script_dir in sorted(self.script_dirs):
+            if script_dir not in previous:
+                previous[script_dir] = _load_arrays(script_dir)
+            # the tasks files of the arrays without tasks anymore are kept, with their tasks removed,
+            # so that their indices are not reused (their tasks can still be in the queue)
+            for name in sorted({name for name, _, _ in previous[script_dir].values()}):
+                if os.path.join(script_dir, name) not in written:
+                    _clear_tasks_file(os.path.join(script_dir, f"{name}.tasks"))
+            path = os.path.join(script_dir, ARRAYS_FILENAME)
+            if script_dir in arrays:
+                with open(path, "w") as f:
+                    json.dump(arrays[script_dir], f)
+            elif os.path.exists(path):
+                os.remove(path)
+        return nb_arrays
+
+    def _assign(self, script_dir, template, resources, tasks, previous):
+        """
+        Assign the tasks of a group to arrays, keeping the array and index of the jobs of the
+        previous build (`previous`, see `load_array_tasks`).
+        Returns a list of (array name, list of tasks by index, None for the indices that are not used anymore).
+        """
+        # the names depend on the template and the resources, so that they are stable across builds
+        prefix = "array_" + hashlib.sha1(repr((template, resources)).encode()).hexdigest()[:12] + "_"
+        # arrays of the group written by previous builds, with their number of tasks
+        chunks = {}
+        for filename in os.listdir(script_dir):
+            if filename.startswith(prefix) and filename.endswith(".tasks") and filename[len(prefix):-len(".tasks")].isdigit():
+                with open(os.path.join(script_dir, filename)) as f:
+                    chunks[filename[:-len(".tasks")]] = [None] * sum(1 for _ in f)
+        new_tasks = []
+        for task in tasks:
+            name, _, index = previous.get(task[0], (None, None, None))
+            if name is not None and name.startswith(prefix) and name in chunks and index < len(chunks[name]):
+                chunks[name][index] = task
+            else:
+                new_tasks.append(task)
+        names = sorted(chunks, key=lambda name: int(name[len(prefix):]))
+        for name in names:
+            room = self.max_array_size - len(chunks[name])
+            if room > 0 and new_tasks:
+                chunks[name].extend(new_tasks[:room])
+                new_tasks = new_tasks[room:]
+        k = int(names[-1][len(prefix):]) + 1 if names else 0
+        while new_tasks:
+            name = f"{prefix}{k}"
+            chunks[name] = new_tasks[:self.max_array_size]
+            new_tasks = new_tasks[self.max_array_size:]
+            names.append(name)
+            k += 1
+        # arrays without tasks anymore are not written again
+        return [(name, chunks[name]) for name in names if any(chunks[name])]
+
+
+def load_array_tasks(jobdefs):
+    """
+    Returns a dict mapping the name of each job that is part of an array
+    (as written by `ArrayBuilder`) to its `ArrayTask`.
+    """
+    tasks = {}
+    script_dirs = set(os.path.dirname(jobdef.sbatch_script) or "." for jobdef in jobdefs)
+    for script_dir in script_dirs:
+        for job_name, (name, script, index) in _load_arrays(script_dir).items():
+            tasks[job_name] = ArrayTask(name=name, script=script, index=index)
+    return tasks
+
+
+def format_indices(indices):
+    """
+    Format a list of task indices for `sbatch --array`, e.g. [0, 1, 2, 5] -> '0-2,5'
+    """
+    ranges = []
+    for index in sorted(set(indices)):
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ",".join(f"{start}-{end}" if start != end else f"{start}" for start, end in ranges)
+
+
+def expand_job_ids(job_id):
+    """
+    Expand the job id of a job array as shown by squeue, e.g. '123_[0-2,5%2]' -> ['123_0', '123_1', '123_2', '123_5'].
+    Other job ids (e.g. '123' or '123_4') are returned as is.
+    """
+    if not job_id.endswith("]") or "_[" not in job_id:
+        return [job_id]
+    array_id, indices = job_id[:-1].split("_[", 1)
+    # remove the limit of simultaneously running tasks, e.g. '%2'
+    indices = indices.split("%", 1)[0]
+    job_ids = []
+    for part in indices.split(","):
+        if "-" in part:
+            start, end = part.split("-", 1)
+            # e.g. '1-7:2', with a step
+            end, step = (end.split(":", 1) + ["1"])[:2]
+            job_ids.extend(f"{array_id}_{i}" for i in range(int(start), int(end) + 1, int(step)))
+        elif part:
+            job_ids.append(f"{array_id}_{part}")
+    return job_ids
+
+
+def _load_arrays(script_dir):
+    """
+    Returns the dict mapping the name of each job to [array name, array script, index] written by the previous build, if any
+    """
+    path = os.path.join(script_dir, ARRAYS_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _clear_tasks_file(path):
+    try:
+        with open(path) as f:
+            nb_tasks = sum(1 for _ in f)
+    except FileNotFoundError:
+        return
+    _write_if_changed(path, "\t\n" * nb_tasks)
+
+
+def _write_if_changed(path, content):
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return
+    with open(path, "w") as f:
+        f.write(content)
@@ -0,0 +1,127 @@
+"""
+Scheduler backends used by the manager to submit, query and cancel jobs.
+"""
+import re
+from subprocess import CalledProcessError, TimeoutExpired
+
+from autoexperiment.arrays import expand_job_ids, format_indices
+
+
+class SchedulerError(Exception):
+    """
+    Raised when a call to the scheduler fails
+    """
+
+
+class SchedulerBackend:
+    """
+    Interface between the manager and the scheduler.
+
+    Job ids are strings, job states follow SLURM's naming (e.g., RUNNING, PENDING).
+    All the methods raise `SchedulerError` when the call to the scheduler fails.
+    """
+
+    async def submit(self, job):
+        """
+        Submit the job `job` (a `JobDef`), returns its job id
+        """
+        raise NotImplementedError()
+
+    async def submit_array(self, script, indices):
+        """
+        Submit the tasks `indices` of the job array `script` (see `autoexperiment.arrays`),
+        returns the job id of the array (task job ids are `<array job id>_<index>`)
+        """
+        raise NotImplementedError()
+
+    async def query_many(self):
+        """
+        Returns the state of all the jobs of the user, as two dicts: job id -> state, and job id -> name
+        """
+        raise NotImplementedError()
+
+    async def cancel(self, job_ids):
+        """
+        Cancel the jobs `job_ids`
+        """
+        raise NotImplementedError()
+
+    async def lookup_by_name(self, names):
+        """
+        Returns a dict mapping each name of `names` to the list of ids of the jobs with that name
+        """
+        names = set(names)
+        _, job_names = await self.query_many()
+        job_ids_by_name = {}
+        for job_id, name in job_names.items():
+            if name in names:
+                job_ids_by_name.setdefault(name, []).append(job_id)
+        return job_ids_by_name
+
+
+class SlurmBackend(SchedulerBackend):
+    """
+    SLURM backend, based on `sbatch`, `squeue` and `scancel`, which are run with a `CommandRunner`.
+    """
+
+    cmd_queue_snapshot = "squeue --me --noheader --format='%i|%j|%T'"
+    cmd_cancel_jobs = "scancel {job_ids}"
+    cmd_submit_array = "sbatch --array={indices} {script}"
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    async def submit(self, job):
+        output = await self._check_output(job.cmd)
+        job_id = get_job_id(output)
+        if job_id is None:
+            raise SchedulerError(f"Cannot find job id in the output of '{job.cmd}': {output}")
+        return str(job_id)
+
+    async def submit_array(self, script, indices):
+        cmd = self.cmd_submit_array.format(indices=format_indices(indices), script=script)
+        output = await self._check_output(cmd)
+        array_id = get_job_id(output)
+        if array_id is None:
+            raise SchedulerError(f"Cannot find job id in the output of '{cmd}': {output}")
+        return str(array_id)
+
+    async def query_many(self):
+        return parse_queue_snapshot(await self._check_output(self.cmd_queue_snapshot))
+
+    async def cancel(self, job_ids):
+        await self._check_output(self.cmd_cancel_jobs.format(job_ids=" ".join(str(job_id) for job_id in job_ids)))
+
+    async def _check_output(self, cmd):
+        try:
+            return (await self.runner.check_output(cmd)).decode()
+        except (CalledProcessError, TimeoutExpired) as ex:
+            raise SchedulerError(str(ex)) from ex
+
+
+def parse_queue_snapshot(data):
+    """
+    Parse the output of `SlurmBackend.cmd_queue_snapshot` (one `job_id|name|state` line per job)
+    into two dicts: job id -> state, and job id -> name.
+    """
+    states = {}
+    names = {}
+    for line in data.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        # names can contain "|", but job ids and states cannot
+        job_id, rest = line.split("|", 1)
+        name, state = rest.rsplit("|", 1)
+        # pending tasks of job arrays can be grouped, e.g. '123_[0-5]'
+        for task_id in expand_job_ids(job_id):
+            states[task_id] = state
+            names[task_id] = name
+    return states, names
+
+
+def get_job_id(s):
+    try:
+        return int(re.search("Submitted batch job ([0-9]+)", s).group(1))
+    except Exception:
+        return None
@@ -0,0 +1,295 @@
+"""
+Benchmark of the manager on a simulated cluster (see `autoexperiment.simulator`).
+
+For a growing number of jobs, the manager runs for a fixed duration against a `SimulatedBackend`,
+and the following metrics are reported:
+- CPU time used by the manager (excluding the simulation itself),
+- number of calls to the scheduler per minute,
+- restart latency, i.e. the time between the interruption of a job (preemption, time limit,
+  or hang) and the submission of a new job for it,
+- number of checks of the jobs per minute, and how bursty they are: the peak number of checks
+  in one sec divided by the mean (1 means that the checks are evenly spread over time).
+
+`run_memory_benchmarks` measures instead the memory used by the job definitions of a sweep,
+for each representation of the jobs (see `MEMORY_REPRESENTATIONS`).
+"""
+import asyncio
+import contextlib
+import gc
+import math
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from omegaconf import OmegaConf
+
+from autoexperiment.manager import _manage_jobs
+from autoexperiment.metrics import metrics
+from autoexperiment.simulator import SimulatedBackend
+from autoexperiment.template import JobDef, iter_job_defs
+
+DEFAULT_NB_JOBS = (100, 1000, 10000)
+DEFAULT_MEMORY_NB_JOBS = (10000, 100000)
+# name -> keyword arguments of `iter_job_defs`
+MEMORY_REPRESENTATIONS = {
+    # `JobDef` with the sbatch script rendered in memory (`generate_job_defs`)
+    "rendered": dict(render=True),
+    # `JobDef` with its own dict of params, the sbatch script being rendered on demand
+    "lazy": dict(render=False),
+    # `CompactJobDef`
+    "compact": dict(compact=True),
+}
+SWEEP_TEMPLATE = """#!/bin/bash -x
+#SBATCH --job-name={name}
+#SBATCH --nodes={nodes}
+#SBATCH --ntasks-per-node=4
+#SBATCH --cpus-per-task=12
+#SBATCH --time=06:00:00
+#SBATCH --partition=booster
+#SBATCH --output={output_file}
+ml purge
+ml Stages/2023 GCC/11.3.0 OpenMPI/4.1.4 CUDA/11.7
+source /p/project/ccstdl/envs/open_clip/bin/activate
+export CUDA_VISIBLE_DEVICES=0,1,2,3
+export MASTER_PORT=12802
+master_addr=$(scontrol show hostnames "$SLURM_JOB_NODELIST" | head -n 1)
+export MASTER_ADDR=$master_addr"i"
+srun --cpu_bind=v --accel-bind=gn python -u src/training/main.py \\
+    --save-frequency 1 \\
+    --train-data="/p/data/datacomp/{dataset}/{{00000000..00139827}}.tar" \\
+    --train-num-samples {train_num_samples} \\
+    --dataset-type webdataset \\
+    --warmup 2000 \\
+    --batch-size={batch_size} \\
+    --epochs={epochs} \\
+    --lr={lr} \\
+    --seed={seed} \\
+    --workers=8 \\
+    --model {model} \\
+    --name {name} \\
+    --logs {logs} \\
+    --resume latest \\
+    --grad-checkpointing \\
+    --local-loss \\
+    --gather-with-grad
+"""
+
+
+def make_job_defs(nb_jobs, output_dir, check_interval_secs=1, termination_str="FINISHED JOB", time_limit_secs=None):
+    """
+    Returns `nb_jobs` synthetic job definitions, writing their output files in `output_dir`.
+    If `time_limit_secs` is given, it is set in the (shared) sbatch script of the jobs, where the manager can find it.
+    """
+    sbatch_script = ""
+    if time_limit_secs:
+        sbatch_script = os.path.join(output_dir, "job.sbatch")
+        with open(sbatch_script, "w") as f:
+            minutes, secs = divmod(int(time_limit_secs), 60)
+            f.write(f"#!/bin/bash\n#SBATCH --time={minutes}:{secs:02d}\n")
+    jobdefs = []
+    for i in range(nb_jobs):
+        name = f"job_{i}"
+        jobdef = JobDef(
+            params={"name": name},
+            name=name,
+            output_file=os.path.join(output_dir, f"{name}.out"),
+            cmd="",
+            sbatch_script=sbatch_script,
+            check_interval_secs=check_interval_secs,
+            termination_str=termination_str,
+        )
+        jobdef.max_start_attempts = float('inf')
+        jobdef.dry = False
+        jobdef.array_task = None
+        jobdefs.append(jobdef)
+    return jobdefs
+
+
+def run_benchmark(nb_jobs, duration_secs=60, check_interval_secs=1, queue_poll_secs=1, max_jobs=None, watch=False, adaptive_checks=False, check_jitter=None, **simulator_kwargs):
+    """
+    Run the manager on `nb_jobs` jobs for (at most) `duration_secs`, returns a dict of metrics.
+    With `watch`, the output files are watched for changes (see `autoexperiment.watcher`).
+    With `adaptive_checks`, the delay between two checks depends on the state of the jobs (see `CheckPolicy`),
+    and with `check_jitter`, the delays are randomly scaled by up to +/- this fraction.
+    `simulator_kwargs` are passed to `SimulatedBackend`.
+    """
+    backend = SimulatedBackend(**simulator_kwargs)
+    checks_per_sec = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        jobdefs = make_job_defs(
+            nb_jobs, output_dir, check_interval_secs=check_interval_secs, termination_str=backend.termination_str,
+            time_limit_secs=backend.time_limit_secs,
+        )
+        wall_start = time.time()
+        cpu_start = time.process_time()
+        # the manager prints the state of each job, which is not what we want to measure
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(_run(
+                jobdefs, backend, duration_secs, queue_poll_secs=queue_poll_secs, max_jobs=max_jobs, watch=watch,
+                adaptive_checks=adaptive_checks, check_jitter=check_jitter, checks_per_sec=checks_per_sec,
+            ))
+        wall_time = time.time() - wall_start
+        cpu_time = time.process_time() - cpu_start - backend.cpu_time
+    latencies = sorted(backend.restart_latencies)
+    nb_calls = sum(backend.calls.values())
+    # the first secs, where all the jobs are submitted at once, are the same with any check policy
+    steady_checks = checks_per_sec[int(check_interval_secs):]
+    return {
+        "jobs": nb_jobs,
+        "finished": len(backend.finished),
+        "wall_secs": wall_time,
+        "manager_cpu_secs": cpu_time,
+        "simulator_cpu_secs": backend.cpu_time,
+        "calls_per_min": nb_calls / wall_time * 60,
+        "calls": dict(backend.calls),
+        "checks_per_min": sum(checks_per_sec) / wall_time * 60,
+        "checks_burstiness": max(steady_checks) / statistics.mean(steady_checks) if steady_checks and any(steady_checks) else None,
+        "interruptions": dict(backend.events),
+        "restarts": len(latencies),
+        "restart_latency_mean": statistics.mean(latencies) if latencies else None,
+        "restart_latency_p95": latencies[math.ceil(0.95 * len(latencies)) - 1] if latencies else None,
+    }
+
+
+async def _run(jobdefs, backend, duration_secs, queue_poll_secs=1, max_jobs=None, watch=False, adaptive_checks=False, check_jitter=None, checks_per_sec=None):
+    simulation = asyncio.ensure_future(backend.run_forever())
+    sampler = asyncio.ensure_future(_count_checks(checks_per_sec if checks_per_sec is not None else []))
+    try:
+        await asyncio.wait_for(
+            _manage_jobs(
+                jobdefs, max_jobs=max_jobs, queue_poll_secs=queue_poll_secs, backend=backend, watch=watch, watch_poll_secs=1,
+                adaptive_checks=adaptive_checks, check_jitter=check_jitter,
+            ),
+            timeout=duration_secs,
+        )
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        simulation.cancel()
+        sampler.cancel()
+
+
+async def _count_checks(checks_per_sec):
+    # number of checks of the jobs during each sec (see the metric `job_checks_total`)
+    key = ("job_checks_total", ())
+    prev = metrics.counters.get(key, 0)
+    while True:
+        await asyncio.sleep(1)
+        value = metrics.counters.get(key, 0)
+        checks_per_sec.append(value - prev)
+        prev = value
+
+
+def run_benchmarks(nb_jobs=DEFAULT_NB_JOBS, file=sys.stdout, **kwargs):
+    """
+    Run `run_benchmark` for each number of jobs in `nb_jobs`, and print a summary line for each
+    """
+    results = []
+    print(
+        f"{'jobs':>8} {'finished':>8} {'wall(s)':>8} {'cpu(s)':>8} {'calls/min':>10} {'checks/min':>10} {'burst':>6} "
+        f"{'restarts':>8} {'lat.mean(s)':>11} {'lat.p95(s)':>10}",
+        file=file,
+    )
+    for n in nb_jobs:
+        r = run_benchmark(n, **kwargs)
+        results.append(r)
+        print(
+            f"{r['jobs']:>8} {r['finished']:>8} {r['wall_secs']:>8.1f} {r['manager_cpu_secs']:>8.2f} {r['calls_per_min']:>10.1f} "
+            f"{r['checks_per_min']:>10.1f} {_fmt(r['checks_burstiness']):>6} {r['restarts']:>8} {_fmt(r['restart_latency_mean']):>11} {_fmt(r['restart_latency_p95']):>10}",
+            file=file, flush=True,
+        )
+    return results
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.2f}"
+
+
+def make_sweep_config(nb_jobs, template):
+    """
+    Returns a config, similar to the ones of `examples/`, with (about) `nb_jobs` jobs using the sbatch template `template`
+    """
+    models = ["ViT-S-32", "ViT-M-32", "ViT-B-32", "ViT-B-16", "ViT-L-14"]
+    lrs = [1e-4, 5e-4, 1e-3, 5e-3]
+    datasets = ["small", "medium", "large", "xlarge", "full"]
+    nb_seeds = max(math.ceil(nb_jobs / (len(models) * len(lrs) * len(datasets))), 1)
+    return OmegaConf.create({
+        "template": template,
+        "logs": "logs",
+        "name": "{dataset}_{model}_lr{lr}_s{seed}",
+        "sbatch_script": "sbatch/{name}.sbatch",
+        "output_file": "{logs}/{name}/slurm.out",
+        "cmd": "sbatch {sbatch_script}",
+        "check_interval_secs": 600,
+        "termination_cmd": 'let last={epochs}-1;ne=`grep "Train Epoch: $last.*100%" {output_file}|wc -l`;echo $(( (ne) >= 1 ))',
+        "nodes": 4,
+        "epochs": 10,
+        "batch_size": 1024,
+        "train_num_samples": 12_800_000,
+        "model": models,
+        "lr": lrs,
+        "dataset": datasets,
+        "seed": list(range(nb_seeds)),
+    })
+
+
+def run_memory_benchmark(nb_jobs, representation):
+    """
+    Generate the job definitions of a sweep of (about) `nb_jobs` jobs, with the `representation`
+    (see `MEMORY_REPRESENTATIONS`), returns a dict of metrics
+    """
+    kwargs = MEMORY_REPRESENTATIONS[representation]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template = os.path.join(tmp_dir, "train.sbatch")
+        with open(template, "w") as f:
+            f.write(SWEEP_TEMPLATE)
+        cfg = make_sweep_config(nb_jobs, template)
+        start = time.perf_counter()
+        jobdefs = list(iter_job_defs(cfg, **kwargs))
+        generate_secs = time.perf_counter() - start
+        # what the manager reads from each job
+        start = time.perf_counter()
+        for jobdef in jobdefs:
+            (jobdef.name, jobdef.output_file, jobdef.cmd, jobdef.sbatch_script, jobdef.check_interval_secs,
+             jobdef.start_condition_cmd, jobdef.termination_str, jobdef.termination_cmd, jobdef.priority)
+        access_secs = time.perf_counter() - start
+        # the jobs are generated again, as tracing the allocations slows down the generation
+        del jobdefs
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            jobdefs = list(iter_job_defs(cfg, **kwargs))
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+    return {
+        "jobs": len(jobdefs),
+        "representation": representation,
+        "memory_mb": used / 2**20,
+        "bytes_per_job": used / len(jobdefs),
+        "generate_secs": generate_secs,
+        "access_secs": access_secs,
+    }
+
+
+def run_memory_benchmarks(nb_jobs=DEFAULT_MEMORY_NB_JOBS, representations=tuple(MEMORY_REPRESENTATIONS), file=sys.stdout):
+    """
+    Run `run_memory_benchmark` for each number of jobs in `nb_jobs` and each representation, and print a summary line for each
+    """
+    results = []
+    print(f"{'jobs':>8} {'repr':>10} {'memory(MB)':>10} {'bytes/job':>10} {'gen(s)':>8} {'access(s)':>9}", file=file)
+    for n in nb_jobs:
+        for representation in representations:
+            r = run_memory_benchmark(n, representation)
+            results.append(r)
+            print(
+                f"{r['jobs']:>8} {r['representation']:>10} {r['memory_mb']:>10.1f} {r['bytes_per_job']:>10.0f} "
+                f"{r['generate_secs']:>8.2f} {r['access_secs']:>9.3f}",
+                file=file, flush=True,
+            )
+    return results
@@ -4,89 +4,532 @@ from clize import run as clize_run
 from clize.parameters import multi
 import sys
 import os
+import json
+import asyncio
+import hashlib
 import warnings
-from subprocess import call
-from autoexperiment.template import generate_job_defs
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+from subprocess import call, PIPE, run as run_process
+from autoexperiment.template import iter_job_defs, parse_param_filter
 from autoexperiment.manager import manage_jobs_forever
+from autoexperiment.store import StateStore
+from autoexperiment.arrays import ArrayBuilder, load_array_tasks
+from autoexperiment.sweep_cache import SweepCache
+from autoexperiment.validation import ValidationError, validate_job_defs
 
 
 def main():
-    return clize_run([build, run, build_and_run, for_each])
+    try:
+        return clize_run([build, run, build_and_run, daemon, ctl, for_each, validate, benchmark])
+    except ValidationError as ex:
+        print(ex, file=sys.stderr)
+        return 1
 
 
-def build(config, *, fix:('f', multi()), verbose=1):
+MANIFEST_FILENAME = ".autoexperiment_manifest.json"
+
+
+def build(config, *, fix:('f', multi()), verbose=1, jobs:'j'=8, array=False, max_array_size:int=1000, sweep_cache:str=None, no_sweep_cache=False):
     """
     Generate sbatch scripts from a yaml config file that
     defines a set of experiments to do.
+
+    Only new or modified sbatch scripts are written: a manifest with the hash of
+    the content of each script is stored in each directory of sbatch scripts.
+    Scripts edited by hand since the previous build (whose content does not match the manifest) are written again.
+    Nothing is written if the jobs are not valid (see `validate`).
+
+    :param jobs: Number of threads used to write the sbatch scripts
+    :param array: Also group jobs with the same template and resources into SLURM job arrays (to be used with `run --array`)
+    :param max_array_size: Maximum number of tasks per job array (should not exceed SLURM's MaxArraySize)
+    :param sweep_cache: Path of the cache of the expanded sweep, reused by `run` and `for_each` as long as the config, the --fix overrides and the templates do not change, defaults to the config path with a '.sweep' extension
+    :param no_sweep_cache: Do not use the cache of the expanded sweep, i.e. always expand the config again
     """
     if not config:
          print("Please specify a config file")
          return 1
+    jobdefs = _load_job_defs(config, fix, sweep_cache=sweep_cache, no_sweep_cache=no_sweep_cache, verbose=verbose)
+    # all the problems of the jobs are reported before writing anything. The hash of each
+    # sbatch script is kept, so that only the new or modified ones are rendered again
+    digests = []
+    on_script = lambda jobdef, sbatch: digests.append(hashlib.sha1(sbatch.encode()).hexdigest())
+    for warning in validate_job_defs(jobdefs, render=True, on_script=on_script):
+        print(warning)
+    # directory of sbatch scripts -> (manifest, set of files in the directory)
+    dirs = {}
+    # dirs of the output files that were already created
+    output_dirs = set()
+    # directory of sbatch scripts -> filenames generated by this build
+    built = {}
+    nb_written = 0
+    nb_unchanged = 0
+    pending = set()
+    array_builder = ArrayBuilder(max_array_size) if array else None
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+       for jobdef, digest in zip(jobdefs, digests):
+          script_dir, filename = os.path.split(jobdef.sbatch_script)
+          script_dir = script_dir or "."
+          if script_dir not in dirs:
+             os.makedirs(script_dir, exist_ok=True)
+             dirs[script_dir] = (_load_manifest(script_dir), set(os.listdir(script_dir)))
+             built[script_dir] = set()
+          manifest, existing = dirs[script_dir]
+          built[script_dir].add(filename)
+          unchanged = manifest.get(filename) == digest and filename in existing and _file_digest(jobdef.sbatch_script) == digest
+          # sbatch scripts are rendered one at a time
+          sbatch = jobdef.render() if array_builder or not unchanged else None
+          if array_builder:
+             array_builder.add(jobdef, sbatch)
+          if unchanged:
+             nb_unchanged += 1
+          else:
+             if verbose:
+                print(f"Building '{jobdef.sbatch_script}'...")
+             manifest[filename] = digest
+             pending.add(executor.submit(_write_file, jobdef.sbatch_script, sbatch))
+             nb_written += 1
+          output_dir = os.path.dirname(jobdef.output_file)
+          if output_dir and output_dir not in output_dirs:
+             output_dirs.add(output_dir)
+             pending.add(executor.submit(os.makedirs, output_dir, exist_ok=True))
+          # avoid keeping too many rendered scripts in memory
+          if len(pending) > jobs * 64:
+             done, pending = wait(pending, return_when=FIRST_COMPLETED)
+             for future in done:
+                future.result()
+       for future in pending:
+          future.result()
+    orphans = []
+    for script_dir, (manifest, existing) in dirs.items():
+       for filename in sorted(set(manifest) - built[script_dir]):
+          if filename in existing:
+             orphans.append(os.path.join(script_dir, filename))
+          else:
+             # file was removed, forget about it
+             del manifest[filename]
+       _save_manifest(script_dir, manifest)
+    nb_orphans = len(orphans)
+    if verbose:
+       for path in orphans:
+          print(f"Orphan sbatch script, not generated by this build: '{path}'")
+    elif orphans:
+       print(f"{nb_orphans} orphan sbatch script(s), not generated by this build (use --verbose to list them).")
+    if array_builder:
+       nb_arrays = array_builder.write(verbose=verbose)
+    if verbose:
+       print(f"{nb_written} sbatch script(s) written, {nb_unchanged} unchanged, {nb_orphans} orphan(s).")
+       if array_builder:
+          print(f"{nb_arrays} job array(s) written.")
+
+def _write_file(path, content):
+    with open(path, "w") as f:
+       f.write(content)
+
+def _file_digest(path):
+    try:
+       with open(path, "rb") as f:
+          return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+       return None
+
+def _load_manifest(script_dir):
+    """
+    Load the manifest of a directory of sbatch scripts, i.e. a dict filename -> hash of the content
+    """
+    path = os.path.join(script_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+       return {}
+    with open(path) as f:
+       return json.load(f)
+
+def _set_script_digests(jobdefs):
+    """
+    Set the digest of the sbatch script of each job from the manifests written by `build`, if any
+    (see `skip_finished_jobs`)
+    """
+    manifests = {}
+    for jobdef in jobdefs:
+       script_dir, filename = os.path.split(jobdef.sbatch_script)
+       script_dir = script_dir or "."
+       if script_dir not in manifests:
+          manifests[script_dir] = _load_manifest(script_dir)
+       jobdef.script_digest = manifests[script_dir].get(filename)
+
+def _save_manifest(script_dir, manifest):
+    path = os.path.join(script_dir, MANIFEST_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+       json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _load_config(config, fix=None):
+    """
+    Load the yaml config file, and override the params given in `fix` (list of key=value)
+    """
     cfg = OmegaConf.load(config)
     if fix:
         for param in fix:
             assert "=" in param, "Invalid param format. Please use key=value."
             key, value = param.split("=")
-            cfg[key] = value       
-    jobdefs = generate_job_defs(cfg, verbose=verbose)
-    for jobdef in jobdefs:
-       _assert_job_name(jobdef.config, jobdef.name)
-       os.makedirs(os.path.dirname(jobdef.sbatch_script), exist_ok=True)
-       print(f"Building '{jobdef.sbatch_script}'...")
-       with open(f"{jobdef.sbatch_script}", "w") as f:
-          f.write(jobdef.config)
-       os.makedirs(os.path.dirname(jobdef.output_file), exist_ok=True)
+            cfg[key] = value
+    return cfg
 
-def _assert_job_name(config:str, name:str):
-    # check if there is a line containing `#SBATCH --job-name={name}`
-    if f"#SBATCH --job-name={name}" not in config:
-        raise ValueError("Please add #SBATCH --job-name={name} to your sbatch templates")
+def _load_job_defs(config, fix=None, where=None, sweep_cache=None, no_sweep_cache=False, verbose=1):
+    """
+    Returns the list of (compact) job definitions of the config file, whose params match `where` (see `iter_job_defs`).
+    They are loaded from the sweep cache (see `autoexperiment.sweep_cache`) if it is up to date, otherwise the
+    config is expanded, and the cache written if the whole sweep was expanded (i.e., without `where`).
+    Raises `ValidationError` if the jobs are not valid (sbatch scripts are not checked, see `validate_job_defs`).
+    """
+    cfg = _load_config(config, fix)
+    cache = None if no_sweep_cache else SweepCache(sweep_cache or _default_sweep_cache(config))
+    jobdefs = cache.load(cfg) if cache else None
+    if jobdefs is None:
+        jobdefs = list(iter_job_defs(cfg, verbose=verbose, where=where, compact=True, unique_names=False))
+        validation_warnings = validate_job_defs(jobdefs)
+        if verbose:
+            for warning in validation_warnings:
+                print(warning)
+        if cache and not where:
+            cache.save(cfg, jobdefs)
+        return jobdefs
+    if verbose:
+        print(f"Loaded {len(jobdefs)} job(s) from the sweep cache '{cache.path}'.")
+    if where:
+        jobdefs = [jobdef for jobdef in jobdefs if all(predicate(jobdef.param(k)) for k, predicate in where.items())]
+    return jobdefs
 
-def run(config, *params, filter_cmd:str=None, dry=False, verbose=1, max_jobs:int=None, fix:('f', multi()), max_start_attempts:int=None):
+
+def run(config, *params, filter_cmd:str=None, dry=False, verbose=1, max_jobs:int=None, fix:('f', multi()), max_start_attempts:int=None, queue_poll_secs:int=60, max_concurrent_cmds:int=32, cmd_timeout_secs:int=600, state_db:str=None, no_state=False, array=False, watch=False, watch_poll_secs:int=5, condition_ttl_secs:int=60, jobs:'j'=1, max_nodes:int=None, group_by:str=None, group_quota:('q', multi()), metrics_port:int=None, metrics_file:str=None, metrics_interval_secs:int=30, profile:str=None, adaptive_checks=False, check_jitter:float=None, submit_rate:float=None, submit_burst:int=10, cancel_delay_secs:float=1, workers:int=1, sweep_cache:str=None, no_sweep_cache=False):
     """
     Manage/schedule jobs corresponding to a config file after
     having generated the sbatch scripts.
     This step requires the 'build' step to have been done first.
     
+    :param params: Only manage the jobs whose params match all the filters, e.g. `dataset=datacomp,laion` (values can be glob patterns or ranges like `lr=0.001..0.01`) or `model~ViT-[BL]-.*` (regex)
     :param max_jobs: Maximum total jobs in SLURM queue (any state)
+    :param max_nodes: Maximum total nodes (`nodes` param of each job) of the jobs in SLURM queue
+    :param group_by: Param used to group jobs (e.g. `mode`), jobs of the group using the fewest nodes are submitted first
+    :param group_quota: Maximum number of jobs of a group in SLURM queue, e.g. `eval=5` (requires --group-by)
+    :param metrics_port: Serve metrics of the manager (scheduler calls, conditions, log scans, event loop lag, jobs per state, restarts, freezes) on this port, in the Prometheus text format
+    :param metrics_file: Write metrics of the manager as JSON to this file, every metrics_interval_secs
+    :param profile: Profile the manager with cProfile, and write the stats to this file on exit
+    :param queue_poll_secs: Secs between two snapshots of the SLURM queue (a single squeue call for all the jobs)
+    :param max_concurrent_cmds: Maximum number of shell commands (sbatch, squeue, start/termination conditions) running at the same time
+    :param cmd_timeout_secs: Shell commands running for longer than that are killed
+    :param state_db: Path of the SQLite database where the state of the jobs is stored, defaults to the config path with a '.state.db' extension
+    :param no_state: Do not use the state database, i.e. check all the jobs again from scratch
+    :param array: Submit jobs as tasks of SLURM job arrays, requires the arrays to be built with `build --array`
+    :param watch: Watch the output files of running jobs for changes (uses file-change events if watchdog is installed), to detect termination strings within seconds, and frozen jobs as soon as their last write is older than check_interval_secs
+    :param watch_poll_secs: With --watch, secs between two polls of the output files, for filesystems that do not deliver change events
+    :param condition_ttl_secs: Secs during which the result of a start/termination condition command is reused (identical commands are only run once)
+    :param jobs: Number of filter commands (see --filter-cmd) run in parallel
+    :param workers: Number of worker processes managing the jobs, split by a hash of their name, for very large sweeps (the main process polls the queue once for all of them and enforces --max-jobs/--max-nodes/--group-quota)
+    :param adaptive_checks: Check pending jobs and jobs steadily writing output less often, and jobs that were just launched or are near their time limit (#SBATCH --time) more often, instead of every check_interval_secs
+    :param check_jitter: Randomly scale each delay between two checks by up to +/- this fraction, to spread the checks of the jobs over time (default: 0.2 with --adaptive-checks, 0 otherwise)
+    :param submit_rate: Maximum number of sbatch calls per sec (shared by the workers), after submit_burst calls at once. In any case, submissions are paused with an exponential backoff when sbatch fails because the controller does not respond or a QOS/association submit limit is reached
+    :param submit_burst: Maximum number of sbatch calls at once, with --submit-rate
+    :param cancel_delay_secs: Frozen jobs detected within that delay are cancelled together, with a single scancel call
+    :param sweep_cache: Path of the cache of the expanded sweep written by `build` (see `build`)
+    :param no_sweep_cache: Do not use the cache of the expanded sweep, i.e. always expand the config again
     """
     if not config:
          print("Please specify a config file")
          return 1
-    cfg = OmegaConf.load(config)
-    if fix:
-        for param in fix:
-            assert "=" in param, "Invalid param format. Please use key=value."
-            key, value = param.split("=")
-            cfg[key] = value
-    jobdefs = generate_job_defs(cfg, verbose=verbose)
-    if params:
-        # filter jobs by params
-        params_dict = {}
-        for param in params:
-            assert "=" in param, "Invalid param format. Please use key=value."
-            key, value = param.split("=")
-            params_dict[key] = value.split(",")
-        jobdefs = [jobdef for jobdef in jobdefs if all(str(jobdef.params.get(k)) in vs for k, vs in params_dict.items())]
+    group_quotas = _parse_group_quotas(group_quota)
+    # filter jobs by params, the filters are applied while expanding the config (if it is not cached)
+    where = dict(parse_param_filter(param) for param in params)
+    # sbatch scripts are not rendered here, they are already built
+    # the manager needs the full list of (filtered) jobs
+    jobdefs = _load_job_defs(config, fix, where=where, sweep_cache=sweep_cache, no_sweep_cache=no_sweep_cache, verbose=verbose)
     if filter_cmd:
-        jobdefs = [jobdef for jobdef in jobdefs if os.system(filter_cmd.format(**jobdef.params)) == 0]
+        # filter commands are only run for the jobs selected by `params`
+        jobdefs = _filter_jobs(jobdefs, filter_cmd, jobs=jobs, verbose=verbose)
+    array_tasks = load_array_tasks(jobdefs) if array else {}
     for jobdef in jobdefs:
         jobdef.max_start_attempts = max_start_attempts if max_start_attempts else float('inf')
         jobdef.dry = dry
-    manage_jobs_forever(jobdefs, max_jobs=max_jobs, verbose=verbose)
+        jobdef.array_task = array_tasks.get(jobdef.name)
+    _set_script_digests(jobdefs)
+    store = None
+    if not no_state and not dry:
+        store = StateStore(state_db or _default_state_db(config))
+    try:
+        manage_jobs_forever(
+            jobdefs, max_jobs=max_jobs, queue_poll_secs=queue_poll_secs,
+            max_concurrent_cmds=max_concurrent_cmds, cmd_timeout_secs=cmd_timeout_secs, store=store,
+            watch=watch, watch_poll_secs=watch_poll_secs, condition_ttl_secs=condition_ttl_secs,
+            max_nodes=max_nodes, group_by=group_by, group_quotas=group_quotas,
+            metrics_port=metrics_port, metrics_file=metrics_file, metrics_interval_secs=metrics_interval_secs, profile=profile,
+            adaptive_checks=adaptive_checks, check_jitter=check_jitter, submit_rate=submit_rate, submit_burst=submit_burst,
+            cancel_delay_secs=cancel_delay_secs, workers=workers, verbose=verbose,
+        )
+    finally:
+        if store:
+            store.close()
+
+def _default_state_db(config):
+    return os.path.splitext(config)[0] + ".state.db"
 
-def build_and_run(config, *params, dry=False, verbose=1, max_jobs:int=None, fix:('f', multi())):
+def _default_sweep_cache(config):
+    return os.path.splitext(config)[0] + ".sweep"
+
+def _default_socket_path(config):
+    return os.path.splitext(config)[0] + ".sock"
+
+def _parse_group_quotas(group_quota):
+    group_quotas = {}
+    for quota in group_quota:
+        assert "=" in quota, "Invalid quota format. Please use group=max_jobs."
+        group, value = quota.rsplit("=", 1)
+        group_quotas[group] = int(value)
+    return group_quotas
+
+def build_and_run(config, *params, dry=False, verbose=1, max_jobs:int=None, fix:('f', multi()), queue_poll_secs:int=60, max_concurrent_cmds:int=32, cmd_timeout_secs:int=600, state_db:str=None, no_state=False, array=False, watch=False, watch_poll_secs:int=5, condition_ttl_secs:int=60, max_nodes:int=None, group_by:str=None, group_quota:('q', multi()), metrics_port:int=None, metrics_file:str=None, metrics_interval_secs:int=30, profile:str=None, adaptive_checks=False, check_jitter:float=None, submit_rate:float=None, submit_burst:int=10, cancel_delay_secs:float=1, workers:int=1, sweep_cache:str=None, no_sweep_cache=False):
     """
     do both above at the same time, for simplicity
     """
-    build(config, fix=fix, verbose=verbose)
-    run(config, *params, dry=dry, verbose=verbose, fix=fix, max_jobs=max_jobs)
+    build(config, fix=fix, verbose=verbose, array=array, sweep_cache=sweep_cache, no_sweep_cache=no_sweep_cache)
+    run(
+        config, *params, dry=dry, verbose=verbose, fix=fix, max_jobs=max_jobs, queue_poll_secs=queue_poll_secs,
+        max_concurrent_cmds=max_concurrent_cmds, cmd_timeout_secs=cmd_timeout_secs, state_db=state_db, no_state=no_state, array=array,
+        watch=watch, watch_poll_secs=watch_poll_secs, condition_ttl_secs=condition_ttl_secs,
+        max_nodes=max_nodes, group_by=group_by, group_quota=group_quota,
+        metrics_port=metrics_port, metrics_file=metrics_file, metrics_interval_secs=metrics_interval_secs, profile=profile,
+        adaptive_checks=adaptive_checks, check_jitter=check_jitter, submit_rate=submit_rate, submit_burst=submit_burst,
+        cancel_delay_secs=cancel_delay_secs, workers=workers, sweep_cache=sweep_cache, no_sweep_cache=no_sweep_cache,
+    )
+
+def daemon(config, *params, verbose=1, max_jobs:int=None, fix:('f', multi()), max_start_attempts:int=None, queue_poll_secs:int=60, max_concurrent_cmds:int=32, cmd_timeout_secs:int=600, state_db:str=None, no_state=False, watch=False, watch_poll_secs:int=5, condition_ttl_secs:int=60, max_nodes:int=None, group_by:str=None, group_quota:('q', multi()), adaptive_checks=False, check_jitter:float=None, submit_rate:float=None, submit_burst:int=10, cancel_delay_secs:float=1, socket_path:str=None, reload_interval_secs:int=5):
+    """
+    Manage the jobs of a config file like `run`, until stopped with `ctl config.yaml stop`.
+    The config file and the templates are reloaded when they change: only the new jobs are started,
+    the removed ones stopped, and the modified ones re-rendered, the other jobs being left as is.
+    The daemon is controlled with `ctl` (status, add, remove, pause, resume, set, reload, stop).
+    The sbatch scripts are built by the daemon, there is no need to run `build` first.
+
+    :param params: Only manage the jobs whose params match all the filters (see `run`), more jobs can be added with `ctl config.yaml add`
+    :param socket_path: Path of the Unix socket where the daemon accepts commands, defaults to the config path with a '.sock' extension
+    :param reload_interval_secs: Secs between two checks of whether the config file or the templates changed
+    """
+    from autoexperiment.daemon import ControlError, Daemon
+    where = dict(parse_param_filter(param) for param in params)
+
+    def load_job_defs():
+        jobdefs = _load_job_defs(config, fix, verbose=verbose)
+        for jobdef in jobdefs:
+            jobdef.max_start_attempts = max_start_attempts if max_start_attempts else float('inf')
+            jobdef.dry = False
+            jobdef.array_task = None
+        return jobdefs
+
+    store = None if no_state else StateStore(state_db or _default_state_db(config))
+    daemon = Daemon(
+        config, load_job_defs, lambda jobdefs: _build_job_defs(jobdefs, verbose=verbose), socket_path or _default_socket_path(config),
+        where=where, reload_interval_secs=reload_interval_secs, max_jobs=max_jobs, max_nodes=max_nodes,
+        group_by=group_by, group_quotas=_parse_group_quotas(group_quota), queue_poll_secs=queue_poll_secs,
+        max_concurrent_cmds=max_concurrent_cmds, cmd_timeout_secs=cmd_timeout_secs, store=store,
+        watch=watch, watch_poll_secs=watch_poll_secs, condition_ttl_secs=condition_ttl_secs,
+        adaptive_checks=adaptive_checks, check_jitter=check_jitter, submit_rate=submit_rate, submit_burst=submit_burst,
+        cancel_delay_secs=cancel_delay_secs, verbose=verbose,
+    )
+    try:
+        asyncio.get_event_loop().run_until_complete(daemon.run())
+    except ControlError as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 1
+    finally:
+        if store:
+            store.close()
 
-def for_each(config, cmd):
-    jobdefs = generate_job_defs(config)
+def _build_job_defs(jobdefs, verbose=1):
+    """
+    Write the sbatch scripts of `jobdefs` (if they changed), and update the manifests of their directories (see `build`)
+    """
+    for warning in validate_job_defs(jobdefs, render=True):
+        print(warning)
+    manifests = {}
     for jobdef in jobdefs:
-        cmd_ = cmd.format(**jobdef.params)
-        call(cmd_, shell=True)
+       sbatch = jobdef.render()
+       script_dir, filename = os.path.split(jobdef.sbatch_script)
+       script_dir = script_dir or "."
+       if script_dir not in manifests:
+          os.makedirs(script_dir, exist_ok=True)
+          manifests[script_dir] = _load_manifest(script_dir)
+       digest = hashlib.sha1(sbatch.encode()).hexdigest()
+       if manifests[script_dir].get(filename) != digest or not os.path.exists(jobdef.sbatch_script):
+          if verbose:
+             print(f"Building '{jobdef.sbatch_script}'...")
+          _write_file(jobdef.sbatch_script, sbatch)
+          manifests[script_dir][filename] = digest
+       jobdef.script_digest = digest
+       output_dir = os.path.dirname(jobdef.output_file)
+       if output_dir:
+          os.makedirs(output_dir, exist_ok=True)
+    for script_dir, manifest in manifests.items():
+       _save_manifest(script_dir, manifest)
+
+def ctl(config, cmd, *args, socket_path:str=None):
+    """
+    Send a command to the daemon managing a config file (see `daemon`), and print its result:
+
+    status [filters]: number of jobs per state, and the state of each job matching the filters if any;
+    add filters: also manage the jobs matching the filters (e.g. new seeds added to the config);
+    remove filters: stop managing the jobs matching the filters, and cancel their SLURM jobs;
+    pause [filters] / resume [filters]: stop/restart monitoring and relaunching the jobs;
+    set max_jobs=N / set max_nodes=N: change the limits;
+    reload: reload the config file now;
+    stop: stop the daemon, leaving the SLURM jobs as is.
+
+    :param socket_path: Path of the Unix socket of the daemon, defaults to the config path with a '.sock' extension
+    """
+    from autoexperiment.daemon import ControlError, send_command
+    try:
+        result = asyncio.get_event_loop().run_until_complete(send_command(socket_path or _default_socket_path(config), cmd, args))
+    except (ConnectionError, FileNotFoundError):
+        print(f"No daemon is listening on '{socket_path or _default_socket_path(config)}'", file=sys.stderr)
+        return 1
+    except ControlError as ex:
+        print(f"Error: {ex}", file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2))
+
+def for_each(config, cmd, *, fix:('f', multi()), jobs:'j'=1, verbose=1, sweep_cache:str=None, no_sweep_cache=False):
+    """
+    Run a shell command for each job, where the command can use the params of the job, e.g. `echo {name}`
+
+    :param jobs: Number of commands run in parallel (their output is shown in the order of the jobs)
+    :param sweep_cache: Path of the cache of the expanded sweep written by `build` (see `build`)
+    :param no_sweep_cache: Do not use the cache of the expanded sweep, i.e. always expand the config again
+    """
+    jobdefs = _load_job_defs(config, fix, sweep_cache=sweep_cache, no_sweep_cache=no_sweep_cache, verbose=0)
+    cmds = [cmd.format(**jobdef.params) for jobdef in jobdefs]
+    failures = [
+        (jobdef.name, returncode)
+        for jobdef, returncode in zip(jobdefs, _run_commands(cmds, jobs=jobs, verbose=verbose))
+        if returncode != 0
+    ]
+    if failures:
+        print(f"{len(failures)} of {len(cmds)} command(s) failed:", file=sys.stderr)
+        for name, returncode in failures:
+            print(f"  {name}: exit code {returncode}", file=sys.stderr)
+        return 1
+
+def validate(config, *, fix:('f', multi()), verbose=1, sweep_cache:str=None, no_sweep_cache=False):
+    """
+    Check the jobs of a config file and their sbatch scripts, without writing them, and report all the problems at once:
+    duplicate names, output files or sbatch scripts, job names too long for SLURM, sbatch scripts without
+    `#SBATCH --job-name={name}`, templates referencing undefined params, and unresolved {placeholders} (warnings)
+
+    :param sweep_cache: Path of the cache of the expanded sweep (see `build`)
+    :param no_sweep_cache: Do not use the cache of the expanded sweep, i.e. always expand the config again
+    """
+    jobdefs = _load_job_defs(config, fix, sweep_cache=sweep_cache, no_sweep_cache=no_sweep_cache, verbose=0)
+    for warning in validate_job_defs(jobdefs, render=True):
+        print(warning)
+    if verbose:
+        print(f"{len(jobdefs)} job(s) checked, no error found.")
+
+def _filter_jobs(jobdefs, filter_cmd, jobs=1, verbose=1):
+    """
+    Returns the jobs for which `filter_cmd` (formatted with the params of the job) succeeds.
+    The jobs excluded are summarized per exit code, as codes other than 1 are usually errors
+    of the command itself (e.g. 127 if it is not found).
+    """
+    cmds = [filter_cmd.format(**jobdef.params) for jobdef in jobdefs]
+    kept = []
+    # exit code -> names of the jobs excluded
+    excluded = {}
+    for jobdef, returncode in zip(jobdefs, _run_commands(cmds, jobs=jobs, verbose=verbose)):
+        if returncode == 0:
+            kept.append(jobdef)
+        else:
+            excluded.setdefault(returncode, []).append(jobdef.name)
+    if verbose:
+        print(f"Filter command kept {len(kept)} of {len(jobdefs)} job(s).")
+        for returncode, names in sorted(excluded.items()):
+            shown = ", ".join(names[:3]) + (", ..." if len(names) > 3 else "")
+            print(f"  exit code {returncode}: {len(names)} job(s) excluded ({shown})")
+    return kept
+
+def _run_commands(cmds, jobs=1, verbose=1):
+    """
+    Run shell commands, at most `jobs` at the same time, and yield their return code in order.
+
+    With jobs > 1, the output of each command is captured and shown once the previous commands
+    are done, so that it is not interleaved with the output of the others.
+    A progress line is shown on stderr, if it is a terminal.
+    """
+    if jobs <= 1:
+        for cmd in cmds:
+            yield call(cmd, shell=True)
+        return
+    progress = _Progress(len(cmds)) if verbose and sys.stderr.isatty() else None
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = [executor.submit(run_process, cmd, shell=True, stdout=PIPE, stderr=PIPE) for cmd in cmds]
+    try:
+        for future in futures:
+            while True:
+                try:
+                    result = future.result(timeout=1)
+                    break
+                except FuturesTimeoutError:
+                    if progress:
+                        progress.show(sum(f.done() for f in futures))
+            if progress:
+                progress.clear()
+            sys.stdout.buffer.write(result.stdout)
+            sys.stdout.flush()
+            sys.stderr.buffer.write(result.stderr)
+            sys.stderr.flush()
+            yield result.returncode
+    finally:
+        # e.g., on Ctrl+C, do not start the remaining commands
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if progress:
+            progress.clear()
+
+class _Progress:
+
+    def __init__(self, total):
+        self.total = total
+
+    def show(self, done):
+        sys.stderr.write(f"\r{done}/{self.total} command(s) done")
+        sys.stderr.flush()
+
+    def clear(self):
+        sys.stderr.write("\r\033[K")
+        sys.stderr.flush()
+
+def benchmark(*nb_jobs:int, duration_secs:int=60, check_interval_secs:int=1, queue_poll_secs:int=1, max_jobs:int=None, queue_delay_secs:float=5, run_secs:float=30, time_limit_secs:float=None, preemption_rate:float=0.0, hang_prob:float=0.0, seed:int=0, watch=False, adaptive_checks=False, check_jitter:float=None, memory=False):
+    """
+    Benchmark the manager on a simulated SLURM cluster, for each number of jobs given (default: 100 1000 10000)
+
+    :param duration_secs: Maximum duration of each run of the manager
+    :param queue_delay_secs: Secs spent by the simulated jobs in the pending state
+    :param run_secs: Total running time of each simulated job (progress is kept across restarts)
+    :param time_limit_secs: Simulated jobs are killed after running that long
+    :param preemption_rate: Probability per sec of a running job to be preempted
+    :param hang_prob: Probability of a simulated job to hang (stop writing to its output file) when it starts
+    :param watch: Run the manager with --watch
+    :param adaptive_checks: Run the manager with --adaptive-checks
+    :param check_jitter: Run the manager with --check-jitter
+    :param memory: Instead, measure the memory used by the job definitions of a sweep, for each representation of the jobs (default: 10000 100000 jobs)
+    """
+    if memory:
+        from autoexperiment.benchmark import run_memory_benchmarks, DEFAULT_MEMORY_NB_JOBS
+        run_memory_benchmarks(nb_jobs or DEFAULT_MEMORY_NB_JOBS)
+        return
+    from autoexperiment.benchmark import run_benchmarks, DEFAULT_NB_JOBS
+    run_benchmarks(
+        nb_jobs or DEFAULT_NB_JOBS, duration_secs=duration_secs, check_interval_secs=check_interval_secs,
+        queue_poll_secs=queue_poll_secs, max_jobs=max_jobs, queue_delay_secs=queue_delay_secs, run_secs=run_secs,
+        time_limit_secs=time_limit_secs, preemption_rate=preemption_rate, hang_prob=hang_prob, seed=seed, watch=watch,
+        adaptive_checks=adaptive_checks, check_jitter=check_jitter,
+    )
 
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
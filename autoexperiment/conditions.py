@@ -0,0 +1,152 @@
+"""
+Evaluation of the start conditions (`start_condition_cmd`) and termination conditions (`termination_cmd`) of the jobs.
+
+A condition is a shell command that outputs an integer (1 means true), e.g.
+`ls {logs}/{name}/checkpoints/*.pt | wc -l`, or a built-in condition, which is evaluated
+in Python without running a shell, e.g.:
+
+   builtin: count("{logs}/{name}/checkpoints/*.pt") - count("{logs}/{name}/checkpoints/imagenet1k*.json") > 0
+
+Built-in conditions are restricted python expressions, like `expr(...)` params (see `autoexperiment.template.Expression`),
+which can use the following functions:
+- `count(pattern)`: number of files matching the glob `pattern` (`**` matches any number of dirs)
+- `exists(path)`: whether `path` exists
+- `lines(path, regex=None)`: number of lines of the file `path` (0 if it does not exist), containing `regex` if provided
+- `min`, `max`, `abs`, `int`, `len`
+"""
+import asyncio
+import glob
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from subprocess import CalledProcessError, TimeoutExpired
+
+from autoexperiment.metrics import metrics
+from autoexperiment.template import Expression
+
+BUILTIN_PREFIX = "builtin:"
+
+
+class ConditionEngine:
+    """
+    Evaluate conditions, with:
+    - deduplication: identical commands evaluated at the same time (e.g., by several jobs) are run only once,
+    - caching: the result of each command is reused for `ttl_secs` secs,
+    - built-in conditions (see above) evaluated in a pool of `max_workers` threads, shell commands
+    being run with `runner` (`CommandRunner`), which bounds the number of concurrent commands.
+
+    `evaluate` returns the integer output of the condition, or raises `CalledProcessError`,
+    `TimeoutExpired` or `ValueError` if it fails (failures are cached as well).
+    """
+    def __init__(self, runner, ttl_secs=0, max_workers=8, verbose=0):
+        self.runner = runner
+        self.ttl_secs = ttl_secs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.verbose = verbose
+        # cmd -> (time at which the evaluation started, value, exception)
+        self.cache = {}
+        # cmd -> future, for the evaluations in progress
+        self.pending = {}
+        self.stats = Counter()
+        self.max_cache_size = 10000
+
+    async def evaluate(self, cmd, max_age=None):
+        """
+        Evaluate the condition `cmd`, reusing a result at most `max_age` secs old (defaults to `ttl_secs`)
+        """
+        max_age = self.ttl_secs if max_age is None else max_age
+        cached = self.cache.get(cmd)
+        if cached is not None and time.time() - cached[0] < max_age:
+            self.stats["cached"] += 1
+            metrics.inc("condition_cache_hits_total")
+            return _unpack(cached)
+        future = self.pending.get(cmd)
+        if future is None:
+            future = asyncio.ensure_future(self._evaluate(cmd))
+            self.pending[cmd] = future
+            future.add_done_callback(lambda _: self.pending.pop(cmd, None))
+        else:
+            self.stats["deduplicated"] += 1
+            metrics.inc("condition_deduplicated_total")
+        # a cancelled caller should not cancel the evaluation for the others
+        return await asyncio.shield(future)
+
+    async def _evaluate(self, cmd):
+        started_at = time.time()
+        kind = "builtin" if cmd.startswith(BUILTIN_PREFIX) else "shell"
+        self.stats[kind] += 1
+        try:
+            with metrics.time("condition_seconds", kind=kind):
+                if kind == "builtin":
+                    loop = asyncio.get_event_loop()
+                    value = await loop.run_in_executor(self.executor, evaluate_builtin, cmd[len(BUILTIN_PREFIX):])
+                else:
+                    value = int(await self.runner.check_output(cmd))
+        except (CalledProcessError, TimeoutExpired, ValueError) as ex:
+            metrics.inc("condition_errors_total", kind=kind)
+            self._store(cmd, (started_at, None, ex))
+            raise
+        self._store(cmd, (started_at, value, None))
+        return value
+
+    def _store(self, cmd, result):
+        if self.ttl_secs <= 0:
+            return
+        if len(self.cache) >= self.max_cache_size:
+            now = time.time()
+            self.cache = {k: v for k, v in self.cache.items() if now - v[0] < self.ttl_secs}
+        self.cache[cmd] = result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def evaluate_builtin(expr):
+    """
+    Evaluate a built-in condition (without the 'builtin:' prefix), returns an integer
+    """
+    try:
+        return int(_compile(expr.strip()).evaluate({}))
+    except Exception as ex:
+        raise ValueError(f"Cannot evaluate built-in condition '{expr.strip()}' (Exception: {ex})") from ex
+
+
+@lru_cache(maxsize=1024)
+def _compile(expr):
+    # the results are not cached, as they depend on the files
+    return Expression(f"expr({expr})", placeholders=False, functions=BUILTINS, cache=False)
+
+
+def _unpack(result):
+    _, value, exception = result
+    if exception is not None:
+        raise exception
+    return value
+
+
+def count(pattern):
+    return sum(1 for _ in glob.iglob(pattern, recursive=True))
+
+
+def lines(path, regex=None):
+    pattern = re.compile(regex) if regex else None
+    try:
+        with open(path, errors="ignore") as f:
+            return sum(1 for line in f if pattern is None or pattern.search(line))
+    except FileNotFoundError:
+        return 0
+
+
+BUILTINS = {
+    "count": count,
+    "exists": os.path.exists,
+    "lines": lines,
+    "min": min,
+    "max": max,
+    "abs": abs,
+    "int": int,
+    "len": len,
+}
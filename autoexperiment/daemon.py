@@ -0,0 +1,365 @@
+"""
+Long-running manager, controlled through a local Unix socket (see `autoexperiment ctl`).
+
+The daemon manages the jobs of a config file like `run`, but:
+- it reloads the config file (and the templates) when they change, and only starts the new jobs,
+  stops the removed ones, and re-renders and restarts the monitoring of the modified ones,
+  the other jobs keeping their monitoring state,
+- it answers the following commands, sent as JSON lines on its control socket:
+  - `status [filters]`: number of jobs per state (and the state of each job matching the filters, if any),
+  - `add filters`: also manage the jobs of the config matching the filters,
+  - `remove filters`: stop managing the jobs matching the filters, and cancel their SLURM jobs,
+  - `pause [filters]`: stop monitoring and relaunching the jobs, their SLURM jobs are left as is,
+  - `resume [filters]`: monitor the paused jobs again,
+  - `set key=value`: change `max_jobs` or `max_nodes`,
+  - `reload`: reload the config file now,
+  - `stop`: stop the daemon, the SLURM jobs are left as is.
+Filters are the same as the ones of `run`, e.g. `dataset=datacomp,laion` or `model~ViT-.*`.
+"""
+import asyncio
+import json
+import os
+import time
+
+from autoexperiment.backends import SchedulerError
+from autoexperiment.manager import JobLimitsManager, Manager, reconcile_jobs, skip_finished_jobs
+from autoexperiment.metrics import metrics
+from autoexperiment.store import JOB_FINISHED
+from autoexperiment.template import parse_param_filter
+
+JOB_PAUSED = "paused"
+
+
+class ControlError(Exception):
+    pass
+
+
+class Daemon:
+    """
+    Manage the jobs returned by `load_job_defs` (a function returning the list of `JobDef`
+    of the config file `config`), until the `stop` command, serving the control API on `socket_path`.
+
+    `build_job_defs` is called with the new and modified jobs, to write their sbatch scripts.
+    Only the jobs matching `where` (see `parse_param_filter`), or added with `add`, are managed.
+    `manager_kwargs` are the arguments of `Manager`.
+    """
+    # the commands are applied while holding `lock`: if the scheduler cannot be reached, they fail
+    # after `reconcile_attempts` calls to it, instead of blocking the other commands
+    reconcile_attempts = 3
+    reconcile_retry_secs = 5
+
+    def __init__(self, config, load_job_defs, build_job_defs, socket_path, where=None, reload_interval_secs=5, max_jobs=None, max_nodes=None, group_by=None, group_quotas=None, verbose=1, **manager_kwargs):
+        self.config = config
+        self.load_job_defs = load_job_defs
+        self.build_job_defs = build_job_defs
+        self.socket_path = socket_path
+        self.reload_interval_secs = reload_interval_secs
+        self.verbose = verbose
+        self.manager_kwargs = manager_kwargs
+        # limits can be changed at runtime, so they are always enforced by a `JobLimitsManager`
+        self.limits_manager = JobLimitsManager(max_jobs, max_nodes=max_nodes, group_by=group_by, group_quotas=group_quotas)
+        self.manager = None
+        # filters (dict param name -> predicate) of the jobs to manage, i.e. `where` and the ones given to `add`
+        self.selections = [where or {}]
+        # names of the jobs removed with `remove`
+        self.removed = set()
+        # name -> JobDef, for the managed jobs
+        self.jobdefs = {}
+        # name -> task managing the job, for the jobs that are not paused
+        self.tasks = {}
+        self.paused = set()
+        # names of the jobs that could not be started yet (e.g. the scheduler could not be reached),
+        # started again by the next reload
+        self.unstarted = set()
+        # path -> mtime, for the config file and the templates
+        self.mtimes = {}
+        self.reloaded_at = None
+        self.stopped = None
+        # reloads and the commands changing the managed jobs are applied one at a time,
+        # e.g. so that a reload and `ctl reload` do not both start the added jobs
+        self.lock = None
+
+    async def run(self):
+        await _check_socket(self.socket_path)
+        self.manager = Manager(limits_manager=self.limits_manager, verbose=self.verbose, **self.manager_kwargs)
+        self.manager.start()
+        self.stopped = asyncio.Event()
+        self.lock = asyncio.Lock()
+        server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        print(f"Listening for commands on '{self.socket_path}'")
+        reloader = None
+        try:
+            try:
+                await self.reload()
+            except SchedulerError as ex:
+                print(f"Cannot start the jobs, retrying at the next reload: {ex}")
+            reloader = asyncio.ensure_future(self._reload_forever())
+            await self.stopped.wait()
+        finally:
+            if reloader:
+                reloader.cancel()
+            server.close()
+            for task in self.tasks.values():
+                task.cancel()
+            self.manager.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    async def reload(self, force=False):
+        """
+        Load the config file again, and apply the differences with the managed jobs
+        """
+        async with self.lock:
+            return await self._reload(force=force)
+
+    async def _reload(self, force=False):
+        changed_paths = {path for path, mtime in self.mtimes.items() if _mtime(path) != mtime}
+        self.reloaded_at = time.time()
+        all_jobdefs = self.load_job_defs()
+        jobdefs = {jobdef.name: jobdef for jobdef in all_jobdefs if self._is_selected(jobdef)}
+        self.mtimes = {path: _mtime(path) for path in _watched_paths(self.config, all_jobdefs)}
+        # jobs using a modified template are re-rendered as well
+        changed_templates = {path for path in changed_paths if path != self.config}
+        removed = [name for name in self.jobdefs if name not in jobdefs]
+        added = [jobdef for name, jobdef in jobdefs.items() if name not in self.jobdefs]
+        modified = [
+            jobdef for name, jobdef in jobdefs.items()
+            if name in self.jobdefs and (jobdef != self.jobdefs[name] or jobdef.params.get("template") in changed_templates)
+        ]
+        if removed:
+            await self._stop_jobs(removed, cancel=True)
+        if added or modified:
+            self.build_job_defs(added + modified)
+        for jobdef in modified:
+            # restarted below, resuming the SLURM job of the job (if any)
+            await self._stop_jobs([jobdef.name], cancel=False)
+            self.jobdefs[jobdef.name] = jobdef
+        for jobdef in added:
+            self.jobdefs[jobdef.name] = jobdef
+        # jobs known to be finished are not started, and new jobs resume from their record in the store, if any
+        remaining, records = skip_finished_jobs(added, self.manager.store)
+        remaining_names = {jobdef.name for jobdef in remaining}
+        for jobdef in added:
+            if jobdef.name not in remaining_names:
+                metrics.set_job_state(jobdef.name, JOB_FINISHED)
+            elif jobdef.name in records:
+                self.manager.records[jobdef.name] = records[jobdef.name]
+        # and the jobs that could not be started by a previous reload
+        started = remaining + modified
+        started_names = {jobdef.name for jobdef in started}
+        started += [self.jobdefs[name] for name in sorted(self.unstarted) if name in self.jobdefs and name not in started_names]
+        await self._start_jobs([jobdef for jobdef in started if jobdef.name not in self.paused])
+        if self.verbose and (added or removed or modified or force):
+            print(f"Config reloaded: {len(added)} job(s) added, {len(removed)} removed, {len(modified)} modified, {len(self.jobdefs)} managed")
+        return {"added": [jobdef.name for jobdef in added], "removed": removed, "modified": [jobdef.name for jobdef in modified]}
+
+    async def execute(self, cmd, args):
+        """
+        Execute the command `cmd` of the control API with the arguments `args` (list of str), returns a JSON-serializable result
+        """
+        if cmd == "status":
+            return self.status(args)
+        if cmd == "reload":
+            return await self.reload(force=True)
+        if cmd == "stop":
+            self.stopped.set()
+            return {"stopping": True}
+        if cmd == "set":
+            return self.set_limits(args)
+        if cmd not in ("add", "remove", "pause", "resume"):
+            raise ControlError(f"Unknown command '{cmd}', expected one of: status, add, remove, pause, resume, set, reload, stop")
+        filters = _parse_filters(args)
+        async with self.lock:
+            return await self._update(cmd, filters)
+
+    async def _update(self, cmd, filters):
+        """
+        Execute the command `cmd` changing the managed jobs (add, remove, pause or resume) with the filters `filters`
+        """
+        if cmd == "add":
+            if not filters:
+                raise ControlError("add requires at least one filter, e.g. `seed=4`")
+            self.selections.append(filters)
+            self.removed -= {jobdef.name for jobdef in self.load_job_defs() if _matches(jobdef, filters)}
+            return await self._reload()
+        names = [name for name, jobdef in self.jobdefs.items() if _matches(jobdef, filters)]
+        if cmd == "remove":
+            if not filters:
+                raise ControlError("remove requires at least one filter, e.g. `dataset=laion`")
+            self.removed.update(names)
+            await self._stop_jobs(names, cancel=True)
+            return {"removed": names}
+        if cmd == "pause":
+            names = [name for name in names if name not in self.paused]
+            await self._stop_jobs(names, cancel=False, forget=False)
+            self.paused.update(names)
+            return {"paused": names}
+        if cmd == "resume":
+            names = [name for name in names if name in self.paused]
+            self.paused -= set(names)
+            await self._start_jobs([self.jobdefs[name] for name in names])
+            return {"resumed": names}
+
+    def status(self, args=()):
+        states = {name: self._state(name) for name in self.jobdefs}
+        counts = {}
+        for state in states.values():
+            counts[state] = counts.get(state, 0) + 1
+        status = {
+            "config": self.config,
+            "jobs": len(self.jobdefs),
+            "jobs_per_state": counts,
+            "max_jobs": self.limits_manager.max_jobs,
+            "max_nodes": self.limits_manager.max_nodes,
+            "jobs_submitted": self.limits_manager.jobs_submitted,
+            "reloaded_at": self.reloaded_at,
+        }
+        filters = _parse_filters(args)
+        if filters:
+            status["states"] = {name: state for name, state in states.items() if _matches(self.jobdefs[name], filters)}
+        return status
+
+    def set_limits(self, args):
+        limits = {}
+        for arg in args:
+            key, _, value = arg.partition("=")
+            if key not in ("max_jobs", "max_nodes"):
+                raise ControlError(f"Cannot set '{key}', expected max_jobs=N or max_nodes=N")
+            try:
+                limits[key] = int(value) if value not in ("", "none", "None") else None
+            except ValueError:
+                raise ControlError(f"Invalid value for {key}: '{value}'")
+        # admits the jobs waiting for a slot, if the limits were raised
+        self.limits_manager.update_limits(**limits)
+        return {"max_jobs": self.limits_manager.max_jobs, "max_nodes": self.limits_manager.max_nodes}
+
+    def _state(self, name):
+        if name in self.paused:
+            return JOB_PAUSED
+        return metrics.job_states.get(name, "starting")
+
+    def _is_selected(self, jobdef):
+        return jobdef.name not in self.removed and any(_matches(jobdef, filters) for filters in self.selections)
+
+    async def _start_jobs(self, jobdefs):
+        if not jobdefs:
+            return
+        self.unstarted.update(jobdef.name for jobdef in jobdefs)
+        # one call to the scheduler to find the SLURM jobs already launched for all of them
+        existing_job_ids = await self._reconcile(jobdefs)
+        for jobdef in jobdefs:
+            self.unstarted.discard(jobdef.name)
+            if jobdef.name in existing_job_ids:
+                self.tasks[jobdef.name] = asyncio.ensure_future(self.manager.manage(jobdef, existing_job_id=existing_job_ids[jobdef.name]))
+
+    async def _stop_jobs(self, names, cancel=False, forget=True):
+        """
+        Stop managing the jobs `names`, and cancel their SLURM jobs if `cancel`.
+        With `forget`, the jobs are also removed from the managed jobs.
+        Raises `SchedulerError` if the SLURM jobs cannot be cancelled, the jobs are then not forgotten.
+        """
+        tasks = [self.tasks.pop(name) for name in names if name in self.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        jobdefs = [self.jobdefs[name] for name in names if name in self.jobdefs]
+        for jobdef in jobdefs:
+            self.unstarted.discard(jobdef.name)
+            if self.manager.watcher:
+                self.manager.watcher.unwatch(jobdef.output_file)
+        if cancel and jobdefs:
+            existing_job_ids = await self._reconcile(jobdefs)
+            job_ids = [job_id for job_id in existing_job_ids.values() if job_id is not None]
+            if job_ids:
+                await self.manager.backend.cancel(job_ids)
+            for jobdef in jobdefs:
+                await self.limits_manager.job_finished(jobdef)
+        if forget:
+            for jobdef in jobdefs:
+                del self.jobdefs[jobdef.name]
+                self.paused.discard(jobdef.name)
+
+    async def _reconcile(self, jobdefs):
+        return await reconcile_jobs(jobdefs, self.manager.backend, max_attempts=self.reconcile_attempts, retry_secs=self.reconcile_retry_secs)
+
+    async def _reload_forever(self):
+        while True:
+            await asyncio.sleep(self.reload_interval_secs)
+            if self.unstarted or any(_mtime(path) != mtime for path, mtime in self.mtimes.items()):
+                try:
+                    await self.reload()
+                except Exception as ex:
+                    # e.g., invalid config file while it is being edited, keep the current jobs
+                    print(f"Cannot reload '{self.config}': {ex}")
+
+    async def _handle_client(self, reader, writer):
+        try:
+            line = await reader.readline()
+            try:
+                request = json.loads(line)
+                response = {"ok": True, "result": await self.execute(request["cmd"], request.get("args", []))}
+            except (ControlError, SchedulerError, ValueError) as ex:
+                response = {"ok": False, "error": str(ex)}
+            except Exception as ex:
+                # e.g., an invalid request or filter, the daemon keeps running and reports it to the client
+                response = {"ok": False, "error": f"{type(ex).__name__}: {ex}"}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def _check_socket(socket_path):
+    """
+    Raise `ControlError` if a daemon is already listening on `socket_path`, remove the socket left by a daemon that is not running anymore
+    """
+    try:
+        _, writer = await asyncio.open_unix_connection(socket_path)
+    except FileNotFoundError:
+        return
+    except ConnectionRefusedError:
+        # nobody is listening, e.g. the previous daemon was killed
+        os.remove(socket_path)
+        return
+    writer.close()
+    raise ControlError(f"A daemon is already listening on '{socket_path}', stop it first with `ctl stop`")
+
+
+async def send_command(socket_path, cmd, args=()):
+    """
+    Send the command `cmd` to the daemon listening on `socket_path`, returns its result or raises `ControlError`
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(json.dumps({"cmd": cmd, "args": list(args)}).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+    finally:
+        writer.close()
+    if not response["ok"]:
+        raise ControlError(response["error"])
+    return response["result"]
+
+
+def _parse_filters(args):
+    return dict(parse_param_filter(arg) for arg in args)
+
+
+def _matches(jobdef, filters):
+    return all(predicate(jobdef.params.get(key)) for key, predicate in filters.items())
+
+
+def _watched_paths(config, jobdefs):
+    paths = {config}
+    for jobdef in jobdefs:
+        template = jobdef.params.get("template")
+        if template:
+            paths.add(template)
+    return paths
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
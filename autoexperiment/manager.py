@@ -1,108 +1,1186 @@
+import codecs
+import cProfile
+import heapq
+import math
 import os
+import random
 import re
+import signal
 import sys
 import time
 
-from subprocess import call, check_output, DEVNULL, CalledProcessError
+from subprocess import DEVNULL, PIPE, CalledProcessError, TimeoutExpired
 from dataclasses import dataclass
 import asyncio
 
-cmd_check_job_in_queue = "squeue -j {job_id}"
-cmd_check_job_running = "squeue -j {job_id} -t R"
-cmd_check_job_id_by_name = "squeue --me -n '{job_name}' --format %i"
+from autoexperiment.backends import SchedulerError, SlurmBackend
+from autoexperiment.watcher import OutputWatcher
+from autoexperiment.conditions import ConditionEngine
+from autoexperiment.metrics import metrics
+from autoexperiment.store import (
+    JOB_WAITING, JOB_GAVE_UP, JOB_SUBMITTED, JOB_RESUMED, JOB_QUEUED,
+    JOB_RUNNING, JOB_FROZEN, JOB_GONE, JOB_FINISHED,
+)
+
+# state reported by squeue (%T) for jobs that are actually running
+JOB_STATE_RUNNING = "RUNNING"
+
+# outcomes of `watch_running_job`
+WATCH_DONE = "done"
+WATCH_FROZEN = "frozen"
+WATCH_RECHECK = "recheck"
+
+
+class CommandRunner:
+    """
+    Run shell commands (sbatch, squeue, scancel, start/termination conditions)
+    as asyncio subprocesses, so that a slow command does not block the monitoring
+    of the other jobs.
+
+    At most `max_concurrent` commands run at the same time, and commands
+    running for more than `timeout_secs` are killed (with all their children).
+    """
+    def __init__(self, max_concurrent=32, timeout_secs=None, verbose=0):
+        self.max_concurrent = max_concurrent
+        self.timeout_secs = timeout_secs
+        self.verbose = verbose
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run(self, cmd, timeout_secs=None):
+        """
+        Run `cmd` in a shell and return a tuple (returncode, stdout).
+        Raises `TimeoutExpired` if the command takes more than `timeout_secs`
+        (defaults to the timeout of the runner).
+        """
+        timeout_secs = timeout_secs if timeout_secs is not None else self.timeout_secs
+        stderr = sys.stderr if self.verbose >= 2 else DEVNULL
+        metrics.inc("commands_total")
+        async with self.semaphore:
+            # new session, so that we can kill the whole process group on timeout
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=PIPE, stderr=stderr, start_new_session=True)
+            try:
+                output, _ = await asyncio.wait_for(proc.communicate(), timeout_secs)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+                if isinstance(ex, asyncio.CancelledError):
+                    raise
+                metrics.inc("command_timeouts_total")
+                raise TimeoutExpired(cmd, timeout_secs)
+        return proc.returncode, output
+
+    async def check_output(self, cmd, timeout_secs=None):
+        """
+        Same as `subprocess.check_output(cmd, shell=True)`, i.e. raises `CalledProcessError`
+        if the return code is not 0, but without blocking the event loop.
+        """
+        returncode, output = await self.run(cmd, timeout_secs=timeout_secs)
+        if returncode != 0:
+            raise CalledProcessError(returncode, cmd, output=output)
+        return output
+
+    async def call(self, cmd, timeout_secs=None):
+        """
+        Same as `subprocess.call(cmd, shell=True)`, returns the return code.
+        """
+        returncode, _ = await self.run(cmd, timeout_secs=timeout_secs)
+        return returncode
+
+
+class LogWatcher:
+    """
+    Incremental view of the output file of a job.
+
+    The watcher remembers the byte offset it already scanned, so each call to `scan`
+    only reads the bytes appended since the previous call, instead of reading the whole
+    file. Termination strings are searched line by line (the last, incomplete, line is
+    kept and prepended to the next read), so `termination_str` should not span several lines.
+
+    Freeze detection relies on `progress`, i.e. (inode, size, mtime) of the file,
+    rather than on comparing the content of the file at two different times. The mtime is
+    set by the clock of the file server, so the age of the last write is measured with the
+    local time at which `progress` was last seen to change (see `progress_changed_at`).
+
+    The file is considered to be rotated/truncated (e.g., the job was restarted by
+    SLURM and the output file rewritten) if its inode changes, if it becomes smaller
+    than the scanned offset, or if its first bytes change. In that case, it is scanned
+    again from the beginning.
+    """
+
+    chunk_size = 1024 * 1024
+    head_size = 256
+    max_carry_size = 64 * 1024
+
+    def __init__(self, path, termination_str=""):
+        self.path = path
+        self.termination_re = re.compile(termination_str) if termination_str else None
+        # last value of `progress`, and local time at which it was first seen
+        self.last_progress = None
+        self.last_progress_at = None
+        self.reset()
+
+    def reset(self):
+        """Forget everything already scanned, the next `scan` starts from the beginning of the file"""
+        self.inode = None
+        self.offset = 0
+        # offset just after the last complete line
+        self.line_offset = 0
+        # first bytes of the file, used to detect if the file was rewritten
+        self.head = b""
+        # last incomplete line
+        self.carry = ""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.found = False
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def position(self):
+        """
+        Returns (inode, offset, head) describing what was already scanned, where offset
+        is the end of the last complete line, or None if nothing was scanned.
+        Can be used with `restore` to continue scanning later, e.g. in a new session.
+        """
+        if self.inode is None:
+            return None
+        return (self.inode, self.line_offset, self.head)
+
+    def restore(self, inode, offset, head):
+        """
+        Continue scanning from a position returned by `position`.
+        If the file was rotated in the meantime, it is scanned again from the beginning.
+        """
+        self.reset()
+        self.inode = inode
+        self.offset = self.line_offset = offset
+        self.head = head or b""
+
+    def progress(self):
+        """
+        Returns (inode, size, mtime) of the file, or None if it does not exist.
+        If two calls return the same value, the job did not write anything in between.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def progress_changed_at(self, progress, now=None):
+        """
+        Returns the local time at which the file was last seen to change, given its current `progress`
+        (the first time a value of `progress` is seen, `now`).
+        """
+        if progress != self.last_progress:
+            self.last_progress = progress
+            self.last_progress_at = time.time() if now is None else now
+        return self.last_progress_at
+
+    def scan(self):
+        """
+        Read the newly appended bytes, and returns True if `termination_str` was found
+        in the file.
+        """
+        if self.termination_re is None:
+            return False
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            st = os.fstat(f.fileno())
+            if self._is_rotated(f, st):
+                self.reset()
+            if self.found:
+                return True
+            if self.inode is None:
+                self.inode = st.st_ino
+            f.seek(self.offset)
+            while not self.found:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                if len(self.head) < self.head_size:
+                    self.head = (self.head + data)[:self.head_size]
+                newline = data.rfind(b"\n")
+                if newline >= 0:
+                    self.line_offset = self.offset + newline + 1
+                self.offset += len(data)
+                text = self.carry + self.decoder.decode(data)
+                if self.termination_re.search(text):
+                    self.found = True
+                # keep the last incomplete line for the next read
+                self.carry = text[text.rfind("\n") + 1:][-self.max_carry_size:]
+        return self.found
+
+    def _is_rotated(self, f, st):
+        if self.inode is None:
+            return False
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            return True
+        f.seek(0)
+        return f.read(len(self.head)) != self.head
+
+
+class QueuePoller:
+    """
+    Shared view of the SLURM queue.
+
+    Instead of having each job call `squeue` on its own, a single coroutine
+    (`poll_forever`) periodically fetches the state of all the jobs of the
+    user with one call to the scheduler backend (e.g., one `squeue` call), and stores it
+    in a job id -> state table.
+    `manage_job` then reads the state of its job from that snapshot, so that
+    the number of `squeue` calls per cycle does not depend on the number of jobs.
+    """
+    def __init__(self, backend, poll_interval_secs=60, verbose=0):
+        self.backend = backend
+        self.poll_interval_secs = poll_interval_secs
+        self.verbose = verbose
+        # job id (str) -> state (e.g., RUNNING, PENDING, COMPLETING)
+        self.states = {}
+        # job id (str) -> job name
+        self.names = {}
+        # job id (str) -> time of the last snapshot before the one where the job was first seen running
+        # (of the first snapshot, for jobs already running then)
+        self.started_after = {}
+        # time at which the last successful snapshot was requested
+        self.updated_at = None
+        self.condition = asyncio.Condition()
+
+    async def poll_forever(self):
+        """Refresh the snapshot every `poll_interval_secs`"""
+        while True:
+            await self.poll()
+            await asyncio.sleep(self.poll_interval_secs)
+
+    async def poll(self):
+        """Take a new snapshot of the queue, and wake up jobs waiting for it"""
+        started_at = time.time()
+        try:
+            with metrics.time("scheduler_call_seconds", op="query_many"):
+                self.states, self.names = await self.backend.query_many()
+        except SchedulerError as ex:
+            metrics.inc("scheduler_errors_total", op="query_many")
+            # keep the previous snapshot, jobs will wait for the next one
+            if self.verbose:
+                print(f"Error when fetching the state of the queue: {ex}")
+            return
+        previous_updated_at = self.updated_at
+        self.updated_at = started_at
+        started_after = {}
+        for job_id, state in self.states.items():
+            if state == JOB_STATE_RUNNING:
+                started_after[job_id] = self.started_after.get(job_id, previous_updated_at or started_at)
+        self.started_after = started_after
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def wait_for_snapshot(self, not_before=None):
+        """
+        Wait until a snapshot is available.
+        If `not_before` is provided, wait for a snapshot that was taken after `not_before`,
+        e.g. to make sure a newly submitted job is visible.
+        """
+        async with self.condition:
+            while self.updated_at is None or (not_before is not None and self.updated_at < not_before):
+                await self.condition.wait()
+
+    async def get_state(self, job_id, not_before=None):
+        """
+        Returns the state of the job `job_id` in the queue, or None if the job is not in the queue.
+        """
+        await self.wait_for_snapshot(not_before=not_before)
+        return self.states.get(str(job_id))
+
+    def get_started_after(self, job_id):
+        """
+        Returns a time before which the running job `job_id` did not start, or None if it is not running
+        """
+        return self.started_after.get(str(job_id))
+
+
+def _fail_futures(futures, ex):
+    """
+    Propagate the exception `ex` to the `futures` that are not done yet
+    """
+    for future in futures:
+        if future.done():
+            continue
+        if isinstance(ex, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(ex)
+
+
+class ArraySubmitter:
+    """
+    Submit the tasks of job arrays (see `autoexperiment.arrays`) in batches: the tasks of
+    the same array that need to be launched within `delay_secs` are submitted together with
+    a single `sbatch --array=...` call. Each task is then managed individually, with
+    its own job id (`<array job id>_<index>`).
+
+    `backend` is usually the `SubmissionGateway` of the manager, which rate limits and times the sbatch calls.
+    """
+    def __init__(self, backend, delay_secs=1, verbose=0):
+        self.backend = backend
+        self.delay_secs = delay_secs
+        self.verbose = verbose
+        # array script -> list of (index, future) waiting to be submitted
+        self.pending = {}
+
+    async def submit(self, task):
+        """
+        Submit the `ArrayTask` task, returns its job id, or None if the submission failed
+        """
+        future = asyncio.get_event_loop().create_future()
+        batch = self.pending.setdefault(task.script, [])
+        batch.append((task.index, future))
+        if len(batch) == 1:
+            asyncio.ensure_future(self._submit_batch(task.script))
+        return await future
+
+    async def _submit_batch(self, script):
+        batch = []
+        try:
+            try:
+                await asyncio.sleep(self.delay_secs)
+            finally:
+                batch = self.pending.pop(script)
+            try:
+                array_id = await self.backend.submit_array(script, [index for index, _ in batch])
+            except SchedulerError as ex:
+                metrics.inc("scheduler_errors_total", op="submit_array")
+                if self.verbose:
+                    print(f"Error when submitting array '{script}': {ex}")
+                array_id = None
+            if self.verbose and array_id is not None:
+                print(f"Submitted {len(batch)} task(s) of array '{script}' (ID:{array_id})")
+            for index, future in batch:
+                if not future.done():
+                    future.set_result(f"{array_id}_{index}" if array_id is not None else None)
+        except BaseException as ex:
+            # e.g. unexpected output of sbatch, the tasks waiting for the batch get the error instead of waiting forever
+            _fail_futures([future for _, future in batch], ex)
+            if isinstance(ex, asyncio.CancelledError):
+                raise
+
+
+# errors of sbatch after which submissions are paused (see `classify_submit_error`), other errors are specific to the job
+SUBMIT_ERROR_TRANSIENT = "transient"
+SUBMIT_ERROR_LIMIT = "limit"
+SUBMIT_ERROR_JOB = "job"
+
+# the controller is overloaded or unreachable, retrying soon is likely to succeed
+TRANSIENT_SUBMIT_ERROR_RE = re.compile(
+    r"socket timed out|timed out after|unable to contact slurm controller|temporarily unable to accept job"
+    r"|resource temporarily unavailable|connection refused|connection reset|transport endpoint|slurm_persist_conn",
+    re.IGNORECASE,
+)
+# a submit limit (QOS, association) is reached, submissions can only succeed once some jobs left the queue
+LIMIT_SUBMIT_ERROR_RE = re.compile(
+    r"MaxSubmitJob|MaxSubmitLimit|submit limit|too many jobs|job violates accounting/qos policy",
+    re.IGNORECASE,
+)
+
+
+def classify_submit_error(message):
+    """
+    Returns the class of an error of sbatch: `SUBMIT_ERROR_TRANSIENT` (controller timeout),
+    `SUBMIT_ERROR_LIMIT` (QOS or association submit limit) or `SUBMIT_ERROR_JOB` (e.g. invalid sbatch script)
+    """
+    if LIMIT_SUBMIT_ERROR_RE.search(message):
+        return SUBMIT_ERROR_LIMIT
+    if TRANSIENT_SUBMIT_ERROR_RE.search(message):
+        return SUBMIT_ERROR_TRANSIENT
+    return SUBMIT_ERROR_JOB
+
+
+class SubmissionGateway:
+    """
+    Submit and cancel the jobs managed in the same event loop, on behalf of the scheduler backend.
+
+    - Submissions are rate limited with a token bucket: at most `burst` submissions at once,
+    then `rate` submissions per sec (no limit if `rate` is None).
+    - When sbatch fails because the controller is unreachable or a submit limit is reached
+    (see `classify_submit_error`), all the submissions are paused, with an exponential backoff
+    (`backoff_secs` for the given class of error: initial delay, maximum delay) reset by the next
+    successful submission. The waiting submissions are spread randomly over the backoff delay,
+    so that they do not all retry at once. The failed submission is retried up to `max_attempts` times,
+    after which the error is raised. Other errors are raised immediately.
+    - Cancellations requested within `cancel_delay_secs` are done together, with a single call to
+    `backend.cancel` (i.e. `scancel id1 id2 ...`) for at most `max_cancel_batch` jobs.
+
+    The gateway has the interface of the backend for `submit`, `submit_array` and `cancel`.
+    """
+    BACKOFF_SECS = {
+        SUBMIT_ERROR_TRANSIENT: (5, 300),
+        SUBMIT_ERROR_LIMIT: (60, 900),
+    }
+
+    def __init__(self, backend, rate=None, burst=10, max_attempts=5, cancel_delay_secs=1, max_cancel_batch=500, backoff_secs=None, seed=None, verbose=0):
+        self.backend = backend
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_attempts = max_attempts
+        self.cancel_delay_secs = cancel_delay_secs
+        self.max_cancel_batch = max_cancel_batch
+        self.backoff_secs = dict(self.BACKOFF_SECS, **(backoff_secs or {}))
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.tokens = float(self.burst)
+        self.refilled_at = time.monotonic()
+        # waiting for a token is done in arrival order
+        self.lock = asyncio.Lock()
+        # consecutive failed submissions, start and end of the current pause
+        self.failures = 0
+        self.delay_secs = 0
+        self.backoff_at = 0.0
+        self.paused_until = 0.0
+        # list of (job id, future) waiting to be cancelled
+        self.pending_cancels = []
+
+    async def submit(self, job):
+        return await self._submit("submit", self.backend.submit, job)
+
+    async def submit_array(self, script, indices):
+        return await self._submit("submit_array", self.backend.submit_array, script, indices)
+
+    async def _submit(self, op, submit, *args):
+        attempt = 1
+        while True:
+            await self._wait_backoff()
+            await self._acquire_token()
+            started_at = time.monotonic()
+            try:
+                with metrics.time("scheduler_call_seconds", op=op):
+                    job_id = await submit(*args)
+            except SchedulerError as ex:
+                error_class = classify_submit_error(str(ex))
+                if error_class == SUBMIT_ERROR_JOB:
+                    raise
+                self._backoff(error_class, ex, started_at)
+                if attempt >= self.max_attempts:
+                    raise
+                attempt += 1
+                metrics.inc("submit_retries_total", error_class=error_class)
+                continue
+            self.failures = 0
+            return job_id
+
+    async def _wait_backoff(self):
+        while True:
+            now = time.monotonic()
+            if now >= self.paused_until:
+                return
+            # a new failure during the wait extends the pause, in which case we wait again
+            await asyncio.sleep(self.paused_until - now + self.random.uniform(0, self.delay_secs))
+            if time.monotonic() >= self.paused_until:
+                return
+
+    def _backoff(self, error_class, ex, started_at):
+        if started_at < self.backoff_at:
+            # the submissions in flight when the pause started fail for the same reason, the delay is not increased
+            return
+        self.failures += 1
+        initial_secs, max_secs = self.backoff_secs[error_class]
+        self.delay_secs = min(max_secs, initial_secs * 2 ** min(self.failures - 1, 30))
+        self.backoff_at = time.monotonic()
+        self.paused_until = self.backoff_at + self.delay_secs
+        metrics.inc("submit_backoffs_total", error_class=error_class)
+        if self.verbose:
+            print(f"sbatch failed ({error_class}: {ex}), pausing submissions for {self.delay_secs} secs")
+
+    async def _acquire_token(self):
+        if self.rate is None:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+                self.refilled_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def cancel(self, job_ids):
+        """
+        Cancel `job_ids` with the next batch of cancellations, raise `SchedulerError` if the batch failed
+        """
+        loop = asyncio.get_event_loop()
+        futures = []
+        for job_id in job_ids:
+            future = loop.create_future()
+            self.pending_cancels.append((job_id, future))
+            futures.append(future)
+            if len(self.pending_cancels) == 1:
+                asyncio.ensure_future(self._cancel_batch())
+        for future in futures:
+            await future
+
+    async def _cancel_batch(self):
+        pending = []
+        try:
+            try:
+                await asyncio.sleep(self.cancel_delay_secs)
+            finally:
+                pending, self.pending_cancels = self.pending_cancels, []
+            for start in range(0, len(pending), self.max_cancel_batch):
+                batch = pending[start:start + self.max_cancel_batch]
+                try:
+                    with metrics.time("scheduler_call_seconds", op="cancel"):
+                        await self.backend.cancel([job_id for job_id, _ in batch])
+                except SchedulerError as ex:
+                    _fail_futures([future for _, future in batch], ex)
+                    continue
+                if self.verbose and len(batch) > 1:
+                    print(f"Cancelled {len(batch)} job(s) with a single scancel")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+        except BaseException as ex:
+            # e.g. scancel cannot be run, the jobs waiting for the cancellation get the error instead of waiting forever
+            _fail_futures([future for _, future in pending], ex)
+            if isinstance(ex, asyncio.CancelledError):
+                raise
 
 
 class JobLimitsManager:
-    def __init__(self, max_jobs=None):
+    """
+    Admission control of the jobs submitted to SLURM.
+
+    A job waits in `wait_for_slot` until it can be submitted without exceeding:
+    - `max_jobs`, the total number of jobs submitted to SLURM (any state),
+    - `max_nodes`, the total number of nodes of the submitted jobs (`nodes` param of each job, 1 by default),
+    - `group_quotas`, the number of submitted jobs of each group, where the group of a job is
+    the value of its param `group_by` (e.g., `mode`), e.g. {"train": 10, "eval": 5}.
+
+    Waiting jobs are admitted by decreasing `priority` (param of the job), then with fair share,
+    i.e. the group using the fewest nodes goes first, then in arrival order. Only the jobs that can
+    be admitted are woken up. A job blocked by its group quota does not block the jobs of other groups,
+    but a job blocked by `max_jobs` or `max_nodes` blocks the jobs after it, so that jobs using many nodes
+    are not starved by smaller ones.
+
+    Resources are reserved when a job is admitted, and released with `job_finished`.
+    """
+    def __init__(self, max_jobs=None, max_nodes=None, group_by=None, group_quotas=None):
         self.max_jobs = max_jobs
-        self.lock = asyncio.Lock()
-        self.condition = asyncio.Condition(self.lock)
-        
-        # Single counter: total jobs submitted to SLURM (any state)
+        self.max_nodes = max_nodes
+        self.group_by = group_by
+        self.group_quotas = group_quotas or {}
+
+        # Total jobs submitted to SLURM (any state) and their nodes
         self.jobs_submitted = 0
-        
-    async def wait_for_slot(self):
-        """Wait until we can submit a new job to SLURM"""
-        if not self.max_jobs:
-            return  # No limit set
-            
-        async with self.condition:
-            while self.jobs_submitted >= self.max_jobs:
-                await self.condition.wait()
-    
-    async def job_submitted(self):
-        """Called when we successfully submit a job to SLURM"""
-        async with self.condition:
-            self.jobs_submitted += 1
-    
-    async def job_finished(self):
-        """Called when job is completely done and removed from SLURM"""
-        async with self.condition:
-            if self.jobs_submitted > 0:
-                self.jobs_submitted -= 1
-            self.condition.notify_all()  # Wake waiting jobs
+        self.nodes_submitted = 0
+        # job name -> (nodes, group) of the admitted/submitted jobs
+        self.admitted = {}
+        # group -> (number of jobs, number of nodes) submitted
+        self.groups = {}
+        # group -> heap of (-priority, seq, nodes, job, future) of the waiting jobs of the group.
+        # Priority, nodes and group are read once, when the job starts waiting (the params of
+        # compact job definitions are built at each access).
+        self.waiters = {}
+        self.seq = 0
+        # whether the first waiting job is blocked by `max_jobs` or `max_nodes`
+        self.blocked = False
+
+    async def wait_for_slot(self, job=None):
+        """Wait until we can submit `job` to SLURM, and reserve its resources"""
+        if job is not None and job.name in self.admitted:
+            return
+        nodes, group = _get_nodes(job), self._get_group(job)
+        if not self.blocked and self._fits(nodes, group):
+            self._admit(job, nodes, group)
+            return
+        future = asyncio.get_event_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.waiters.setdefault(group, []), (-_get_priority(job), self.seq, nodes, job, future))
+        if self._fits_group(group):
+            # blocked by `max_jobs` or `max_nodes`, the jobs arriving next wait for it
+            self.blocked = True
+        try:
+            await future
+        except asyncio.CancelledError:
+            # a cancelled waiter is dropped when it reaches the head of its heap (see `_dispatch`)
+            if future.done() and not future.cancelled():
+                # admitted in the meantime
+                await self.job_finished(job)
+            raise
+
+    async def job_submitted(self, job=None):
+        """Called when we successfully submit a job to SLURM, or find one already submitted"""
+        if job is None or job.name not in self.admitted:
+            self._admit(job, _get_nodes(job), self._get_group(job))
+
+    async def job_finished(self, job=None):
+        """Called when job is completely done and removed from SLURM, or could not be submitted"""
+        if job is not None:
+            if job.name not in self.admitted:
+                return
+            nodes, group = self.admitted.pop(job.name)
+        else:
+            nodes, group = 1, None
+        if self.jobs_submitted > 0:
+            self.jobs_submitted -= 1
+        self.nodes_submitted = max(self.nodes_submitted - nodes, 0)
+        nb_jobs, nb_nodes = self.groups.get(group, (1, nodes))
+        self.groups[group] = (max(nb_jobs - 1, 0), max(nb_nodes - nodes, 0))
+        self._dispatch()
+
+    def update_limits(self, **limits):
+        """
+        Change `max_jobs`, `max_nodes` or `group_quotas`, e.g. `update_limits(max_jobs=100)`,
+        and admit the waiting jobs that fit the new limits
+        """
+        for key, value in limits.items():
+            if key not in ("max_jobs", "max_nodes", "group_quotas"):
+                raise ValueError(f"Unknown limit '{key}', expected max_jobs, max_nodes or group_quotas")
+            if key == "group_quotas":
+                value = value or {}
+            setattr(self, key, value)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Admit waiting jobs, in order, as long as they fit"""
+        self.blocked = False
+        while True:
+            # the next job is the first waiting job of one of the groups within their quota
+            best = None
+            for group, heap in list(self.waiters.items()):
+                # waiters cancelled in the meantime (e.g. jobs paused or removed), whose cancellation is not handled yet
+                while heap and heap[0][4].done():
+                    heapq.heappop(heap)
+                if not heap:
+                    del self.waiters[group]
+                    continue
+                if not self._fits_group(group):
+                    continue
+                neg_priority, seq = heap[0][:2]
+                # fair share: the group using the fewest nodes goes first
+                _, nb_nodes = self.groups.get(group, (0, 0))
+                key = (neg_priority, nb_nodes, seq)
+                if best is None or key < best[0]:
+                    best = (key, group)
+            if best is None:
+                return
+            _, group = best
+            heap = self.waiters[group]
+            _, _, nodes, job, future = heap[0]
+            if not self._fits_total(nodes):
+                self.blocked = True
+                return
+            heapq.heappop(heap)
+            self._admit(job, nodes, group)
+            future.set_result(None)
 
-def manage_jobs_forever(jobs, max_jobs:int=None, verbose=0):
+    def _fits(self, nodes, group):
+        return self._fits_total(nodes) and self._fits_group(group)
+
+    def _fits_total(self, nodes):
+        if self.max_jobs and self.jobs_submitted >= self.max_jobs:
+            return False
+        # a job larger than `max_nodes` is admitted alone
+        if self.max_nodes and self.nodes_submitted > 0 and self.nodes_submitted + nodes > self.max_nodes:
+            return False
+        return True
+
+    def _fits_group(self, group):
+        quota = self.group_quotas.get(str(group))
+        if quota is None:
+            return True
+        nb_jobs, _ = self.groups.get(group, (0, 0))
+        return nb_jobs < quota
+
+    def _admit(self, job, nodes, group):
+        if job is not None:
+            self.admitted[job.name] = (nodes, group)
+        self.jobs_submitted += 1
+        self.nodes_submitted += nodes
+        nb_jobs, nb_nodes = self.groups.get(group, (0, 0))
+        self.groups[group] = (nb_jobs + 1, nb_nodes + nodes)
+
+    def _get_group(self, job):
+        if job is None or self.group_by is None:
+            return None
+        return job.params.get(self.group_by)
+
+
+def _get_nodes(job):
+    try:
+        return max(int(job.params.get("nodes", 1)), 1)
+    except (AttributeError, TypeError, ValueError):
+        return 1
+
+def _get_priority(job):
+    try:
+        return float(getattr(job, "priority", 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+class CheckPolicy:
+    """
+    Delay between two checks of a job, instead of always waiting `check_interval_secs`:
+    - jobs pending in the queue are checked `pending_factor` times less often,
+    - running jobs steadily writing to their output file are checked `running_factor` times less often,
+      but a frozen job is still detected at most 2 * `check_interval_secs` after its last write, as with fixed checks,
+    - jobs are checked `launch_factor` times as often during the `check_interval_secs` following their submission
+      or their start, and near their time limit (`#SBATCH --time`, see `get_time_limit_secs`),
+      so that early failures and timeouts are detected quickly.
+    Each delay is multiplied by a random factor in [1 - `jitter`, 1 + `jitter`], so that the checks of jobs
+    launched at the same time spread over the interval instead of all happening at once.
+    With all the factors set to 1, the checks are only jittered (see `fixed`).
+    Wake-up times are rounded to `resolution_secs`, so that the jobs waking up at about the same time
+    are handled in a single iteration of the event loop.
+
+    Since checks are not evenly spaced anymore, running jobs are considered frozen when the last write
+    to their output file is older than `check_interval_secs`, rather than by comparing the file between two checks.
+    """
+    def __init__(self, pending_factor=2, running_factor=2, launch_factor=0.25, jitter=0.2, min_secs=1, resolution_secs=0.1, seed=None):
+        self.pending_factor = pending_factor
+        self.running_factor = running_factor
+        self.launch_factor = launch_factor
+        self.jitter = jitter
+        self.min_secs = min_secs
+        self.resolution_secs = resolution_secs
+        self.random = random.Random(seed)
+
+    @classmethod
+    def fixed(cls, jitter=0.2, seed=None):
+        return cls(pending_factor=1, running_factor=1, launch_factor=1, jitter=jitter, seed=seed)
+
+    def jittered(self, secs):
+        return self._align(max(secs * self.random.uniform(1 - self.jitter, 1 + self.jitter), self.min_secs))
+
+    def next_check_secs(self, interval_secs, state, submitted_at, running_since=None, started_after=None, freeze_at=None, time_limit_secs=None):
+        """
+        Returns the number of secs to wait before checking again a job in the state `state` (in the queue),
+        submitted at `submitted_at`, seen running since `running_since`, and which did not start before `started_after`.
+        `freeze_at` is the time at which the running job would be considered frozen, if any.
+        """
+        now = time.time()
+        fast_secs = interval_secs * self.launch_factor
+        if state == JOB_STATE_RUNNING and running_since is not None:
+            secs = interval_secs * self.running_factor
+            if now - running_since < interval_secs:
+                secs = fast_secs
+            if time_limit_secs:
+                # check often from `interval_secs` before the earliest time at which the job can reach its time limit
+                near_limit_at = (started_after or running_since) + time_limit_secs - interval_secs
+                secs = fast_secs if now >= near_limit_at else min(secs, near_limit_at - now)
+        else:
+            secs = interval_secs * self.pending_factor
+            if now - submitted_at < interval_secs:
+                secs = fast_secs
+        secs = self.jittered(secs)
+        if freeze_at is not None:
+            # comparing the output file every `interval_secs` detects a frozen job at most
+            # 2 * `interval_secs` after its last write, do not do worse
+            secs = min(secs, self._align(max(freeze_at + interval_secs - now, self.min_secs)))
+        return secs
+
+    def _align(self, secs):
+        if not self.resolution_secs:
+            return secs
+        # `asyncio.sleep` uses the clock of the event loop
+        now = asyncio.get_event_loop().time()
+        return math.ceil((now + secs) / self.resolution_secs) * self.resolution_secs - now
+
+
+_TIME_LIMIT_RE = re.compile(r"^#SBATCH\s+(?:--time[=\s]|-t\s*)\s*(\S+)", re.MULTILINE)
+
+def get_time_limit_secs(job):
+    """
+    Returns the time limit of the job in secs, as given by `#SBATCH --time` in its sbatch script, or None
+    """
+    try:
+        with open(job.sbatch_script, errors="ignore") as f:
+            match = _TIME_LIMIT_RE.search(f.read())
+    except (OSError, TypeError):
+        return None
+    return parse_slurm_time(match.group(1)) if match else None
+
+def parse_slurm_time(value):
+    """
+    Parse a SLURM time limit ("minutes", "minutes:seconds", "hours:minutes:seconds", "days-hours",
+    "days-hours:minutes" or "days-hours:minutes:seconds"), returns secs or None if unlimited or invalid
+    """
+    try:
+        if "-" in value:
+            days, value = value.split("-", 1)
+            parts = [int(p) for p in value.split(":")]
+            # with days, the first field is the number of hours
+            parts += [0] * (3 - len(parts))
+            hours, minutes, secs = parts
+            return ((int(days) * 24 + hours) * 60 + minutes) * 60 + secs
+        parts = [int(p) for p in value.split(":")]
+    except ValueError:
+        return None
+    if len(parts) == 1:
+        return parts[0] * 60
+    if len(parts) == 2:
+        return parts[0] * 60 + parts[1]
+    if len(parts) == 3:
+        return (parts[0] * 60 + parts[1]) * 60 + parts[2]
+    return None
+
+
+def manage_jobs_forever(jobs, max_jobs:int=None, queue_poll_secs:int=60, max_concurrent_cmds:int=32, cmd_timeout_secs:int=600, store=None, array_delay_secs=1, backend=None, watch=False, watch_poll_secs=5, condition_ttl_secs=60, max_nodes=None, group_by=None, group_quotas=None, metrics_port=None, metrics_file=None, metrics_interval_secs=30, profile=None, adaptive_checks=False, check_jitter=None, submit_rate=None, submit_burst=10, cancel_delay_secs=1, workers=1, verbose=0):
     """
     Manage a list of jobs forever, relaunching them if they are frozen or not running anymore.
+
+    :param queue_poll_secs: secs between two snapshots of the SLURM queue
+    :param max_concurrent_cmds: maximum number of shell commands (sbatch, squeue, conditions, etc.) running at the same time
+    :param cmd_timeout_secs: shell commands running for longer than that are killed
+    :param store: optional `StateStore`, used to skip the jobs known to be finished and to resume the others
+    :param array_delay_secs: tasks of the same job array launched within that delay are submitted together
+    :param backend: `SchedulerBackend` used to submit, query and cancel jobs, defaults to `SlurmBackend`
+    :param watch: watch the output files of the running jobs for changes (see `OutputWatcher`), so that
+    termination strings and frozen jobs are detected without waiting for the next check interval
+    :param watch_poll_secs: when watching, secs between two polls of the output files (for filesystems without change events)
+    :param condition_ttl_secs: results of start/termination conditions are cached for that many secs (see `ConditionEngine`)
+    :param max_nodes: maximum total number of nodes of the jobs in the SLURM queue (see `JobLimitsManager`)
+    :param group_by: param used to group jobs, for `group_quotas` and fair share between groups
+    :param group_quotas: dict mapping the value of the param `group_by` to the maximum number of jobs of that group in the queue
+    :param metrics_port: serve the metrics of the manager (see `autoexperiment.metrics`) on this port, in the Prometheus text format
+    :param metrics_file: write the metrics of the manager as JSON to this file, every `metrics_interval_secs`
+    :param profile: profile the manager with cProfile, and dump the stats to this file on exit
+    :param adaptive_checks: adapt the delay between two checks of each job to its state (see `CheckPolicy`)
+    :param check_jitter: delays between two checks are randomly scaled by up to +/- this fraction (defaults to 0.2 with `adaptive_checks`, 0 otherwise)
+    :param submit_rate: maximum number of sbatch calls per sec, after `submit_burst` calls at once (see `SubmissionGateway`), no limit if None
+    :param submit_burst: maximum number of sbatch calls at once, with `submit_rate`
+    :param cancel_delay_secs: frozen jobs cancelled within that delay are cancelled together, with a single scancel call
+    :param workers: number of worker processes managing the jobs, split by a hash of their name (see `autoexperiment.sharding`)
     """
-    limits_manager = JobLimitsManager(max_jobs) if max_jobs is not None else None
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        _run_manager(
+            jobs, max_jobs=max_jobs, queue_poll_secs=queue_poll_secs,
+            max_concurrent_cmds=max_concurrent_cmds, cmd_timeout_secs=cmd_timeout_secs, store=store,
+            array_delay_secs=array_delay_secs, backend=backend, watch=watch, watch_poll_secs=watch_poll_secs,
+            condition_ttl_secs=condition_ttl_secs, max_nodes=max_nodes, group_by=group_by, group_quotas=group_quotas,
+            metrics_port=metrics_port, metrics_file=metrics_file, metrics_interval_secs=metrics_interval_secs,
+            adaptive_checks=adaptive_checks, check_jitter=check_jitter, submit_rate=submit_rate, submit_burst=submit_burst,
+            cancel_delay_secs=cancel_delay_secs, workers=workers, profile=profile, verbose=verbose,
+        )
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            print(f"Profile written to '{profile}'")
+        if metrics_file:
+            metrics.write_json(metrics_file)
+
+
+def _run_manager(jobs, workers=1, metrics_port=None, metrics_file=None, metrics_interval_secs=30, **kwargs):
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.gather(*[
-        manage_job(job, limits_manager, verbose=verbose) for job in jobs
-    ]))
+    tasks = [loop.create_task(metrics.monitor_loop_lag())]
+    if metrics_file:
+        tasks.append(loop.create_task(metrics.write_json_forever(metrics_file, metrics_interval_secs)))
+    server = None
+    if metrics_port:
+        server = loop.run_until_complete(metrics.serve(metrics_port))
+        print(f"Serving metrics on http://127.0.0.1:{metrics_port}/metrics")
+    if workers > 1:
+        from autoexperiment.sharding import coordinate_shards
+        main = coordinate_shards(jobs, workers, **kwargs)
+    else:
+        kwargs.pop("profile", None)
+        main = _manage_jobs(jobs, **kwargs)
+    try:
+        loop.run_until_complete(main)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if server:
+            server.close()
+
+
+async def _manage_jobs(jobs, store=None, existing_job_ids=None, **kwargs):
+    """
+    Manage `jobs` in the current event loop, see `manage_jobs_forever` and `Manager` for the arguments.
+
+    `existing_job_ids` (see `reconcile_jobs`) can be provided, e.g. by a worker of the sharded manager
+    (see `autoexperiment.sharding`), instead of looking for the existing jobs here.
+    """
+    jobs, records = skip_finished_jobs(jobs, store)
+    manager = Manager(store=store, records=records, **kwargs)
+    manager.start()
+    try:
+        if existing_job_ids is None:
+            existing_job_ids = await reconcile_jobs(jobs, manager.backend)
+        await asyncio.gather(*[
+            manager.manage(job, existing_job_id=existing_job_ids[job.name])
+            for job in jobs if job.name in existing_job_ids
+        ])
+    finally:
+        manager.close()
+
+
+class Manager:
+    """
+    State shared by the jobs managed in the same event loop (see `manage_job`): command runner, scheduler backend,
+    submission gateway, snapshots of the queue, limits, conditions, output file watcher and check policy.
+
+    The arguments are the ones of `manage_jobs_forever`. `records` are the records of the jobs in `store`.
+    `queue` (with the interface of `QueuePoller`) and `limits_manager` (with the interface of `JobLimitsManager`)
+    can be provided instead of polling the queue and enforcing the limits here, e.g. by a worker of the sharded manager.
+    """
+    def __init__(self, max_jobs=None, queue_poll_secs=60, max_concurrent_cmds=32, cmd_timeout_secs=600, store=None, records=None, array_delay_secs=1, backend=None, watch=False, watch_poll_secs=5, condition_ttl_secs=60, max_nodes=None, group_by=None, group_quotas=None, adaptive_checks=False, check_jitter=None, submit_rate=None, submit_burst=10, cancel_delay_secs=1, queue=None, limits_manager=None, verbose=0):
+        if limits_manager is None and (max_jobs is not None or max_nodes is not None or group_quotas):
+            limits_manager = JobLimitsManager(max_jobs, max_nodes=max_nodes, group_by=group_by, group_quotas=group_quotas)
+        self.limits_manager = limits_manager
+        self.store = store
+        self.records = records or {}
+        self.verbose = verbose
+        self.runner = CommandRunner(max_concurrent_cmds, timeout_secs=cmd_timeout_secs, verbose=verbose)
+        self.backend = backend or SlurmBackend(self.runner)
+        self.conditions = ConditionEngine(self.runner, ttl_secs=condition_ttl_secs, max_workers=max_concurrent_cmds, verbose=verbose)
+        self.own_queue = queue is None
+        self.queue = queue or QueuePoller(self.backend, queue_poll_secs, verbose=verbose)
+        self.gateway = SubmissionGateway(self.backend, rate=submit_rate, burst=submit_burst, cancel_delay_secs=cancel_delay_secs, verbose=verbose)
+        self.array_submitter = ArraySubmitter(self.gateway, delay_secs=array_delay_secs, verbose=verbose)
+        self.check_policy = None
+        if adaptive_checks:
+            self.check_policy = CheckPolicy() if check_jitter is None else CheckPolicy(jitter=check_jitter)
+        elif check_jitter:
+            self.check_policy = CheckPolicy.fixed(jitter=check_jitter)
+        self.watcher = OutputWatcher(poll_interval_secs=watch_poll_secs, verbose=verbose) if watch else None
+        self.poller = None
+        self.flusher = None
+
+    def start(self):
+        """
+        Start polling the queue, watching the output files and writing the store, must be called from the event loop
+        """
+        if self.own_queue:
+            self.poller = asyncio.ensure_future(self.queue.poll_forever())
+        if self.watcher:
+            self.watcher.start()
+        if self.store:
+            self.flusher = asyncio.ensure_future(self.store.flush_forever())
+
+    def close(self):
+        if self.poller:
+            self.poller.cancel()
+        self.conditions.close()
+        if self.watcher:
+            self.watcher.stop()
+        if self.flusher:
+            self.flusher.cancel()
+            self.store.flush()
+
+    def manage(self, job, existing_job_id=None):
+        """
+        Returns the coroutine managing `job` (see `manage_job`)
+        """
+        # the record of a job is only valid for the first time it is managed
+        record = self.records.pop(job.name, None)
+        return manage_job(
+            job, self.runner, self.limits_manager, queue=self.queue, backend=self.backend, existing_job_id=existing_job_id,
+            store=self.store, record=record, array_submitter=self.array_submitter, watcher=self.watcher,
+            conditions=self.conditions, check_policy=self.check_policy, gateway=self.gateway, verbose=self.verbose,
+        )
+
+
+def skip_finished_jobs(jobs, store):
+    """
+    Returns the jobs that are not known to be finished according to `store` (if any),
+    and the records of the jobs in the store.
+
+    A record only applies to a job whose sbatch script did not change since it was recorded (same digest):
+    the records of the other jobs are ignored, they are checked again from scratch.
+    """
+    records = store.load() if store else {}
+    stale = {
+        job.name for job in jobs
+        if job.name in records and job.script_digest is not None and records[job.name].digest != job.script_digest
+    }
+    if stale:
+        print(f"Ignoring the records of {len(stale)} job(s) whose sbatch script changed")
+        records = {name: record for name, record in records.items() if name not in stale}
+    finished = [job for job in jobs if job.name in records and records[job.name].state == JOB_FINISHED]
+    if finished:
+        print(f"Skipping {len(finished)} job(s) already finished according to '{store.path}'")
+        jobs = [job for job in jobs if job.name not in records or records[job.name].state != JOB_FINISHED]
+    return jobs, records
 
 
-async def manage_job(job, limits_manager=None, verbose=0):
+async def reconcile_jobs(jobs, backend, max_attempts=None, retry_secs=10):
+    """
+    Find, with a single call to the scheduler, the SLURM jobs that were already
+    launched (e.g., by a previous autoexperiment session) for each job, based on the job names
+    (or the name of the array and the index of the task, for tasks of job arrays).
+
+    Returns a dict mapping the name of each job to its existing job id (or None if the job is
+    not in the queue). Jobs with duplicate names in the queue are reported and excluded from the dict.
+
+    If the scheduler cannot be reached, the call is retried every `retry_secs`, at most `max_attempts`
+    times (forever if None), after which `SchedulerError` is raised.
+    """
+    names = set()
+    for job in jobs:
+        array_task = getattr(job, "array_task", None)
+        names.add(array_task.name if array_task else job.name)
+    attempt = 1
+    while True:
+        try:
+            with metrics.time("scheduler_call_seconds", op="lookup_by_name"):
+                job_ids_by_name = await backend.lookup_by_name(names)
+            break
+        except SchedulerError as ex:
+            metrics.inc("scheduler_errors_total", op="lookup_by_name")
+            if max_attempts is not None and attempt >= max_attempts:
+                raise
+            attempt += 1
+            print(f"Error when looking for existing jobs in the queue, retrying: {ex}")
+            await asyncio.sleep(retry_secs)
+    existing_job_ids = {}
+    for job in jobs:
+        array_task = getattr(job, "array_task", None)
+        if array_task:
+            # tasks of job arrays share the name of the array, find them based on their index
+            job_ids = [job_id for job_id in job_ids_by_name.get(array_task.name, []) if job_id.endswith(f"_{array_task.index}")]
+        else:
+            job_ids = job_ids_by_name.get(job.name, [])
+        if len(job_ids) == 0:
+            existing_job_ids[job.name] = None
+        elif len(job_ids) == 1:
+            # only extract job id if there are no duplicate names
+            existing_job_ids[job.name] = job_ids[0]
+        else:
+            # more than one job found with same name, e.g. another autoexperiment session uses the same names:
+            # the job is not managed, rather than adopting the SLURM job of another session or submitting one more
+            print(
+                f"Found duplicate jobs with same name: '{job.name}': {job_ids}, the job is not managed. "
+                "Please make sure the names of the jobs are unique, in your YAML config and across autoexperiment sessions."
+            )
+    return existing_job_ids
+
+
+async def manage_job(job, runner, limits_manager=None, queue=None, backend=None, existing_job_id=None, store=None, record=None, array_submitter=None, watcher=None, conditions=None, check_policy=None, gateway=None, verbose=0):
     """
     Manage a single job, relaunching it if it is frozen or not running anymore.
+
+    `existing_job_id` is the id of a SLURM job already launched for this job (see `reconcile_jobs`),
+    which is resumed instead of launching a new one.
+
+    If a `store` is provided, the state transitions of the job are recorded in it,
+    and `record` is the state of the job recorded in a previous session, if any.
+
+    If the job is a task of a job array (`job.array_task`, see `autoexperiment.arrays`),
+    it is submitted through `array_submitter` instead of `backend.submit`.
+
+    If a `watcher` (`OutputWatcher`) is provided, the output file of the running job is watched
+    for changes (see `watch_running_job`) instead of being compared every `check_interval_secs`.
+
+    Start and termination conditions are evaluated with `conditions` (`ConditionEngine`),
+    which can be shared between jobs to deduplicate and cache identical commands.
+
+    If a `check_policy` (`CheckPolicy`) is provided, the delay between two checks of the job
+    depends on its state, instead of being `check_interval_secs`.
+
+    If a `gateway` (`SubmissionGateway`) is provided, the job is submitted and cancelled through it
+    (rate limit, backoff after sbatch errors, batched scancel) instead of calling `backend` directly.
     """
-    cmd = job.cmd
+    array_task = getattr(job, "array_task", None)
     output_file = job.output_file
+    log_watcher = LogWatcher(output_file, termination_str=job.termination_str)
     check_interval_secs = job.check_interval_secs
     start_condition_cmd = job.start_condition_cmd
-    termination_str = job.termination_str
     termination_cmd = job.termination_cmd
-    stderr = sys.stderr if verbose >= 2 else DEVNULL
-
-    # Get job id from the queue based on the name
-    data = check_output(cmd_check_job_id_by_name.format(job_name=job.name), shell=True, stderr=stderr).decode()
-    job_ids = [line for line in data.split("\n") if re.match('[0-9]+', line)]
-
-    if len(job_ids) == 0:
-        existing_job_id = None
-    elif len(job_ids) == 1:
-        # only extract job id if there are no duplicate names
-        existing_job_id = int(job_ids[0])
-    else: 
-        # more than one job found with same name
-        # TODO can fail if different autoexp sessions use same names, one must ensure that it is not the case!
-        print(f"Found duplicate jobs with same name: '{job.name}': {job_ids}. Please fix your YAML config to have only unique names.")
-        return
+    if conditions is None:
+        conditions = ConditionEngine(runner, verbose=verbose)
+    time_limit_secs = get_time_limit_secs(job) if check_policy else None
+
+    def wait_secs():
+        # delay before retrying to start the job
+        return check_policy.jittered(check_interval_secs) if check_policy else check_interval_secs
+
     attempts = 0
+    restarts = 0
+    # whether a SLURM job was already launched for this job, in this session or a previous one
+    launched = False
+    if record is not None:
+        attempts = record.attempts or 0
+        restarts = record.restarts or 0
+        launched = record.job_id is not None
+        if record.log_offset is not None:
+            # continue scanning the output file where the previous session stopped
+            log_watcher.restore(record.log_inode, record.log_offset, record.log_head)
+
+    def update_store(state, job_id=None):
+        metrics.set_job_state(job.name, state)
+        if not store or job.dry:
+            return
+        store.record(job.name, state, job_id=job_id, attempts=attempts, restarts=restarts, digest=job.script_digest)
+        position = log_watcher.position()
+        if position is not None:
+            store.record_log_position(job.name, *position)
+
+    def set_finished(job_id):
+        update_store(JOB_FINISHED, job_id)
+        if watcher:
+            watcher.unwatch(output_file)
+        print(f"Job '{job.name}' is finished")
+
+    async def cancel_job(job_id):
+        # cancel a frozen job, it is relaunched afterwards
+        try:
+            if gateway:
+                await gateway.cancel([job_id])
+            else:
+                with metrics.time("scheduler_call_seconds", op="cancel"):
+                    await backend.cancel([job_id])
+        except SchedulerError as ex:
+            metrics.inc("scheduler_errors_total", op="cancel")
+            if verbose:
+                print(f"Error when cancelling {job.name} (ID:{job_id}): {ex}")
+        metrics.inc("job_freezes_total")
+        update_store(JOB_FROZEN, job_id)
+        if limits_manager:
+            await limits_manager.job_finished(job)
+
+    if watcher:
+        watcher.watch(output_file)
     job_id = None
     while True:
-        if check_if_done(output_file, termination_str=termination_str, termination_cmd=termination_cmd, verbose=verbose):
+        if await check_if_done(log_watcher, conditions, termination_cmd=termination_cmd, verbose=verbose):
             if limits_manager and job_id is not None:
-                await limits_manager.job_finished()
-            print(f"Job '{job.name}' is finished")
+                await limits_manager.job_finished(job)
+            set_finished(job_id)
             return
         if start_condition_cmd:
             # if start condition is provided, check it first by running it in a shell
+            # (or in python for built-in conditions, see `autoexperiment.conditions`)
             # if it outputs 0 (false), do not start the job and wait and check again, 
             # otherwise, start the job
             if verbose:
                 print(f"Checking start condition of {job.name}...")
-            value = int(check_output(start_condition_cmd, shell=True, stderr=stderr))
+            try:
+                value = await conditions.evaluate(start_condition_cmd)
+            except (CalledProcessError, TimeoutExpired, ValueError) as ex:
+                # a failing start condition is considered as not satisfied
+                if verbose:
+                    print(f"Error when checking start condition of {job.name}: {ex}")
+                value = None
             if value != 1:
                 attempts += 1
                 if attempts >= job.max_start_attempts:
                     if verbose:
                         print(f"Max number of attempts achieved, will not try again to start the job.")
+                    update_store(JOB_GAVE_UP)
                     return
+                update_store(JOB_WAITING)
                 if verbose:
                     print(f"Start condition returned {value}, not starting for {job.name}, retrying again in {check_interval_secs//60} mins.")
-                await asyncio.sleep(check_interval_secs)
+                await asyncio.sleep(wait_secs())
                 continue
 
         if existing_job_id is not None:
@@ -110,14 +1188,16 @@ async def manage_job(job, limits_manager=None, verbose=0):
                 print(f"Resume {job.name} from job id: {existing_job_id}")
             job_id = existing_job_id
             existing_job_id = None
+            launched = True
+            update_store(JOB_RESUMED, job_id)
             
             # Count existing job toward our limits
             if limits_manager:
-                await limits_manager.job_submitted()
+                await limits_manager.job_submitted(job)
         else:
             # Wait for job slot before launching
             if limits_manager:
-                await limits_manager.wait_for_slot()
+                await limits_manager.wait_for_slot(job)
                 if verbose:
                     print(f"Slot available, launching job for {job.name}")
             # launch job
@@ -126,105 +1206,197 @@ async def manage_job(job, limits_manager=None, verbose=0):
                     print(f"Launching a new job for {job.name}")
                 if job.dry:
                     print(job.params["name"])
+                    if limits_manager:
+                        await limits_manager.job_finished(job)
                     return
-                output = check_output(cmd, shell=True, stderr=stderr).decode()
-                # get job id
-                job_id = get_job_id(output)
+                if array_task:
+                    job_id = await array_submitter.submit(array_task)
+                elif gateway:
+                    job_id = await gateway.submit(job)
+                else:
+                    with metrics.time("scheduler_call_seconds", op="submit"):
+                        job_id = await backend.submit(job)
+                if job_id is not None:
+                    # the new job may rewrite the output file, scan it again from the beginning
+                    log_watcher.reset()
+                    if launched:
+                        restarts += 1
+                        metrics.inc("job_restarts_total")
+                    launched = True
+                    update_store(JOB_SUBMITTED, job_id)
                 if job_id is not None and limits_manager:
-                    await limits_manager.job_submitted()
-            except CalledProcessError as e:
+                    await limits_manager.job_submitted(job)
+            except SchedulerError as e:
+                metrics.inc("scheduler_errors_total", op="submit")
                 if verbose:
                     print(f"Error when launching a new job for {job.name}: {e}")
                 job_id = None
             
             if job_id is None:
+                # release the slot reserved for the job
+                if limits_manager:
+                    await limits_manager.job_finished(job)
                 if verbose:
                     print(f"Cannot find job id for {job.name}")
                     print(f"Retrying again in {check_interval_secs//60} mins...")
-                await asyncio.sleep(check_interval_secs)
+                await asyncio.sleep(wait_secs())
                 continue
 
         if verbose:
             print(f"Current job id for {job.name}: {job_id}")
+        # time at which the job was first seen running, and state of the output file
+        # before that (which can still be the one of a previous job)
+        running_since = None
+        progress_at_launch = log_watcher.progress()
+        # only trust snapshots of the queue taken after the job was submitted
+        not_before = submitted_at = time.time()
         while True:
             # Infinite-loop, check each `check_interval_secs` whether job is present
             # in the queue, then, if present in the queue check if it is still running
             # and not frozen. The job is relaunched when it is no longuer running or
             # frozen. Then the same process is repeated.
-
-            try:
-                data = check_output(cmd_check_job_in_queue.format(job_id=job_id), shell=True, stderr=stderr).decode()
-            except Exception as ex:
-                # Exception after checking, which means that the job id no longer exists.
-                # In this case, we wait and relaunch, except if termination string is found
-                if limits_manager:
-                    await limits_manager.job_finished()
-                if verbose:
-                    print(ex)
-                if check_if_done(output_file, termination_str=termination_str, termination_cmd=termination_cmd, verbose=verbose):
-                    if limits_manager:
-                        await limits_manager.job_finished()
-                    print(f"Job '{job.name}' is finished")
-                    return
-                # Job will be relaunched 
-                if verbose:
-                    print(f"Retrying again in {check_interval_secs//60} mins for {job.name}...")
-                await asyncio.sleep(check_interval_secs)
-                break
+            state = await queue.get_state(job_id, not_before=not_before)
+            metrics.inc("job_checks_total")
             # if job is not present in the queue, relaunch it directly, except if termination string is found
-            if str(job_id) not in data:
+            if state is None:
                 if limits_manager:
-                    await limits_manager.job_finished()
-                if check_if_done(output_file, termination_str=termination_str, termination_cmd=termination_cmd, verbose=verbose):
-                    print(f"Job '{job.name}' is finished")
+                    await limits_manager.job_finished(job)
+                # the job may have just finished, do not rely on a cached result of the termination condition
+                if await check_if_done(log_watcher, conditions, termination_cmd=termination_cmd, max_age=0, verbose=verbose):
+                    set_finished(job_id)
                     return
                 # Job will be relaunched directly
+                update_store(JOB_GONE, job_id)
                 break
             # Check first if job is specifically on a running state (to avoid the case where it is on pending state etc)
-            data = check_output(cmd_check_job_running.format(job_id=job_id), shell=True, stderr=stderr).decode()
-            if str(job_id) in data:
+            if state == JOB_STATE_RUNNING:
                 # job on running state
+                update_store(JOB_RUNNING, job_id)
                 print(f"Job '{job.name}' is running...(ID:{job_id})")
-                if not os.path.exists(output_file):
+                if running_since is None:
+                    running_since = time.time()
+                if not log_watcher.exists():
                     if verbose:
                         print(f"Output file not found for {job.name}, waiting...")
-                    await asyncio.sleep(check_interval_secs)
+                    not_before = time.time()
+                    await asyncio.sleep(watcher.poll_interval_secs if watcher else check_interval_secs)
+                    continue
+                if watcher:
+                    not_before = time.time()
+                    outcome = await watch_running_job(
+                        log_watcher, watcher, running_since, check_interval_secs,
+                        recheck_secs=queue.poll_interval_secs, stale_progress=progress_at_launch,
+                    )
+                    if outcome == WATCH_DONE:
+                        if limits_manager:
+                            await limits_manager.job_finished(job)
+                        set_finished(job_id)
+                        return
+                    if outcome == WATCH_FROZEN:
+                        if verbose:
+                            print(f"Job frozen for {job.name} (no output for {check_interval_secs} secs), stopping the job then restarting it")
+                        await cancel_job(job_id)
+                        break
+                    # check the queue again
+                    continue
+                if check_policy:
+                    progress = log_watcher.progress()
+                    changed_at = log_watcher.progress_changed_at(progress)
+                    freeze_at = None
+                    # (make sure there is output before declaring the job frozen)
+                    if progress and progress[1] > 0:
+                        # as long as the output file did not change since the launch, it can be the one of a previous job
+                        last_write_at = changed_at if progress != progress_at_launch else running_since
+                        freeze_at = last_write_at + check_interval_secs
+                        if time.time() >= freeze_at:
+                            if verbose:
+                                print(f"Job frozen for {job.name} (no output for {check_interval_secs} secs), stopping the job then restarting it")
+                            await cancel_job(job_id)
+                            break
+                    not_before = time.time()
+                    await asyncio.sleep(check_policy.next_check_secs(
+                        check_interval_secs, state, submitted_at, running_since=running_since,
+                        started_after=queue.get_started_after(job_id), freeze_at=freeze_at, time_limit_secs=time_limit_secs,
+                    ))
                     continue
                 if verbose:
                     print(f"Check if the job is freezing for {job.name}...")
                 # if job is on running state, check the output file
-                output_data_prev = get_file_content(output_file)
+                progress_prev = log_watcher.progress()
                 # wait few minutes
+                not_before = time.time()
                 await asyncio.sleep(check_interval_secs)
                 # check again the output file
-                output_data = get_file_content(output_file)
-                # if the file did not change, then it is considered
-                # to be frozen
+                progress = log_watcher.progress()
+                # if the file did not change (same inode, size and modification time),
+                # then it is considered to be frozen
                 # (make sure there are is output before checking)
-                if output_data and output_data_prev and output_data == output_data_prev:
+                if progress and progress[1] > 0 and progress == progress_prev:
                     if verbose:
                         print(f"Job frozen for {job.name}, stopping the job then restarting it")
-                    call(f"scancel {job_id}", shell=True)
-                    if limits_manager:
-                        await limits_manager.job_finished()
+                    await cancel_job(job_id)
                     break
             else:
                 # job not on running state, so it is present in the queue but in a different state
                 # In this case, we wait, then check again if the job is still on the queue
-                await asyncio.sleep(check_interval_secs)
+                update_store(JOB_QUEUED, job_id)
+                not_before = time.time()
+                if check_policy:
+                    await asyncio.sleep(check_policy.next_check_secs(check_interval_secs, state, submitted_at))
+                else:
+                    await asyncio.sleep(check_interval_secs)
  
 
-def check_if_done(logfile, termination_str='', termination_cmd='', verbose=0):
-    return (
-        (os.path.exists(logfile) and (termination_str != "") and re.search(termination_str, open(logfile).read())) or 
-        (termination_cmd and int(check_output(termination_cmd, shell=True, stderr=sys.stderr if verbose >=2 else DEVNULL)) == 1)
-    )
+async def check_if_done(log_watcher, conditions, termination_cmd='', max_age=None, verbose=0):
+    # reading the output file is done in a thread, in order to not block the event loop
+    # when there is a lot of new content to scan
+    loop = asyncio.get_event_loop()
+    with metrics.time("log_scan_seconds"):
+        found = await loop.run_in_executor(None, log_watcher.scan)
+    if found:
+        return True
+    if termination_cmd:
+        try:
+            return await conditions.evaluate(termination_cmd, max_age=max_age) == 1
+        except (CalledProcessError, TimeoutExpired, ValueError) as ex:
+            # if the termination command fails, we consider that the job is not done
+            if verbose:
+                print(f"Error when running termination command '{termination_cmd}': {ex}")
+    return False
 
-def get_file_content(output_file):
-    return open(output_file, errors='ignore').read()
 
-def get_job_id(s):
-    try:
-        return int(re.search("Submitted batch job ([0-9]+)", s).group(1))
-    except Exception:
-        return None
+async def watch_running_job(log_watcher, watcher, running_since, freeze_secs, recheck_secs=60, stale_progress=None, min_scan_interval_secs=1):
+    """
+    Watch the output file of a running job with `watcher` (`OutputWatcher`), until:
+    - the termination string is found, the file being scanned each time it changes (returns `WATCH_DONE`),
+    - the file was last seen to change more than `freeze_secs` ago (returns `WATCH_FROZEN`),
+    - `recheck_secs` passed, so that the state of the job in the queue is checked again (returns `WATCH_RECHECK`).
+
+    `stale_progress` is the state of the output file (see `LogWatcher.progress`) when the job was launched.
+    As long as the file did not change since then, the last write is considered to be `running_since`
+    (when the job was first seen running), rather than the time the file was first seen.
+    """
+    loop = asyncio.get_event_loop()
+    recheck_at = time.time() + recheck_secs
+    while True:
+        progress = log_watcher.progress()
+        now = time.time()
+        changed_at = log_watcher.progress_changed_at(progress, now)
+        if progress is None or now >= recheck_at:
+            return WATCH_RECHECK
+        # (make sure there is output before declaring the job frozen)
+        if progress[1] > 0:
+            last_write_at = changed_at if progress != stale_progress else running_since
+            freeze_at = last_write_at + freeze_secs
+            if now >= freeze_at:
+                return WATCH_FROZEN
+            deadline = min(freeze_at, recheck_at)
+        else:
+            deadline = recheck_at
+        if await watcher.wait_for_change(log_watcher.path, timeout=deadline - now):
+            with metrics.time("log_scan_seconds"):
+                found = await loop.run_in_executor(None, log_watcher.scan)
+            if found:
+                return WATCH_DONE
+            # jobs can write very often, do not scan the file on each write
+            await asyncio.sleep(min_scan_interval_secs)
@@ -0,0 +1,242 @@
+"""
+Instrumentation of the manager: counters, gauges and latency histograms, exposed as a
+Prometheus text endpoint (`serve`) or a JSON file written periodically (`write_json_forever`).
+
+The metrics are recorded in the module-level registry `metrics`, e.g.:
+
+    metrics.inc("job_restarts_total")
+    with metrics.time("scheduler_call_seconds", op="submit"):
+        job_id = await backend.submit(job)
+"""
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+
+PREFIX = "autoexperiment_"
+# upper bounds (in secs) of the buckets of the histograms
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), self.counts)},
+        }
+
+
+class Metrics:
+    """
+    Registry of metrics, each metric is identified by its name and its labels (keyword arguments)
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # (name, labels) -> value
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+        # job name -> last state (see `autoexperiment.store`), for the number of jobs per state
+        self.job_states = {}
+        # source -> last snapshot of the registry of another process (see `merge`)
+        self.sources = {}
+        self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Observe the duration of the block in the histogram `name`, also when it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def set_job_state(self, name, state):
+        self.job_states[name] = state
+
+    def jobs_per_state(self):
+        counts = {}
+        for state in self.job_states.values():
+            counts[state] = counts.get(state, 0) + 1
+        for snapshot in self.sources.values():
+            for state, count in snapshot["jobs_per_state"].items():
+                counts[state] = counts.get(state, 0) + count
+        return counts
+
+    def snapshot(self):
+        """
+        Returns the counters and the number of jobs per state, as a JSON-serializable dict (see `merge`)
+        """
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+            "jobs_per_state": self.jobs_per_state(),
+        }
+
+    def merge(self, source, snapshot):
+        """
+        Add the counters and the jobs of the `snapshot` of the registry of another process
+        (e.g., a worker of the sharded manager, see `autoexperiment.sharding`) to this registry,
+        replacing the previous snapshot of `source`. Histograms are not merged.
+        """
+        self.sources[source] = {
+            "counters": {(name, tuple(tuple(label) for label in labels)): value for name, labels, value in snapshot["counters"]},
+            "jobs_per_state": snapshot["jobs_per_state"],
+        }
+
+    def all_counters(self):
+        """
+        Returns the counters of this registry, summed with the ones of the merged sources
+        """
+        counters = dict(self.counters)
+        for snapshot in self.sources.values():
+            for key, value in snapshot["counters"].items():
+                counters[key] = counters.get(key, 0) + value
+        return counters
+
+    def to_dict(self):
+        return {
+            "time": time.time(),
+            "uptime_secs": time.time() - self.started_at,
+            "jobs_per_state": self.jobs_per_state(),
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.all_counters().items())],
+            "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.gauges.items())],
+            "histograms": [
+                dict(name=name, labels=dict(labels), **histogram.to_dict())
+                for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+            ],
+        }
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        typed = set()
+        def add_type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+        for (name, labels), value in sorted(self.all_counters().items()):
+            add_type(name, "counter")
+            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        gauges = dict(self.gauges)
+        for state, count in self.jobs_per_state().items():
+            gauges[("jobs", (("state", state),))] = count
+        gauges[("uptime_seconds", ())] = time.time() - self.started_at
+        for (name, labels), value in sorted(gauges.items()):
+            add_type(name, "gauge")
+            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            add_type(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmp_path, path)
+
+    async def write_json_forever(self, path, interval_secs=30):
+        while True:
+            self.write_json(path)
+            await asyncio.sleep(interval_secs)
+
+    async def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics over HTTP, in the Prometheus text format (any path), or as JSON (path '/json')
+        """
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                # ignore the headers
+                while (await reader.readline()).strip():
+                    pass
+                parts = request.decode(errors="ignore").split()
+                path = parts[1] if len(parts) > 1 else "/"
+                if path.startswith("/json"):
+                    body, content_type = json.dumps(self.to_dict()), "application/json"
+                else:
+                    body, content_type = self.to_prometheus(), "text/plain; version=0.0.4"
+                body = body.encode()
+                writer.write(
+                    f"HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
+        return await asyncio.start_server(handle, host, port)
+
+    async def monitor_loop_lag(self, interval_secs=1):
+        """
+        Measure how late the event loop wakes up a coroutine sleeping `interval_secs`,
+        i.e. how far behind schedule the checks of the jobs are running
+        """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval_secs)
+            lag = max(time.perf_counter() - start - interval_secs, 0)
+            self.observe("event_loop_lag_seconds", lag)
+            self.set("event_loop_lag_last_seconds", lag)
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
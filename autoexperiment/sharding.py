@@ -0,0 +1,444 @@
+"""
+Sharded manager, for very large sweeps: the jobs are split across several worker processes
+by a stable hash of their name (of the name of their array, for tasks of job arrays),
+so that scanning output files, evaluating conditions and the bookkeeping of each job use several cores.
+
+The coordinator (the main process):
+- takes the snapshots of the SLURM queue, with a single `squeue` call for all the workers,
+  and sends to each worker the part of the snapshot corresponding to its jobs,
+- owns the global limits (`max_jobs`, `max_nodes` and group quotas, see `JobLimitsManager`):
+  workers ask it for a slot before submitting a job,
+- finds the jobs already in the queue (see `reconcile_jobs`),
+- owns the `StateStore`: workers send it the updates of their jobs (see `RemoteStore`), so that
+  a single process writes the SQLite database,
+- aggregates the status and the metrics of the workers (see `Metrics.merge`).
+
+Each worker runs the usual manager (`_manage_jobs`) on its shard, with a `RemoteQueue`, `RemoteLimits`
+and `RemoteStore` instead of a `QueuePoller`, a `JobLimitsManager` and a `StateStore`, and submits and
+cancels its own jobs (with its share of `submit_rate`). Messages are JSON lines sent over a socket pair between the coordinator
+and each worker. Workers stop when the coordinator goes away.
+"""
+import asyncio
+import cProfile
+import json
+import multiprocessing
+import signal
+import socket
+import zlib
+from dataclasses import dataclass, field
+
+from autoexperiment.backends import SlurmBackend
+from autoexperiment.manager import (
+    CommandRunner,
+    JobLimitsManager,
+    QueuePoller,
+    _manage_jobs,
+    reconcile_jobs,
+    skip_finished_jobs,
+)
+from autoexperiment.metrics import metrics
+
+# maximum size of a message (e.g., a snapshot of the queue)
+MAX_MESSAGE_SIZE = 2 ** 28
+
+
+def get_shard(name, nb_shards):
+    """
+    Returns the shard of the job named `name`, which is the same in all the processes and sessions
+    (unlike `hash`, which is randomized for strings)
+    """
+    return zlib.crc32(str(name).encode()) % nb_shards
+
+
+def get_shard_key(job):
+    # tasks of the same job array are managed by the same worker, so that they are submitted together
+    array_task = getattr(job, "array_task", None)
+    return array_task.name if array_task else job.name
+
+
+@dataclass
+class JobRef:
+    """
+    What the coordinator knows about a job of a worker, for the limits (see `JobLimitsManager`)
+    """
+    name: str
+    params: dict = field(default_factory=dict)
+    priority: float = 0
+
+
+class ShardCoordinator:
+    """
+    Coordinator side of the connections with the workers
+    """
+    def __init__(self, queue, nb_shards, limits_manager=None, store=None, status_interval_secs=30, verbose=0):
+        self.queue = queue
+        self.nb_shards = nb_shards
+        self.limits_manager = limits_manager
+        self.store = store
+        self.status_interval_secs = status_interval_secs
+        self.verbose = verbose
+        # shard -> StreamWriter, for the workers still connected
+        self.writers = {}
+        # shard -> names of the jobs of the worker holding a slot
+        self.admitted = {}
+        # shard -> job name -> task waiting for a slot for the job
+        self.acquiring = {}
+
+    async def serve(self, shard, sock):
+        """
+        Handle the messages of the worker of `shard`, until it disconnects
+        """
+        reader, writer = await asyncio.open_connection(sock=sock, limit=MAX_MESSAGE_SIZE)
+        self.writers[shard] = writer
+        self.admitted[shard] = set()
+        self.acquiring[shard] = {}
+        if self.queue.updated_at is not None:
+            self._send_snapshot(shard, self._split_snapshot().get(shard, ({}, {})))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self._handle(shard, json.loads(line))
+        finally:
+            del self.writers[shard]
+            writer.close()
+            for task in self.acquiring.pop(shard).values():
+                task.cancel()
+            # release the slots of the jobs of a worker that stopped
+            for name in self.admitted.pop(shard):
+                await self.limits_manager.job_finished(JobRef(name))
+
+    async def poll_forever(self):
+        """
+        Take a snapshot of the queue every `poll_interval_secs` of the queue, and send it to the workers
+        """
+        while True:
+            updated_at = self.queue.updated_at
+            await self.queue.poll()
+            if self.queue.updated_at != updated_at:
+                snapshots = self._split_snapshot()
+                for shard in list(self.writers):
+                    self._send_snapshot(shard, snapshots.get(shard, ({}, {})))
+            await asyncio.sleep(self.queue.poll_interval_secs)
+
+    async def report_forever(self):
+        while True:
+            await asyncio.sleep(self.status_interval_secs)
+            if self.verbose:
+                print(f"{len(self.writers)} worker(s) running, jobs per state: {metrics.jobs_per_state()}")
+
+    async def _handle(self, shard, message):
+        kind = message["type"]
+        if kind == "status":
+            metrics.merge(f"worker{shard}", message["metrics"])
+            return
+        if kind == "store":
+            self._write_store(message["updates"])
+            return
+        job = JobRef(**message["job"])
+        if kind == "acquire":
+            acquiring = self.acquiring[shard]
+            task = asyncio.ensure_future(self._acquire(shard, message["id"], job))
+            acquiring[job.name] = task
+            task.add_done_callback(lambda task, name=job.name: acquiring.get(name) is task and acquiring.pop(name))
+        elif kind == "submitted":
+            self.admitted[shard].add(job.name)
+            await self.limits_manager.job_submitted(job)
+        elif kind == "finished":
+            # also sent when the job stopped waiting for a slot (see `RemoteLimits.wait_for_slot`)
+            task = self.acquiring[shard].pop(job.name, None)
+            if task is not None:
+                # a slot granted in the meantime is released by `JobLimitsManager.wait_for_slot`
+                task.cancel()
+            self.admitted[shard].discard(job.name)
+            await self.limits_manager.job_finished(job)
+
+    async def _acquire(self, shard, request_id, job):
+        await self.limits_manager.wait_for_slot(job)
+        self.admitted[shard].add(job.name)
+        self._send(shard, {"type": "granted", "id": request_id})
+
+    def _write_store(self, updates):
+        if self.store is None:
+            return
+        for kind, *args in updates:
+            if kind == "record":
+                self.store.record(*args)
+            elif kind == "log_position":
+                name, inode, offset, head = args
+                self.store.record_log_position(name, inode, offset, bytes.fromhex(head) if head is not None else None)
+
+    def _split_snapshot(self):
+        # shard -> (job id -> state, job id -> time before which the job did not start)
+        snapshots = {}
+        for job_id, state in self.queue.states.items():
+            shard = get_shard(self.queue.names.get(job_id), self.nb_shards)
+            states, started_after = snapshots.setdefault(shard, ({}, {}))
+            states[job_id] = state
+            if job_id in self.queue.started_after:
+                started_after[job_id] = self.queue.started_after[job_id]
+        return snapshots
+
+    def _send_snapshot(self, shard, snapshot):
+        states, started_after = snapshot
+        self._send(shard, {"type": "snapshot", "updated_at": self.queue.updated_at, "states": states, "started_after": started_after})
+
+    def _send(self, shard, message):
+        writer = self.writers.get(shard)
+        if writer is not None:
+            writer.write(json.dumps(message).encode() + b"\n")
+
+
+class ShardClient:
+    """
+    Worker side of the connection with the coordinator
+    """
+    def __init__(self, reader, writer, queue):
+        self.reader = reader
+        self.writer = writer
+        self.queue = queue
+        # request id -> future, for the slots requested to the coordinator
+        self.pending = {}
+        self.next_request_id = 0
+
+    async def read_forever(self):
+        """
+        Handle the messages of the coordinator, returns when it disconnects
+        """
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            if message["type"] == "snapshot":
+                await self.queue.update(message["states"], message["started_after"], message["updated_at"])
+            elif message["type"] == "granted":
+                future = self.pending.pop(message["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+    async def request(self, message):
+        """
+        Send `message` to the coordinator, and wait for the answer
+        """
+        self.next_request_id += 1
+        future = asyncio.get_event_loop().create_future()
+        request_id = self.next_request_id
+        self.pending[request_id] = future
+        self.send(dict(message, id=request_id))
+        try:
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(message).encode() + b"\n")
+
+    async def send_status_forever(self, interval_secs):
+        while True:
+            self.send_status()
+            await asyncio.sleep(interval_secs)
+
+    def send_status(self):
+        self.send({"type": "status", "metrics": metrics.snapshot()})
+
+
+class RemoteQueue(QueuePoller):
+    """
+    View of the SLURM queue of a worker, updated with the snapshots sent by the coordinator
+    """
+    def __init__(self, poll_interval_secs=60, verbose=0):
+        super().__init__(backend=None, poll_interval_secs=poll_interval_secs, verbose=verbose)
+
+    async def poll_forever(self):
+        raise RuntimeError("The queue of a worker is updated by the coordinator")
+
+    async def update(self, states, started_after, updated_at):
+        self.states = states
+        self.started_after = started_after
+        self.updated_at = updated_at
+        async with self.condition:
+            self.condition.notify_all()
+
+
+class RemoteLimits:
+    """
+    Limits of a worker (same interface as `JobLimitsManager`), enforced by the coordinator
+    """
+    def __init__(self, client, group_by=None):
+        self.client = client
+        self.group_by = group_by
+
+    async def wait_for_slot(self, job=None):
+        try:
+            await self.client.request({"type": "acquire", "job": self._job_ref(job)})
+        except asyncio.CancelledError:
+            # e.g. the job was cancelled while waiting, or right after the slot was granted:
+            # the coordinator stops waiting for a slot or releases it
+            self.client.send({"type": "finished", "job": self._job_ref(job)})
+            raise
+
+    async def job_submitted(self, job=None):
+        self.client.send({"type": "submitted", "job": self._job_ref(job)})
+
+    async def job_finished(self, job=None):
+        self.client.send({"type": "finished", "job": self._job_ref(job)})
+
+    def _job_ref(self, job):
+        params = {}
+        for key in ("nodes", self.group_by):
+            if key is not None and key in job.params:
+                params[key] = job.params[key]
+        return {"name": job.name, "params": params, "priority": getattr(job, "priority", 0) or 0}
+
+
+class RemoteStore:
+    """
+    Store of a worker (same interface as `StateStore`): the updates are sent to the coordinator,
+    which writes them in its `StateStore`, every `flush_interval_secs` and when closing.
+    `records` are the records of the jobs of the worker, loaded by the coordinator.
+    """
+    def __init__(self, client, path, records=None, flush_interval_secs=1):
+        self.client = client
+        self.path = path
+        self.records = records or {}
+        self.flush_interval_secs = flush_interval_secs
+        # updates not sent yet, in order
+        self.pending = []
+
+    def load(self):
+        return dict(self.records)
+
+    def record(self, name, state, job_id=None, attempts=None, restarts=None, digest=None):
+        self.pending.append(("record", name, state, str(job_id) if job_id is not None else None, attempts, restarts, digest))
+
+    def record_log_position(self, name, inode, offset, head):
+        self.pending.append(("log_position", name, inode, offset, head.hex() if head is not None else None))
+
+    def flush(self):
+        if self.pending:
+            self.client.send({"type": "store", "updates": self.pending})
+            self.pending = []
+
+    async def flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_secs)
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+
+async def coordinate_shards(jobs, workers, max_jobs=None, queue_poll_secs=60, max_concurrent_cmds=32, cmd_timeout_secs=600, store=None, backend=None, max_nodes=None, group_by=None, group_quotas=None, status_interval_secs=30, profile=None, verbose=0, **worker_kwargs):
+    """
+    Manage `jobs` with `workers` worker processes, see above.
+    The arguments are the ones of `manage_jobs_forever`, `worker_kwargs` being passed to `_manage_jobs` in each worker.
+    """
+    if backend is not None:
+        raise ValueError("The sharded manager only supports the SLURM backend")
+    jobs, records = skip_finished_jobs(jobs, store)
+    runner = CommandRunner(max_concurrent_cmds, timeout_secs=cmd_timeout_secs, verbose=verbose)
+    backend = SlurmBackend(runner)
+    existing_job_ids = await reconcile_jobs(jobs, backend)
+    shards = {}
+    for job in jobs:
+        if job.name in existing_job_ids:
+            shards.setdefault(get_shard(get_shard_key(job), workers), []).append(job)
+    limits_manager = JobLimitsManager(max_jobs, max_nodes=max_nodes, group_by=group_by, group_quotas=group_quotas)
+    queue = QueuePoller(backend, queue_poll_secs, verbose=verbose)
+    coordinator = ShardCoordinator(queue, workers, limits_manager=limits_manager, store=store, status_interval_secs=status_interval_secs, verbose=verbose)
+    worker_kwargs = dict(
+        worker_kwargs, max_concurrent_cmds=max_concurrent_cmds, cmd_timeout_secs=cmd_timeout_secs,
+        queue_poll_secs=queue_poll_secs, verbose=verbose,
+    )
+    if worker_kwargs.get("submit_rate") and shards:
+        # each worker submits its jobs through its own gateway, the rate limit is shared between them
+        worker_kwargs["submit_rate"] /= len(shards)
+    # workers are started from scratch, rather than forked from a process running an event loop
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    connections = []
+    for shard, shard_jobs in sorted(shards.items()):
+        parent_sock, child_sock = socket.socketpair()
+        process = context.Process(
+            target=_run_worker,
+            args=(shard, child_sock, shard_jobs, {job.name: existing_job_ids[job.name] for job in shard_jobs}),
+            kwargs=dict(
+                store_path=store.path if store else None, records={job.name: records[job.name] for job in shard_jobs if job.name in records}, limits=limits_manager.max_jobs is not None or max_nodes is not None or bool(group_quotas),
+                group_by=group_by, status_interval_secs=status_interval_secs,
+                profile=f"{profile}.worker{shard}" if profile else None, worker_kwargs=worker_kwargs,
+            ),
+            name=f"autoexperiment-worker{shard}",
+            # killed if the coordinator exits without waiting for them (e.g., on Ctrl+C)
+            daemon=True,
+        )
+        process.start()
+        child_sock.close()
+        processes[shard] = process
+        connections.append(coordinator.serve(shard, parent_sock))
+        if verbose:
+            print(f"Started worker {shard} (PID {process.pid}) for {len(shard_jobs)} job(s)")
+    tasks = [asyncio.ensure_future(coordinator.poll_forever()), asyncio.ensure_future(coordinator.report_forever())]
+    if store:
+        tasks.append(asyncio.ensure_future(store.flush_forever()))
+    try:
+        await asyncio.gather(*connections)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if store:
+            store.flush()
+        loop = asyncio.get_event_loop()
+        for shard, process in processes.items():
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+            elif process.exitcode != 0:
+                print(f"Worker {shard} exited with code {process.exitcode}")
+    print(f"All workers are done, jobs per state: {metrics.jobs_per_state()}")
+
+
+def _run_worker(shard, sock, jobs, existing_job_ids, store_path=None, records=None, limits=False, group_by=None, status_interval_secs=30, profile=None, worker_kwargs=None):
+    # Ctrl+C is sent to all the processes of the terminal, workers stop when the coordinator stops
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        asyncio.run(_worker_main(shard, sock, jobs, existing_job_ids, store_path, records, limits, group_by, status_interval_secs, worker_kwargs or {}))
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+
+
+async def _worker_main(shard, sock, jobs, existing_job_ids, store_path, records, limits, group_by, status_interval_secs, worker_kwargs):
+    reader, writer = await asyncio.open_connection(sock=sock, limit=MAX_MESSAGE_SIZE)
+    queue = RemoteQueue(worker_kwargs.get("queue_poll_secs", 60))
+    client = ShardClient(reader, writer, queue)
+    # the coordinator writes the store, see `RemoteStore`
+    store = RemoteStore(client, store_path, records=records) if store_path else None
+    manager = asyncio.ensure_future(_manage_jobs(
+        jobs, store=store, queue=queue, limits_manager=RemoteLimits(client, group_by=group_by) if limits else None,
+        existing_job_ids=existing_job_ids, **worker_kwargs,
+    ))
+    reading = asyncio.ensure_future(client.read_forever())
+    status = asyncio.ensure_future(client.send_status_forever(status_interval_secs))
+    try:
+        await asyncio.wait([manager, reading], return_when=asyncio.FIRST_COMPLETED)
+        if not manager.done():
+            print(f"Worker {shard}: the coordinator stopped, stopping")
+            manager.cancel()
+        else:
+            # raise the exception of the manager, if any
+            manager.result()
+    finally:
+        status.cancel()
+        reading.cancel()
+        if store:
+            store.close()
+        client.send_status()
+        writer.close()
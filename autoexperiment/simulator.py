@@ -0,0 +1,212 @@
+"""
+In-process simulation of a SLURM cluster, used to measure how the manager behaves
+with many jobs without a real cluster (see `autoexperiment.benchmark`).
+"""
+import asyncio
+import math
+import os
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from autoexperiment.backends import SchedulerBackend, SchedulerError
+
+SIM_PENDING = "PENDING"
+SIM_RUNNING = "RUNNING"
+
+
+@dataclass
+class SimulatedJob:
+    job_id: str
+    name: str
+    output_file: str
+    # key used to keep the progress of the job across restarts (checkpointing)
+    key: str
+    state: str = SIM_PENDING
+    submitted_at: float = 0.0
+    started_at: float = None
+    last_write_at: float = None
+    # the job stops writing to its output file, without leaving the queue
+    hung: bool = False
+
+
+class SimulatedBackend(SchedulerBackend):
+    """
+    Scheduler backend simulating a SLURM cluster in the current process.
+
+    Submitted jobs stay pending for `queue_delay_secs` (and while `max_running` jobs are running),
+    then run: their output file is truncated, a line is appended every `write_interval_secs`,
+    and `termination_str` is written once the job ran for a total of `run_secs` secs.
+    Progress is kept across restarts, as if the jobs were checkpointing.
+
+    Running jobs can be interrupted, and should then be resubmitted by the manager:
+    - they are killed after `time_limit_secs` secs (if not None),
+    - they are preempted with a rate of `preemption_rate` per sec,
+    - they hang (stop writing, but stay in the queue) with probability `hang_prob` when they start.
+
+    The simulation advances each time the backend is called, and with `run_forever`.
+    """
+    def __init__(
+        self, queue_delay_secs=5, run_secs=60, time_limit_secs=None, preemption_rate=0.0, hang_prob=0.0,
+        write_interval_secs=1, termination_str="FINISHED JOB", max_running=None, call_latency_secs=0, seed=0,
+    ):
+        self.queue_delay_secs = queue_delay_secs
+        self.run_secs = run_secs
+        self.time_limit_secs = time_limit_secs
+        self.preemption_rate = preemption_rate
+        self.hang_prob = hang_prob
+        self.write_interval_secs = write_interval_secs
+        self.termination_str = termination_str
+        self.max_running = max_running
+        self.call_latency_secs = call_latency_secs
+        self.random = random.Random(seed)
+        # job id -> SimulatedJob, for the jobs in the queue
+        self.jobs = {}
+        self.next_job_id = 1
+        # key -> secs already run
+        self.progress = {}
+        # key -> time at which the last job was interrupted (or hung), to measure restart latency
+        self.interrupted_at = {}
+        # number of calls per method
+        self.calls = Counter()
+        # number of interruptions per cause
+        self.events = Counter()
+        self.restart_latencies = []
+        self.finished = set()
+        # CPU time spent simulating, to be excluded from the CPU time of the manager
+        self.cpu_time = 0.0
+        self.last_step_at = None
+
+    async def submit(self, job):
+        await self._call("submit")
+        return self._add_job(job.name, job.output_file)
+
+    async def submit_array(self, script, indices):
+        await self._call("submit_array")
+        # see `autoexperiment.arrays.ArrayBuilder`
+        name = os.path.splitext(os.path.basename(script))[0]
+        tasks_file = os.path.splitext(script)[0] + ".tasks"
+        try:
+            with open(tasks_file) as f:
+                tasks = [line.rstrip("\n").split("\t") for line in f]
+        except OSError as ex:
+            raise SchedulerError(str(ex)) from ex
+        array_id = str(self.next_job_id)
+        self.next_job_id += 1
+        for index in indices:
+            _, output_file = tasks[index]
+            self._add_job(name, output_file, job_id=f"{array_id}_{index}")
+        return array_id
+
+    async def query_many(self):
+        await self._call("query_many")
+        states = {job_id: job.state for job_id, job in self.jobs.items()}
+        names = {job_id: job.name for job_id, job in self.jobs.items()}
+        return states, names
+
+    async def cancel(self, job_ids):
+        await self._call("cancel")
+        for job_id in job_ids:
+            job = self.jobs.pop(str(job_id), None)
+            if job is not None and not job.hung:
+                self.interrupted_at.setdefault(job.key, time.time())
+
+    async def run_forever(self, tick_secs=0.5):
+        """
+        Advance the simulation every `tick_secs`, so that running jobs write to their output file
+        even when the manager does not call the backend
+        """
+        while True:
+            self.step()
+            await asyncio.sleep(tick_secs)
+
+    def step(self):
+        """
+        Advance the simulation up to the current time
+        """
+        cpu_start = time.process_time()
+        now = time.time()
+        dt = now - self.last_step_at if self.last_step_at is not None else 0
+        self.last_step_at = now
+        nb_running = sum(job.state == SIM_RUNNING for job in self.jobs.values())
+        for job_id, job in list(self.jobs.items()):
+            if job.state == SIM_PENDING:
+                if now - job.submitted_at < self.queue_delay_secs:
+                    continue
+                if self.max_running is not None and nb_running >= self.max_running:
+                    continue
+                self._start(job, now)
+                nb_running += 1
+            elif job.hung:
+                continue
+            elif self.time_limit_secs is not None and now - job.started_at >= self.time_limit_secs:
+                self._interrupt(job_id, "timeout", now)
+                nb_running -= 1
+            elif self.preemption_rate and self.random.random() < 1 - math.exp(-self.preemption_rate * dt):
+                self._interrupt(job_id, "preemption", now)
+                nb_running -= 1
+            else:
+                self._write(job, now)
+                if self.progress[job.key] >= self.run_secs:
+                    with open(job.output_file, "a") as f:
+                        f.write(f"{self.termination_str}\n")
+                    del self.jobs[job_id]
+                    self.finished.add(job.key)
+                    nb_running -= 1
+        self.cpu_time += time.process_time() - cpu_start
+
+    def stats(self):
+        """
+        Returns a dict with the number of calls per method, the number of interruptions per cause,
+        and the number of finished jobs
+        """
+        return {
+            "calls": dict(self.calls),
+            "events": dict(self.events),
+            "finished": len(self.finished),
+        }
+
+    async def _call(self, method):
+        self.calls[method] += 1
+        if self.call_latency_secs:
+            await asyncio.sleep(self.call_latency_secs)
+        self.step()
+
+    def _add_job(self, name, output_file, job_id=None):
+        if job_id is None:
+            job_id = str(self.next_job_id)
+            self.next_job_id += 1
+        key = output_file
+        interrupted_at = self.interrupted_at.pop(key, None)
+        now = time.time()
+        if interrupted_at is not None:
+            self.restart_latencies.append(now - interrupted_at)
+        self.jobs[job_id] = SimulatedJob(job_id=job_id, name=name, output_file=output_file, key=key, submitted_at=now)
+        return job_id
+
+    def _start(self, job, now):
+        job.state = SIM_RUNNING
+        job.started_at = now
+        job.last_write_at = now
+        self.progress.setdefault(job.key, 0.0)
+        with open(job.output_file, "w") as f:
+            f.write(f"Job {job.job_id} started\n")
+        if self.hang_prob and self.random.random() < self.hang_prob:
+            job.hung = True
+            self.events["hang"] += 1
+            self.interrupted_at[job.key] = now
+
+    def _write(self, job, now):
+        elapsed = now - job.last_write_at
+        if elapsed < self.write_interval_secs:
+            return
+        self.progress[job.key] += elapsed
+        job.last_write_at = now
+        with open(job.output_file, "a") as f:
+            f.write(f"Progress: {self.progress[job.key]:.1f}/{self.run_secs} secs\n")
+
+    def _interrupt(self, job_id, cause, now):
+        job = self.jobs.pop(job_id)
+        self.events[cause] += 1
+        self.interrupted_at[job.key] = now
@@ -0,0 +1,152 @@
+import asyncio
+import sqlite3
+import time
+from dataclasses import dataclass
+
+# states of a job recorded in the store
+JOB_WAITING = "waiting"      # start condition not satisfied yet
+JOB_GAVE_UP = "gave_up"      # max number of start attempts reached
+JOB_SUBMITTED = "submitted"  # new SLURM job submitted
+JOB_RESUMED = "resumed"      # existing SLURM job found in the queue
+JOB_QUEUED = "queued"        # in the queue, but not running (e.g., pending)
+JOB_RUNNING = "running"
+JOB_FROZEN = "frozen"        # cancelled because output file did not change
+JOB_GONE = "gone"            # not in the queue anymore, will be relaunched
+JOB_FINISHED = "finished"
+
+
+@dataclass
+class JobRecord:
+    name: str
+    state: str = None
+    # last SLURM job id
+    job_id: str = None
+    # number of times the start condition was not satisfied
+    attempts: int = 0
+    # number of times a new SLURM job was submitted after the first one
+    restarts: int = 0
+    finished_at: float = None
+    updated_at: float = None
+    # position already scanned in the output file (see `LogWatcher`)
+    log_inode: int = None
+    log_offset: int = None
+    log_head: bytes = None
+    # digest of the sbatch script of the job (see `build`), the record does not apply to the job anymore if it changes
+    digest: str = None
+
+
+class StateStore:
+    """
+    Persistent state of the managed jobs (state, SLURM job id, restart counts, finish time,
+    and position scanned in the output file), stored in a SQLite database in WAL mode.
+    Each state transition is also appended to a `transitions` table.
+
+    This allows `run` to skip the jobs that are known to be finished, and to resume
+    the other ones from their stored state, after a crash or a restart.
+
+    Updates are kept in memory and written together, in a single transaction, by `flush`:
+    at most every `flush_interval_secs` when updating, with `flush_forever`, and when closing the store.
+    """
+    def __init__(self, path, flush_interval_secs=1):
+        self.path = path
+        self.flush_interval_secs = flush_interval_secs
+        # autocommit mode, transactions are explicit (see `flush`)
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "name TEXT PRIMARY KEY, state TEXT, job_id TEXT, attempts INTEGER DEFAULT 0, restarts INTEGER DEFAULT 0, "
+            "finished_at REAL, updated_at REAL, log_inode INTEGER, log_offset INTEGER, log_head BLOB, digest TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS transitions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, state TEXT, job_id TEXT, time REAL)"
+        )
+        # name -> last recorded state, to only log actual transitions
+        self.states = {}
+        # name -> columns to update, and transitions to insert, not written yet
+        self.pending = {}
+        self.pending_transitions = []
+        self.flushed_at = time.time()
+
+    def load(self):
+        """
+        Returns a dict mapping job names to their `JobRecord`
+        """
+        self.flush()
+        records = {}
+        cursor = self.conn.execute(
+            "SELECT name, state, job_id, attempts, restarts, finished_at, updated_at, log_inode, log_offset, log_head, digest FROM jobs"
+        )
+        for row in cursor:
+            record = JobRecord(*row)
+            records[record.name] = record
+            self.states[record.name] = record.state
+        return records
+
+    def record(self, name, state, job_id=None, attempts=None, restarts=None, digest=None):
+        """
+        Record the (new) state of a job. Fields that are None are left unchanged.
+        """
+        now = time.time()
+        job_id = str(job_id) if job_id is not None else None
+        columns = self.pending.setdefault(name, {})
+        columns.update(state=state, finished_at=now if state == JOB_FINISHED else None, updated_at=now)
+        for column, value in (("job_id", job_id), ("attempts", attempts), ("restarts", restarts), ("digest", digest)):
+            if value is not None:
+                columns[column] = value
+        if self.states.get(name) != state:
+            self.pending_transitions.append((name, state, job_id, now))
+            self.states[name] = state
+        self._maybe_flush()
+
+    def record_log_position(self, name, inode, offset, head):
+        """
+        Record the position already scanned in the output file of a job
+        """
+        self.pending.setdefault(name, {}).update(log_inode=inode, log_offset=offset, log_head=head)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self.flushed_at >= self.flush_interval_secs:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending updates, in a single transaction
+        """
+        self.flushed_at = time.time()
+        if not self.pending and not self.pending_transitions:
+            return
+        # updates of the same columns are written with a single statement
+        by_columns = {}
+        for name, columns in self.pending.items():
+            by_columns.setdefault(tuple(columns), []).append((name, *columns.values()))
+        self.conn.execute("BEGIN")
+        try:
+            for columns, rows in by_columns.items():
+                self.conn.executemany(
+                    f"INSERT INTO jobs (name, {', '.join(columns)}) VALUES (?{', ?' * len(columns)}) "
+                    f"ON CONFLICT(name) DO UPDATE SET {', '.join(f'{column}=excluded.{column}' for column in columns)}",
+                    rows,
+                )
+            self.conn.executemany("INSERT INTO transitions (name, state, job_id, time) VALUES (?, ?, ?, ?)", self.pending_transitions)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.pending = {}
+        self.pending_transitions = []
+
+    async def flush_forever(self):
+        """
+        Write the pending updates every `flush_interval_secs`, even when the jobs are not updated
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval_secs)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,89 @@
+"""
+Cache of the expanded sweep of a config file, so that `build`, `run` and `for_each` do not
+expand the same sweep again as long as its inputs did not change.
+
+The cache file is written by `build` (or by `run` when there is no up-to-date cache). It contains
+a header with the key of the sweep, i.e. a hash of the config with the `--fix` overrides and its
+interpolations (e.g. `${oc.env:USER}`) resolved, and the modification times of the templates, followed by the job definitions in the compact
+form of `CompactJobDef` (the `ParamTable` of the sweep, which is columnar, and the name and
+offset of each job), both pickled.
+"""
+import hashlib
+import os
+import pickle
+from array import array
+
+from omegaconf import OmegaConf
+
+from autoexperiment.template import CompactJobDef
+
+# incremented when the format of the cache (or of `ParamTable`) changes
+VERSION = 3
+
+
+class SweepCache:
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, cfg):
+        """
+        Returns the list of `CompactJobDef` of the config `cfg` (loaded with the overrides, see `_load_config`),
+        or None if it is not cached, or if the cache is outdated or cannot be read
+        """
+        try:
+            with open(self.path, "rb") as f:
+                header = pickle.load(f)
+                if not self._is_valid(header, cfg):
+                    return None
+                table, names, offsets = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            print(f"Ignoring the sweep cache '{self.path}', which cannot be read (Exception: {ex})")
+            return None
+        return [CompactJobDef(table, offset, name) for name, offset in zip(names, offsets)]
+
+    def save(self, cfg, jobdefs):
+        """
+        Cache `jobdefs`, the list of `CompactJobDef` of the config `cfg`
+        """
+        table = jobdefs[0].table if jobdefs else None
+        assert all(jobdef.table is table for jobdef in jobdefs), "the jobs of a sweep share the same table"
+        templates = {}
+        for jobdef in jobdefs:
+            path = jobdef.param("template")
+            if path not in templates:
+                templates[path] = _mtime(path)
+        header = dict(_key(cfg), templates=templates)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(
+                (table, [jobdef.name for jobdef in jobdefs], array("Q", (jobdef.offset for jobdef in jobdefs))),
+                f, protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, self.path)
+
+    def _is_valid(self, header, cfg):
+        if not isinstance(header, dict) or any(header.get(k) != v for k, v in _key(cfg).items()):
+            return False
+        return all(_mtime(path) == mtime for path, mtime in header["templates"].items())
+
+
+def _key(cfg):
+    # the values the sweep is expanded from, e.g. a change of an environment variable used in the config changes the key
+    config_hash = hashlib.sha1(OmegaConf.to_yaml(cfg, resolve=True).encode()).hexdigest()
+    return {
+        "version": VERSION,
+        "config_hash": config_hash,
+        # paths of the templates and of the sbatch scripts are relative to the working directory
+        "cwd": os.getcwd(),
+    }
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
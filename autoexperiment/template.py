@@ -1,6 +1,20 @@
+import ast
+import io
+import keyword
+import math
+import operator
+import os
+import re
+import sys
+import time
+import tokenize
 import warnings
-from omegaconf import OmegaConf, DictConfig, ListConfig
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from string import Formatter
 from itertools import product
+from omegaconf import OmegaConf, DictConfig, ListConfig
+from array import array
 from dataclasses import dataclass, fields
 
 @dataclass
@@ -27,6 +41,239 @@ class JobDef:
    termination_str: str = ""
    # command to check to terminate the job (alternative to termination_str)
    termination_cmd: str = ""
+   # jobs with a higher priority are submitted first when the number of jobs is limited (see `JobLimitsManager`)
+   priority: int = 0
+
+   # set by `run` for the manager (see `manage_job`), these are not params of the job
+   max_start_attempts = float('inf')
+   dry = False
+   array_task = None
+   # digest of the sbatch script, when it is known (see `build`)
+   script_digest = None
+
+   def render(self):
+      """
+      Returns the sbatch script of the job.
+      If the job definition was generated lazily (see `iter_job_defs`), the template is
+      rendered on demand and the result is not kept in memory.
+      """
+      if self.config:
+         return self.config
+      return _render_template(self.params)
+
+
+_JOB_DEF_DEFAULTS = {field.name: field.default for field in fields(JobDef)}
+
+
+class ParamTable:
+   """
+   Compact storage of the params of the jobs of a sweep (see `CompactJobDef`).
+
+   Each distinct tuple of param names (a "layout") is stored once, and each distinct value
+   of a param once, in the value table of the param. The params of a job are stored as a row
+   of indices in the flat array `rows`: the index of the layout, followed by the index of the
+   value of each param of the layout in its value table.
+
+   Params referencing other params (e.g. '{logs}/{name}/slurm.out') usually have a different
+   value for each job, they can be stored unresolved (`lazy`), the template being shared by all
+   the jobs, and are then resolved each time they are accessed. The templates of the lazy params
+   they reference are inlined (e.g. '{logs}/{dataset}_{lr}/slurm.out' if name is '{dataset}_{lr}'),
+   so that each access is a single `str.format`.
+   """
+   def __init__(self):
+      # list of tuples of (interned) param names
+      self.layouts = []
+      # for each layout, param name -> position of the param in the rows
+      self.positions = []
+      # for each layout, names of the params stored unresolved, and their positions in the rows
+      self.lazy = []
+      self.lazy_positions = []
+      # param name -> list of the distinct values of the param
+      self.values = {}
+      self.rows = array("I")
+      # (layout, param name, indices of the values of the lazy params) -> (inlined template, list of (name, position)
+      # of the params it references which are not lazy, names of the lazy params it references)
+      self._inlined = {}
+      # layout -> index, and (param name, type of value) -> {value: index}, only needed
+      # while adding rows (see `freeze`)
+      self._layout_ids = {}
+      self._value_ids = {}
+
+   def add(self, params, lazy=()):
+      """
+      Store `params` (dict), where the params `lazy` are templates to resolve when accessed,
+      returns the offset of its row
+      """
+      key = (tuple(params), tuple(lazy))
+      layout_id = self._layout_ids.get(key)
+      if layout_id is None:
+         layout = tuple(sys.intern(k) if type(k) == str else k for k in params)
+         layout_id = self._layout_ids[key] = len(self.layouts)
+         self.layouts.append(layout)
+         self.positions.append({k: i + 1 for i, k in enumerate(layout)})
+         self.lazy.append(frozenset(lazy))
+         self.lazy_positions.append(tuple(self.positions[layout_id][k] for k in lazy))
+         for k in layout:
+            self.values.setdefault(k, [])
+      offset = len(self.rows)
+      self.rows.append(layout_id)
+      for k, v in params.items():
+         self.rows.append(self._value_id(k, v))
+      return offset
+
+   def _value_id(self, k, v):
+      values = self.values[k]
+      # values are deduplicated per type, as e.g. 1, 1.0 and True are equal
+      ids = self._value_ids.get((k, type(v)))
+      if ids is None:
+         ids = self._value_ids[(k, type(v))] = {}
+      try:
+         value_id = ids.get(v)
+      except TypeError:
+         # unhashable value (e.g., list returned by an expression), not deduplicated
+         values.append(v)
+         return len(values) - 1
+      if value_id is None:
+         value_id = ids[v] = len(values)
+         values.append(v)
+      return value_id
+
+   def freeze(self):
+      """
+      Drop the indexes used to deduplicate the values, once all the rows are added
+      """
+      self._layout_ids = {}
+      self._value_ids = {}
+
+   def get(self, offset, key, default=None):
+      """
+      Returns the value of the param `key` of the row at `offset`
+      """
+      layout_id = self.rows[offset]
+      if key not in self.positions[layout_id]:
+         return default
+      return self._get(offset, layout_id, key, None)
+
+   def _get(self, offset, layout_id, key, resolved):
+      value = self.values[key][self.rows[offset + self.positions[layout_id][key]]]
+      if key not in self.lazy[layout_id]:
+         return value
+      if resolved is not None and key in resolved:
+         return resolved[key]
+      rows = self.rows
+      inlined_key = (layout_id, key, tuple(rows[offset + position] for position in self.lazy_positions[layout_id]))
+      inlined = self._inlined.get(inlined_key)
+      if inlined is None:
+         template, deps = self._inline(offset, layout_id, value)
+         positions, lazy = self.positions[layout_id], self.lazy[layout_id]
+         inlined = self._inlined[inlined_key] = (
+            template, [(dep, positions[dep]) for dep in deps if dep not in lazy], [dep for dep in deps if dep in lazy],
+         )
+      template, direct_deps, lazy_deps = inlined
+      values = self.values
+      kwargs = {dep: values[dep][rows[offset + position]] for dep, position in direct_deps}
+      for dep in lazy_deps:
+         kwargs[dep] = self._get(offset, layout_id, dep, resolved)
+      value = template.format(**kwargs)
+      if resolved is not None:
+         resolved[key] = value
+      return value
+
+   def _inline(self, offset, layout_id, template):
+      """
+      Inline, in `template`, the templates of the lazy params of the row at `offset`, returns
+      the resulting template and the names of the params it references
+      """
+      parts = []
+      deps = set()
+      for literal, field_name, format_spec, conversion in Formatter().parse(template):
+         parts.append(literal.replace("{", "{{").replace("}", "}}"))
+         if field_name is None:
+            continue
+         if field_name in self.lazy[layout_id] and not format_spec and not conversion:
+            value = self.values[field_name][self.rows[offset + self.positions[layout_id][field_name]]]
+            inlined, inlined_deps = self._inline(offset, layout_id, value)
+            parts.append(inlined)
+            deps.update(inlined_deps)
+         else:
+            field = "{" + field_name + ("!" + conversion if conversion else "") + (":" + format_spec if format_spec else "") + "}"
+            parts.append(field)
+            deps.update(_find_deps(field))
+      return "".join(parts), tuple(deps)
+
+   def to_dict(self, offset):
+      """
+      Returns the (resolved) params of the row at `offset` as a dict
+      """
+      layout_id = self.rows[offset]
+      resolved = {}
+      return {k: self._get(offset, layout_id, k, resolved) for k in self.layouts[layout_id]}
+
+
+def _param_property(name):
+   default = _JOB_DEF_DEFAULTS[name]
+   return property(lambda self: self.table.get(self.offset, name, default))
+
+
+class CompactJobDef:
+   """
+   Memory-lean equivalent of `JobDef`, for large sweeps (see `iter_job_defs(compact=True)`).
+
+   The params of the job are stored in a `ParamTable` shared by all the jobs of the sweep, the
+   fields of `JobDef` are read from the params when accessed, and the sbatch script is only
+   rendered on demand (`render`), it is never kept in memory.
+   """
+   __slots__ = ("table", "offset", "name", "max_start_attempts", "dry", "array_task", "script_digest")
+
+   def __init__(self, table, offset, name):
+      self.table = table
+      self.offset = offset
+      self.name = name
+      # same defaults as `JobDef`
+      self.max_start_attempts = float('inf')
+      self.dry = False
+      self.array_task = None
+      self.script_digest = None
+
+   @property
+   def params(self):
+      # a new dict at each access, modifying it does not modify the job
+      return self.table.to_dict(self.offset)
+
+   @property
+   def config(self):
+      return ""
+
+   def param(self, key, default=None):
+      """
+      Returns the value of the param `key`, without building the dict of all the params
+      """
+      return self.table.get(self.offset, key, default)
+
+   output_file = _param_property("output_file")
+   cmd = _param_property("cmd")
+   sbatch_script = _param_property("sbatch_script")
+   check_interval_secs = _param_property("check_interval_secs")
+   start_condition_cmd = _param_property("start_condition_cmd")
+   termination_str = _param_property("termination_str")
+   termination_cmd = _param_property("termination_cmd")
+   priority = _param_property("priority")
+
+   def render(self):
+      """
+      Returns the sbatch script of the job
+      """
+      return _render_template(self.params)
+
+   def __eq__(self, other):
+      if not isinstance(other, (CompactJobDef, JobDef)):
+         return NotImplemented
+      return self.name == other.name and self.params == other.params and self.config == other.config
+
+   __hash__ = None
+
+   def __repr__(self):
+      return f"CompactJobDef(name={self.name!r}, params={self.params!r})"
  
 MANDATORY_FIELDS =[
    "name",
@@ -40,8 +287,16 @@ MANDATORY_FIELDS =[
 def product_recursive(cfg):
    """
    Generate all possible combinations of parameters in a config file.
+   See `iter_product_recursive` for more details, this returns the same
+   combinations as a list.
+   """
+   return list(iter_product_recursive(cfg))
+
+def iter_product_recursive(cfg):
+   """
+   Generate all possible combinations of parameters in a config file.
 
-   Returns a list of dicts where:
+   Yields dicts (one at a time, without building the full product in memory) where:
    each dict is a group set of params (and their values) that occur together
    the keys are tuples constructed from the nested structure, the values are the corresponding values
 
@@ -90,35 +345,181 @@ def product_recursive(cfg):
          {(x,val:2), (x,r):5, (y,val):4, (y,r):6},
       ]
    """
+   return _iter_product(cfg)
+
+def _iter_product(cfg, pruner=None, key=None):
+   """
+   See `iter_product_recursive`.
+   `key` is the key of `cfg` in its parent dict (if any), and `pruner` (see `_Pruner`)
+   is used to skip the values and branches that cannot match the filters on the params.
+   """
    if type(cfg) in (str, int, float, bool):
-      return [{tuple(): cfg}]
+      if pruner is None or pruner.keep_value(key, cfg):
+         yield {tuple(): cfg}
    elif type(cfg) == ListConfig:
       if all(type(vi) == DictConfig and len(vi) == 1 for vi in cfg):
          # list of dicts where each dict has a single key and a value:
-         all_vals = []
          for kv in cfg:
             k = _first_key(kv)
+            if pruner is not None and not pruner.keep_branch(key, k, cfg, kv):
+               continue
             v = _first_val(kv)
-            vals = [_add_key(k, vi) for vi in product_recursive(v)]
-            all_vals.extend(vals)
-         return all_vals
+            for vi in _iter_product(v, pruner, k):
+               yield _add_key(k, vi)
       elif all(type(vi) in (str, int, float, bool) for vi in cfg):
          # list of str/int/float values
-         return  [{tuple(): vi} for vi in cfg]
+         for vi in cfg:
+            if pruner is None or pruner.keep_value(key, vi):
+               yield {tuple(): vi}
       else:
          # list of something else?
          raise ValueError(f"list should either be of str/int/float values, or list of dicts with a single key/value, got:{cfg}")
    elif type(cfg) == DictConfig:
-      vals_all = []
-      for k, v in cfg.items():
-         vs = [ _add_key(k, vi) for vi in product_recursive(v)]
-         vals_all.append(vs)
-      vals_all = product(*vals_all)
-      vals_all = [_merge(vi) for vi in vals_all]
-      return vals_all
+      yield from _iter_product_items(list(cfg.items()), pruner)
    else:
       raise ValueError(f"Unexpected type {type(cfg)}, should be either str or int or float or ListConfig or DictConfig")
 
+def _iter_product_items(items, pruner=None):
+   """
+   cartesian product of the values of a list of (key, value) items, in the same order
+   as `itertools.product`, i.e. the first key varies the slowest.
+   The combinations of the remaining items are re-generated for each value of the first
+   item instead of being stored, so that memory does not grow with the size of the product.
+   """
+   if not items:
+      yield {}
+      return
+   # leading items whose values are leaves (a value or a list of values) have few
+   # combinations, they are expanded together with `itertools.product`, the others
+   # are generated recursively.
+   nb_leaves = 0
+   while nb_leaves < len(items) and _is_leaf(items[nb_leaves][1]):
+      nb_leaves += 1
+   if nb_leaves:
+      heads = product(*[[_add_key(k, vi) for vi in _iter_product(v, pruner, k)] for k, v in items[:nb_leaves]])
+   else:
+      k, v = items[0]
+      heads = ((_add_key(k, vi),) for vi in _iter_product(v, pruner, k))
+      nb_leaves = 1
+   rest = items[nb_leaves:]
+   for head in heads:
+      head = _merge(head)
+      for tail in _iter_product_items(rest, pruner):
+         yield _merge((head, tail))
+
+def _is_leaf(cfg):
+   """
+   whether `cfg` is a single value or a list of values
+   """
+   return type(cfg) in (str, int, float, bool) or (type(cfg) == ListConfig and all(type(vi) in (str, int, float, bool) for vi in cfg))
+
+class _Pruner:
+   """
+   Decide, during the expansion of the config, which values and branches can be skipped
+   because the resulting params cannot match the filters `where` (param name -> predicate,
+   see `parse_param_filter`).
+
+   Only the params defined by a single key of the whole config are used to prune, as their
+   value cannot be overridden elsewhere, and only static values are checked (values referencing
+   other params or expressions are only known after resolution). The filters still need to be
+   applied to the resolved params of each job, see `iter_job_defs`.
+   """
+   def __init__(self, cfg, where):
+      counts = {}
+      _count_keys(cfg, counts)
+      self.where = {k: predicate for k, predicate in where.items() if counts.get(k) == 1}
+      # id of a node -> (node, set of keys in the node)
+      self._keys = {}
+      self._parse = ParamResolver().parse
+
+   def keep_value(self, key, value):
+      """
+      whether the param `key` can take the value `value`
+      """
+      predicate = self.where.get(key)
+      if predicate is None:
+         return True
+      if type(value) == str and self._parse(value).is_dynamic:
+         return True
+      return predicate(value)
+
+   def keep_branch(self, key, k, union, kv):
+      """
+      whether the branch `kv` (a dict with the single key `k`) of the list of dicts `union`,
+      which is the value of `key`, can match the filters
+      """
+      # the value of `key` is the key of the branch
+      predicate = self.where.get(key)
+      if predicate is not None and not predicate(k):
+         return False
+      # params defined in other branches of the list are not defined by this branch
+      for other, predicate in self.where.items():
+         if other != key and other in self._keys_of(union) and other not in self._keys_of(kv) and not predicate(None):
+            return False
+      return True
+
+   def _keys_of(self, node):
+      cached = self._keys.get(id(node))
+      if cached is None:
+         counts = {}
+         _count_keys(node, counts)
+         # keep a reference to the node, so that its id is not reused
+         cached = self._keys[id(node)] = (node, set(counts))
+      return cached[1]
+
+def _count_keys(cfg, counts):
+   """
+   count the number of occurrences of each key in the config
+   """
+   if type(cfg) == DictConfig:
+      for k, v in cfg.items():
+         counts[k] = counts.get(k, 0) + 1
+         _count_keys(v, counts)
+   elif type(cfg) == ListConfig:
+      for v in cfg:
+         _count_keys(v, counts)
+
+def parse_param_filter(spec):
+   """
+   Parse a filter on a param, as given on the command line, and returns (key, predicate)
+   where `predicate` is a function of the value of the param (None if the param is not defined).
+
+   - `key=v1,v2`: the value is one of v1, v2 (compared as strings). Each alternative can be:
+      - a glob pattern, e.g. `model=ViT-*`
+      - an inclusive range of numbers, where the bounds can be omitted, e.g. `lr=0.001..0.01` or `epochs=10..`
+   - `key~regex`: the value (as a string) fully matches the regular expression, e.g. `model~ViT-[BL]-.*`
+   """
+   eq, tilde = spec.find("="), spec.find("~")
+   if tilde > 0 and (eq < 0 or tilde < eq):
+      key, regex = spec[:tilde], re.compile(spec[tilde + 1:])
+      return key, lambda value: regex.fullmatch(str(value)) is not None
+   assert eq > 0, "Invalid param format. Please use key=value or key~regex."
+   key, values = spec[:eq], spec[eq + 1:]
+   predicates = [_parse_alternative(value) for value in values.split(",")]
+   return key, lambda value: any(predicate(value) for predicate in predicates)
+
+def _parse_alternative(value):
+   match = re.fullmatch(r"([-+0-9.eE]*)\.\.([-+0-9.eE]*)", value)
+   if match and any(match.groups()):
+      try:
+         low, high = (float(bound) if bound else None for bound in match.groups())
+         return lambda v: _in_range(v, low, high)
+      except ValueError:
+         # not a range, e.g. '1.2.3..4'
+         pass
+   if any(c in value for c in "*?["):
+      return lambda v: fnmatchcase(str(v), value)
+   return lambda v: str(v) == value
+
+def _in_range(value, low, high):
+   if value is None or type(value) == bool:
+      return False
+   try:
+      value = float(value)
+   except ValueError:
+      return False
+   return (low is None or value >= low) and (high is None or value <= high)
+
 def _add_key(k, vi):
    """
    insert the key k to the list of keys of each dict element
@@ -151,8 +552,28 @@ def generate_job_defs(cfg, verbose=0):
    Returns a list of JobDef from a config file (config.yaml)
    the JobDef list can directly be used by the manager to schedule/manage the jobs
    """
-   jobs = []
-   for vals in product_recursive(cfg):
+   return list(iter_job_defs(cfg, verbose=verbose, render=True))
+
+def iter_job_defs(cfg, verbose=0, render=False, where=None, compact=False, unique_names=True):
+   """
+   Same as `generate_job_defs`, but yields the JobDef one at a time, so that
+   large sweeps do not need to be expanded in memory.
+   If `render` is False, the sbatch script of each job is not rendered (`JobDef.config` is empty),
+   use `JobDef.render()` to render it when needed.
+   If `compact` is True, `CompactJobDef` are generated instead, whose params are stored in a table
+   shared by all the jobs (`render` is ignored, the sbatch scripts are always rendered on demand).
+   If `unique_names` is False, duplicate job names are not checked here (see `autoexperiment.validation`,
+   which reports all the problems of the jobs at once).
+   If `where` (dict param name -> predicate, see `parse_param_filter`) is provided, only the jobs whose
+   params match all the predicates are generated. The branches of the config that cannot match are
+   skipped during the expansion, so selecting a few jobs of a large sweep is cheap.
+   """
+   names = set()
+   resolver = ParamResolver()
+   _check_templates(cfg)
+   pruner = _Pruner(cfg, where) if where else None
+   table = ParamTable() if compact else None
+   for vals in _iter_product(cfg, pruner):
       # params will store the key-value pairs
       # of all the variables that can be used
       # in the template
@@ -170,65 +591,292 @@ def generate_job_defs(cfg, verbose=0):
          # last key goes to the actual value
          params[ks[-1]] = v
       # if value of a variable is a template format (e.g., '{dataset}_{lr}') or an expression e.g. 'expr({lr} * 0.001))', 
-      # replace the values by the evaluated expression.
-      # keep doing until no value needs to be evaluated.
-      while True:
-         old_params = params.copy()
-         evaled_params = {k: v for k, v in old_params.items() if not _is_expr(v)}
-         for k in params.keys():
-            
-            # if the value is not a string, we skip it
-            # as we only evaluate strings
-            if type(old_params[k]) != str:
-               continue
-            
-            try:
-               params[k] = old_params[k].format(**evaled_params)
-            except Exception as ex:
-               # exception happens when some variables needed in the template do not exist (yet) in `evaled_params`, or expression is invalid.
-               # Here, we skip the exceptions, as some variables can be later evaled in next iterations,
-               # but we make sure to throw a warning
-               if verbose > 0:
-                  msg = (f"Cannot set value for {old_params[k]}' (Exception: {ex})")
-                  if verbose == 2:
-                     msg += f" with params {evaled_params}"
-                  warnings.warn(msg)
-            
-            # get the (possible) new value of the variable
-            v = params[k]
-            ## evaluate expressions
-            try:
-               if _is_expr(v):
-                  params[k] = _eval_expr(v)
-            except Exception as ex:
-               # exception happens when some variables needed in the template do not exist (yet) in `evaled_params`, or expression is invalid.
-               # Here, we skip the exceptions, as some variables can be later evaled in next iterations,
-               # but we make sure to throw a warning.
-               if verbose > 0:
-                  warnings.warn(f"Cannot set value for '{k}' with expression '{v}' (Exception: {ex})")
-         if old_params == params:
-            break
+      # replace the values by the evaluated expression, in the order given by the dependencies
+      # between the variables.
+      raw_params, params = params, resolver.resolve(params)
+      if where and not all(predicate(params.get(k)) for k, predicate in where.items()):
+         continue
       # at this point, we can use the template file to generate the config file
       # by replacing all the keys from 'params' with their values in the template
       # file.
-      tpl = open(params['template']).read()
-      config = tpl.format(**params)
+      config = _render_template(params) if render and not compact else ""
       # auto generate the name of the job from the full set of params
       # if 'name' is not present in 'params', otherwise just use the value of 'name'
       # from params.
       name = params.get('name', _auto_name(params))
-      # Define the 'JobDef' structure, which is directly used by the manager
-      # to schedule/manaage the jobs
-      jobdef = JobDef(config=config, name=name, params=params)
-      # These are directly used by the manager (e.g. check_interval_secs, name, etc)
-      for field in fields(jobdef):
-         if field.name in params:
-            setattr(jobdef, field.name, params[field.name])
-         elif field.name in MANDATORY_FIELDS:
-            raise ValueError(f"Field '{field.name}' is a not provided, but is MANDATORY")
-      jobs.append(jobdef)
-   _check_name_uniqueness(jobs)
-   return jobs
+      if compact:
+         # the fields used by the manager are read from the params when needed
+         for field in MANDATORY_FIELDS:
+            if field not in params:
+               raise ValueError(f"Field '{field}' is a not provided, but is MANDATORY")
+         # params referencing other params are stored unresolved, when resolving them again gives the same value
+         # (i.e., they are not expressions), as their template is shared by all the jobs while their value is not
+         lazy = [
+            k for k, v in raw_params.items()
+            if type(v) == str and v != params[k] and resolver.parse(v).deps and not _is_expr(v) and v.format(**params) == params[k]
+         ]
+         stored = {k: raw_params[k] if k in lazy else v for k, v in params.items()} if lazy else params
+         jobdef = CompactJobDef(table, table.add(stored, lazy), name)
+      else:
+         # Define the 'JobDef' structure, which is directly used by the manager
+         # to schedule/manaage the jobs
+         jobdef = JobDef(config=config, name=name, params=params)
+         # These are directly used by the manager (e.g. check_interval_secs, name, etc)
+         for field in fields(jobdef):
+            if field.name in params:
+               setattr(jobdef, field.name, params[field.name])
+            elif field.name in MANDATORY_FIELDS:
+               raise ValueError(f"Field '{field.name}' is a not provided, but is MANDATORY")
+      # Check that all job names are unique
+      if unique_names and jobdef.name in names:
+         raise ValueError(f"Job names must be unique. Found duplicates: {[jobdef.name]}")
+      names.add(jobdef.name)
+      yield jobdef
+   if table is not None:
+      table.freeze()
+
+def _render_template(params):
+   """
+   Fill the template file `params['template']` with the params
+   """
+   return template_cache.get(params['template']).render(params)
+
+def _check_templates(cfg):
+   """
+   Warn about the fields of the templates of the config that are not defined by any param.
+   Only templates whose path does not depend on other params can be checked before the sweep.
+   """
+   defined = set()
+   paths = set()
+   _collect_keys_and_templates(cfg, defined, paths)
+   for path in sorted(paths):
+      if not os.path.exists(path):
+         continue
+      undefined = template_cache.get(path).fields - defined
+      if undefined:
+         warnings.warn(f"Template '{path}' references fields that are not defined by any param: {sorted(undefined)}")
+
+def _collect_keys_and_templates(cfg, keys, templates):
+   """
+   collect all the keys of the config (i.e. all the params that can be defined),
+   and the paths of the templates
+   """
+   if type(cfg) == DictConfig:
+      for k, v in cfg.items():
+         keys.add(k)
+         if k == "template":
+            for path in (v if type(v) == ListConfig else [v]):
+               if type(path) == str and not _find_deps(path):
+                  templates.add(path)
+         _collect_keys_and_templates(v, keys, templates)
+   elif type(cfg) == ListConfig:
+      for v in cfg:
+         _collect_keys_and_templates(v, keys, templates)
+
+
+class CompiledTemplate:
+   """
+   A template parsed once into literal text and fields, rendered by filling the fields
+   with the params.
+   """
+   def __init__(self, text):
+      self.text = text
+      # list of (literal text, field name, format spec, conversion)
+      self.segments = []
+      # names of the params used in the template
+      self.fields = set()
+      # templates using advanced formatting (e.g. '{a[0]}', '{a.b}' or '{a:{b}}') are rendered with `str.format`
+      self.simple = True
+      for literal, field_name, format_spec, conversion in Formatter().parse(text):
+         if field_name is not None:
+            root = field_name.split(".", 1)[0].split("[", 1)[0]
+            self.fields.add(root)
+            if root != field_name or not root.isidentifier() or "{" in format_spec:
+               self.simple = False
+         self.segments.append((literal, field_name, format_spec, conversion))
+
+   def render(self, params):
+      if not self.simple:
+         return self.text.format(**params)
+      out = []
+      for literal, field_name, format_spec, conversion in self.segments:
+         out.append(literal)
+         if field_name is not None:
+            value = params[field_name]
+            if conversion == "r":
+               value = repr(value)
+            elif conversion == "s":
+               value = str(value)
+            elif conversion == "a":
+               value = ascii(value)
+            out.append(format(value, format_spec))
+      return "".join(out)
+
+
+class TemplateCache:
+   """
+   Cache of compiled templates, keyed by path and modification time, so that
+   each template file is read and parsed only once per sweep.
+   The modification time of a cached template is checked at most every `check_interval_secs`.
+   """
+   def __init__(self, check_interval_secs=1):
+      self.check_interval_secs = check_interval_secs
+      # path -> (mtime, last time mtime was checked, CompiledTemplate)
+      self._templates = {}
+
+   def get(self, path):
+      entry = self._templates.get(path)
+      now = time.time()
+      if entry is not None:
+         mtime, checked_at, tpl = entry
+         if now - checked_at < self.check_interval_secs:
+            return tpl
+         if os.stat(path).st_mtime_ns == mtime:
+            self._templates[path] = (mtime, now, tpl)
+            return tpl
+      mtime = os.stat(path).st_mtime_ns
+      with open(path) as f:
+         tpl = CompiledTemplate(f.read())
+      self._templates[path] = (mtime, now, tpl)
+      return tpl
+
+template_cache = TemplateCache()
+
+
+@dataclass
+class ParsedValue:
+   # names of the params referenced by the value, e.g. {'dataset', 'lr'} for '{dataset}_{lr}'
+   deps: frozenset = frozenset()
+   # whether the value is an expression, e.g. 'expr({lr} * 0.001)'
+   is_expr: bool = False
+
+   @property
+   def is_dynamic(self):
+      return bool(self.deps) or self.is_expr
+
+
+class ParamResolver:
+   """
+   Resolve the string params of each sweep point that reference other params
+   (e.g., '{dataset}_{lr}') or are expressions (e.g., 'expr({lr} * 0.001)').
+
+   Each distinct string value is parsed only once, and the evaluation order of the
+   params (dependencies first) is computed only once for each distinct structure of
+   sweep point, so that each point is then resolved in a single pass.
+
+   Placeholders that are not valid param names (e.g. '{0000000..0139827}' or awk's '{print $1}'),
+   as well as values with unbalanced braces, are left as is.
+   Raises ValueError if a param references a param that does not exist, or if there is a
+   cycle between the params.
+   """
+   def __init__(self):
+      # string value -> ParsedValue
+      self._parsed = {}
+      # structure of a sweep point -> list of (key, ParsedValue) in evaluation order
+      self._orders = {}
+
+   def parse(self, value):
+      parsed = self._parsed.get(value)
+      if parsed is None:
+         parsed = self._parsed[value] = _parse_value(value)
+      return parsed
+
+   def resolve(self, params):
+      """
+      Returns a new dict of params where all the templates and expressions are evaluated
+      """
+      dynamic = tuple((k, v) for k, v in params.items() if type(v) == str and self.parse(v).is_dynamic)
+      signature = (tuple(params), dynamic)
+      order = self._orders.get(signature)
+      if order is None:
+         order = self._orders[signature] = self._build_order(params, dynamic)
+      params = params.copy()
+      for k, parsed in order:
+         v = params[k]
+         try:
+            expression = compile_expr(v) if parsed.is_expr else None
+            if expression is not None and not expression.textual:
+               v = expression.evaluate(params)
+            else:
+               if parsed.deps:
+                  v = v.format(**params)
+               if _is_expr(v):
+                  v = _eval_expr(v)
+         except Exception as ex:
+            raise ValueError(f"Cannot evaluate expression '{params[k]}' of param '{k}' (Exception: {ex})")
+         params[k] = v
+      return params
+
+   def _build_order(self, params, dynamic):
+      """
+      Topological sort of the dynamic params, based on their dependencies
+      """
+      deps = {k: self.parse(v).deps for k, v in dynamic}
+      for k, ds in deps.items():
+         missing = sorted(d for d in ds if d not in params)
+         if missing:
+            raise ValueError(
+               f"Param '{k}' ('{params[k]}') references undefined param(s): {missing}. "
+               "Use '{{' and '}}' to write literal braces."
+            )
+      order = []
+      # 0: not visited, 1: being visited, 2: done
+      status = {}
+      def visit(k, path):
+         if status.get(k) == 2:
+            return
+         if status.get(k) == 1:
+            cycle = path[path.index(k):] + [k]
+            raise ValueError(f"Cycle in the definition of params: {' -> '.join(cycle)}")
+         status[k] = 1
+         for d in sorted(deps[k]):
+            if d in deps:
+               visit(d, path + [k])
+         status[k] = 2
+         order.append((k, self.parse(params[k])))
+      for k, _ in dynamic:
+         visit(k, [])
+      return order
+
+
+def _parse_value(value):
+   """
+   Find the params referenced by a string value, see `ParsedValue`
+   """
+   is_expr = _is_expr(value)
+   try:
+      deps = _find_deps(value)
+   except ValueError:
+      # e.g., unbalanced braces, the value is left as is
+      return ParsedValue(is_expr=is_expr)
+   if deps is None:
+      # e.g., positional placeholders such as '{0000000..0139827}', the value is left as is
+      return ParsedValue(is_expr=is_expr)
+   return ParsedValue(deps=frozenset(deps), is_expr=is_expr)
+
+def _find_deps(value):
+   """
+   Returns the set of param names referenced in a format string, or None if the
+   string cannot be formatted with named params only.
+   """
+   deps = set()
+   for _, field_name, format_spec, _ in Formatter().parse(value):
+      if field_name is None:
+         continue
+      # e.g. 'a.b' or 'a[0]' reference 'a'
+      root = field_name.split(".", 1)[0].split("[", 1)[0]
+      if root == "" or root.isdigit():
+         return None
+      if not root.isidentifier():
+         return None
+      deps.add(root)
+      if format_spec:
+         # format spec can also contain placeholders, e.g. '{lr:.{precision}f}'
+         spec_deps = _find_deps(format_spec)
+         if spec_deps is None:
+            return None
+         deps.update(spec_deps)
+   return deps
 
 
 def _auto_name(params):
@@ -246,16 +894,255 @@ def _is_expr(e):
    return type(e) == str and e.startswith("expr(") and e.endswith(")")
 
 def _eval_expr(e):
+   """
+   Evaluate an expression without placeholders, e.g. 'expr(0.001 * 4)'
+   """
    assert _is_expr(e)
-   start = len("expr(")
-   end = -1
-   return eval(e[start:end])
+   return compile_expr(e, placeholders=False).evaluate({})
 
-def _check_name_uniqueness(jobdefs):
-    """
-    Check that all job names are unique.
-    """
-    names = [jobdef.name for jobdef in jobdefs]
-    if len(names) != len(set(names)):
-        raise ValueError("Job names must be unique. Found duplicates: {}".format(
-            [name for name in set(names) if names.count(name) > 1]))
+
+class ExpressionError(ValueError):
+   """
+   Invalid `expr(...)` param
+   """
+
+
+def _pow(a, b):
+   if type(a) == int and type(b) == int and abs(b) > 10000:
+      raise ValueError(f"exponent too large: {b}")
+   return a ** b
+
+def _mul(a, b):
+   if type(a) == str or type(b) == str:
+      raise TypeError("strings cannot be multiplied")
+   return a * b
+
+_BINARY_OPERATORS = {
+   ast.Add: operator.add,
+   ast.Sub: operator.sub,
+   ast.Mult: _mul,
+   ast.Div: operator.truediv,
+   ast.FloorDiv: operator.floordiv,
+   ast.Mod: operator.mod,
+   ast.Pow: _pow,
+}
+_UNARY_OPERATORS = {
+   ast.UAdd: operator.pos,
+   ast.USub: operator.neg,
+   ast.Not: operator.not_,
+}
+_COMPARISONS = {
+   ast.Eq: operator.eq,
+   ast.NotEq: operator.ne,
+   ast.Lt: operator.lt,
+   ast.LtE: operator.le,
+   ast.Gt: operator.gt,
+   ast.GtE: operator.ge,
+}
+EXPR_FUNCTIONS = {
+   "abs": abs,
+   "min": min,
+   "max": max,
+   "round": round,
+   "int": int,
+   "float": float,
+   "sqrt": math.sqrt,
+   "exp": math.exp,
+   "log": math.log,
+   "log2": math.log2,
+   "log10": math.log10,
+   "ceil": math.ceil,
+   "floor": math.floor,
+}
+EXPR_CONSTANTS = {
+   "pi": math.pi,
+}
+
+
+class Expression:
+   """
+   An `expr(...)` param, e.g. 'expr({lr} * {batch_size} / 256)', compiled once into a tree of functions.
+
+   Only arithmetic (+, -, *, /, //, %, **), comparisons, `and`/`or`/`not`, `x if cond else y`, numbers,
+   strings, the constants of `EXPR_CONSTANTS` and the functions of `EXPR_FUNCTIONS` (or `functions`)
+   are allowed, any other syntax (attributes, subscripts, other names or functions, ...) raises `ExpressionError`.
+
+   Each placeholder (e.g. '{lr}') is a variable bound to the value of the param, string values being
+   parsed as numbers, as if they were written in the expression. Unless `cache` is False (e.g. when the
+   functions read files), the result is cached for each distinct tuple of values of the params, so that
+   a sweep evaluates the expression once per distinct combination.
+
+   Placeholders that cannot be bound to a variable (inside a string literal, with a format spec or a
+   conversion, e.g. '{lr:.3f}', or with an index or attribute) are `textual`: the expression has to be
+   formatted with the params first, then compiled (see `compile_expr`), like before.
+   """
+   max_cache_size = 4096
+
+   def __init__(self, text, placeholders=True, functions=None, cache=True):
+      assert _is_expr(text)
+      self.text = text
+      self.functions = EXPR_FUNCTIONS if functions is None else functions
+      # names of the params referenced by the expression
+      self.names = []
+      self.textual = False
+      # tuple of values of the params -> result
+      self._cache = {} if cache else None
+      source = text[len("expr("):-1]
+      # offsets of the placeholders in the source
+      positions = []
+      if placeholders:
+         try:
+            segments = list(Formatter().parse(source))
+         except ValueError:
+            # e.g., unbalanced braces
+            self.textual = True
+            return
+         parts = []
+         for literal, field_name, format_spec, conversion in segments:
+            parts.append(literal)
+            if field_name is None:
+               continue
+            if format_spec or conversion or not field_name.isidentifier() or keyword.iskeyword(field_name):
+               self.textual = True
+               return
+            positions.append(sum(map(len, parts)))
+            parts.append(field_name)
+            if field_name not in self.names:
+               self.names.append(field_name)
+         source = "".join(parts)
+      indent = len(source) - len(source.lstrip())
+      self.source = source[indent:]
+      positions = [position - indent for position in positions]
+      if positions and _in_string_literal(self.source, positions):
+         self.textual = True
+         return
+      try:
+         tree = ast.parse(self.source, mode="eval")
+      except SyntaxError as ex:
+         raise ExpressionError(f"invalid syntax: {ex.msg}") from None
+      self._evaluate = self._compile(tree.body)
+
+   def evaluate(self, params):
+      """
+      Evaluate the expression with the (resolved) `params`
+      """
+      assert not self.textual
+      args = tuple(_to_value(name, params[name]) for name in self.names)
+      if self._cache is None:
+         return self._evaluate(dict(zip(self.names, args)))
+      try:
+         return self._cache[args]
+      except (KeyError, TypeError):
+         pass
+      value = self._evaluate(dict(zip(self.names, args)))
+      if len(self._cache) >= self.max_cache_size:
+         self._cache.clear()
+      try:
+         self._cache[args] = value
+      except TypeError:
+         # unhashable values
+         pass
+      return value
+
+   def _error(self, node, reason):
+      segment = ast.get_source_segment(self.source, node)
+      return ExpressionError(f"{reason}: '{segment}'")
+
+   def _compile(self, node):
+      """
+      Returns a function of the dict param name -> value, which evaluates `node`
+      """
+      if isinstance(node, ast.Constant) and (node.value is None or type(node.value) in (int, float, bool, str)):
+         value = node.value
+         return lambda env: value
+      if isinstance(node, ast.Name):
+         name = node.id
+         if name in self.names:
+            return lambda env: env[name]
+         if name in EXPR_CONSTANTS:
+            value = EXPR_CONSTANTS[name]
+            return lambda env: value
+         raise self._error(node, f"unknown name, params are referenced as '{{{name}}}'")
+      if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+         op, left, right = _BINARY_OPERATORS[type(node.op)], self._compile(node.left), self._compile(node.right)
+         return lambda env: op(left(env), right(env))
+      if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+         op, operand = _UNARY_OPERATORS[type(node.op)], self._compile(node.operand)
+         return lambda env: op(operand(env))
+      if isinstance(node, ast.BoolOp):
+         values = [self._compile(value) for value in node.values]
+         is_and = isinstance(node.op, ast.And)
+         def bool_op(env):
+            for value in values:
+               result = value(env)
+               if bool(result) != is_and:
+                  return result
+            return result
+         return bool_op
+      if isinstance(node, ast.Compare) and all(type(op) in _COMPARISONS for op in node.ops):
+         ops = [_COMPARISONS[type(op)] for op in node.ops]
+         operands = [self._compile(node.left)] + [self._compile(comparator) for comparator in node.comparators]
+         def compare(env):
+            left = operands[0](env)
+            for op, operand in zip(ops, operands[1:]):
+               right = operand(env)
+               if not op(left, right):
+                  return False
+               left = right
+            return True
+         return compare
+      if isinstance(node, ast.IfExp):
+         test, body, orelse = self._compile(node.test), self._compile(node.body), self._compile(node.orelse)
+         return lambda env: body(env) if test(env) else orelse(env)
+      if isinstance(node, ast.Call):
+         if not isinstance(node.func, ast.Name) or node.func.id not in self.functions:
+            raise self._error(node.func, f"unknown function, allowed functions are {sorted(self.functions)}")
+         if any(isinstance(arg, ast.Starred) for arg in node.args) or any(kw.arg is None for kw in node.keywords):
+            raise self._error(node, "argument unpacking is not allowed")
+         func, args = self.functions[node.func.id], [self._compile(arg) for arg in node.args]
+         kwargs = {kw.arg: self._compile(kw.value) for kw in node.keywords}
+         return lambda env: func(*[arg(env) for arg in args], **{name: arg(env) for name, arg in kwargs.items()})
+      raise self._error(node, f"unsupported syntax ({type(node).__name__})")
+
+
+@lru_cache(maxsize=4096)
+def compile_expr(text, placeholders=True):
+   """
+   Returns the compiled `Expression` of an `expr(...)` param (each distinct expression is compiled once)
+   """
+   return Expression(text, placeholders=placeholders)
+
+def _in_string_literal(source, positions):
+   """
+   whether any of the offsets `positions` of `source` is inside a string literal
+   """
+   line_starts = [0]
+   for line in source.splitlines(keepends=True):
+      line_starts.append(line_starts[-1] + len(line))
+   try:
+      for token in tokenize.generate_tokens(io.StringIO(source).readline):
+         if token.type == tokenize.STRING:
+            start = line_starts[token.start[0] - 1] + token.start[1]
+            end = line_starts[token.end[0] - 1] + token.end[1]
+            if any(start <= position < end for position in positions):
+               return True
+   except (tokenize.TokenError, SyntaxError):
+      # reported when parsing the expression
+      pass
+   return False
+
+def _to_value(name, value):
+   """
+   Value of the param `name` in an expression: string values are parsed as numbers
+   (or booleans), as if they were written in the expression
+   """
+   if type(value) != str:
+      return value
+   for parse in (int, float):
+      try:
+         return parse(value)
+      except ValueError:
+         pass
+   if value in ("True", "False"):
+      return value == "True"
+   raise ValueError(f"param '{name}' ('{value}') is not a number, use quotes to compare it as a string, e.g. '{{{name}}}' == '{value}'")
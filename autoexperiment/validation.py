@@ -0,0 +1,136 @@
+"""
+Pre-flight validation of the jobs of a sweep, before they are built or run.
+
+The jobs are checked in a single pass, with hash indexes for the values that must be unique,
+and all the problems are reported at once (see `validate_job_defs`):
+- collisions: two jobs with the same name, output file or sbatch script (the manager identifies
+  the jobs by name, and detects their termination and freezes from their output file),
+- names that SLURM cannot handle: too long, or containing line breaks,
+- sbatch scripts without `#SBATCH --job-name=<name of the job>` (used to find the jobs in the queue),
+- templates referencing undefined params,
+- unresolved `{placeholders}` left in the sbatch scripts or in the paths of the jobs (only warnings,
+  as they can be intended, e.g. a literal '{{param}}' in a template; shell's `${var}` is ignored).
+"""
+import re
+
+# longer job names are truncated in the SLURM accounting database (sacct)
+MAX_JOB_NAME_LENGTH = 255
+# number of problems shown for each kind of problem
+MAX_SHOWN_PROBLEMS = 10
+
+# e.g. `#SBATCH --job-name=x`, `#SBATCH --job-name x`, `#SBATCH -J x`
+JOB_NAME_RE = re.compile(r"^#SBATCH[ \t]+(?:--job-name(?:=|[ \t]+)|-J[ \t]*)(\S+)", re.MULTILINE)
+UNRESOLVED_RE = re.compile(r"(?<!\$)\{[A-Za-z_][A-Za-z0-9_]*\}")
+
+# fields of the jobs whose values must be unique
+UNIQUE_FIELDS = ("name", "output_file", "sbatch_script")
+
+
+class ValidationError(ValueError):
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"{len(errors)} problem(s) found in the jobs:\n" + "\n".join(_summarize(errors)))
+
+
+class SweepValidator:
+    """
+    Check the jobs one at a time (`add`), collecting the problems, which are then reported
+    at once by `check`.
+    Problems are tuples (kind of problem, message).
+    """
+    def __init__(self, max_name_length=MAX_JOB_NAME_LENGTH):
+        self.max_name_length = max_name_length
+        self.errors = []
+        self.warnings = []
+        # field -> {value: name of the first job with that value}
+        self._owners = {field: {} for field in UNIQUE_FIELDS}
+
+    def add(self, jobdef, sbatch=None):
+        """
+        Check the job `jobdef`, and its rendered sbatch script `sbatch` if given
+        """
+        name = jobdef.name
+        # fields of compact job definitions are resolved at each access, they are read once
+        values = {field: getattr(jobdef, field) for field in UNIQUE_FIELDS}
+        for field, value in values.items():
+            owner = self._owners[field].get(value)
+            if owner is None:
+                self._owners[field][value] = name
+            elif field == "name":
+                self.errors.append(("duplicate name", f"Job names must be unique, found duplicate: '{name}'"))
+                # the other collisions of the job follow from the duplicate name
+                break
+            else:
+                self.errors.append((f"duplicate {field}", f"Jobs '{owner}' and '{name}' have the same {field}: '{value}'"))
+        if len(name) > self.max_name_length:
+            self.errors.append(("name too long", f"Job name '{name}' is longer than {self.max_name_length} characters"))
+        if "\n" in name or "\r" in name:
+            self.errors.append(("invalid name", f"Job name {name!r} contains a line break"))
+        for field in ("output_file", "sbatch_script"):
+            value = values[field]
+            if UNRESOLVED_RE.search(value):
+                self.warnings.append((f"unresolved placeholder in {field}", f"Job '{name}': unresolved placeholder in {field}: '{value}'"))
+        if sbatch is not None:
+            self._check_script(jobdef, sbatch)
+
+    def add_render_error(self, jobdef, ex):
+        self.errors.append(("render error", f"Job '{jobdef.name}': cannot render the template '{jobdef.params.get('template')}' ({type(ex).__name__}: {ex})"))
+
+    def _check_script(self, jobdef, sbatch):
+        match = JOB_NAME_RE.search(sbatch)
+        if match is None:
+            self.errors.append(("missing --job-name", f"Job '{jobdef.name}': please add #SBATCH --job-name={{name}} to the sbatch template"))
+        elif match.group(1).strip("'\"") != jobdef.name:
+            self.errors.append(("wrong --job-name", f"Job '{jobdef.name}': the sbatch script sets --job-name to '{match.group(1)}'"))
+        placeholders = sorted(set(UNRESOLVED_RE.findall(sbatch)))
+        if placeholders:
+            self.warnings.append((
+                "unresolved placeholder in sbatch script",
+                f"Job '{jobdef.name}': unresolved placeholder(s) in the sbatch script: {', '.join(placeholders)}",
+            ))
+
+    def check(self):
+        """
+        Raise `ValidationError` if any error was found, returns the warnings as a list of strings
+        (summarized, see `MAX_SHOWN_PROBLEMS`)
+        """
+        if self.errors:
+            raise ValidationError(self.errors)
+        return _summarize(self.warnings)
+
+
+def validate_job_defs(jobdefs, render=False, max_name_length=MAX_JOB_NAME_LENGTH, on_script=None):
+    """
+    Check the jobs `jobdefs`, and if `render` is True, their sbatch scripts as well.
+    `on_script(jobdef, sbatch)` is called with each rendered sbatch script, if given (e.g., to avoid rendering them again).
+    Raise `ValidationError` listing all the errors, returns the warnings (list of strings).
+    """
+    validator = SweepValidator(max_name_length=max_name_length)
+    for jobdef in jobdefs:
+        sbatch = None
+        if render:
+            try:
+                sbatch = jobdef.render()
+            except (KeyError, IndexError, AttributeError, ValueError) as ex:
+                validator.add_render_error(jobdef, ex)
+            else:
+                if on_script is not None:
+                    on_script(jobdef, sbatch)
+        validator.add(jobdef, sbatch)
+    return validator.check()
+
+
+def _summarize(problems):
+    """
+    Group the problems by kind, showing at most `MAX_SHOWN_PROBLEMS` of each kind
+    """
+    by_kind = {}
+    for kind, message in problems:
+        by_kind.setdefault(kind, []).append(message)
+    lines = []
+    for kind, messages in by_kind.items():
+        lines.extend(f"- {message}" for message in messages[:MAX_SHOWN_PROBLEMS])
+        if len(messages) > MAX_SHOWN_PROBLEMS:
+            lines.append(f"- ... and {len(messages) - MAX_SHOWN_PROBLEMS} more job(s) with: {kind}")
+    return lines
@@ -0,0 +1,141 @@
+"""
+Event-driven monitoring of the output files of the jobs.
+
+If `watchdog` is installed, file-change events (inotify on Linux) are used to wake up
+the jobs as soon as their output file is written. Since network filesystems (e.g., NFS, Lustre)
+usually do not deliver events for writes done on other nodes, the files are also polled
+periodically, so events only make the detection faster.
+"""
+import asyncio
+import os
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class OutputWatcher:
+    """
+    Notify the jobs when their output file changes, see `wait_for_change`.
+
+    Changes are detected with file-change events (if `use_events` and `watchdog` is installed),
+    and by polling (inode, size, mtime) of all the watched files every `poll_interval_secs`.
+    """
+    def __init__(self, poll_interval_secs=5, use_events=True, verbose=0):
+        self.poll_interval_secs = poll_interval_secs
+        self.use_events = use_events and Observer is not None
+        self.verbose = verbose
+        # absolute path -> asyncio.Event, set when the file changes
+        self.events = {}
+        # absolute path -> last (inode, size, mtime) seen by the poller
+        self.stats = {}
+        self.watched_dirs = set()
+        self.observer = None
+        self.poller = None
+        self.loop = None
+
+    def start(self):
+        """
+        Start watching, must be called from the event loop
+        """
+        self.loop = asyncio.get_event_loop()
+        if self.use_events:
+            self.observer = Observer()
+            self.observer.daemon = True
+            self.observer.start()
+        elif self.verbose and Observer is None:
+            print("watchdog is not installed, output files are only polled")
+        self.poller = asyncio.ensure_future(self.poll_forever())
+
+    def stop(self):
+        if self.poller:
+            self.poller.cancel()
+        if self.observer:
+            self.observer.stop()
+
+    def watch(self, path):
+        path = os.path.abspath(path)
+        if path in self.events:
+            return
+        self.events[path] = asyncio.Event()
+        self.stats[path] = _stat(path)
+        directory = os.path.dirname(path)
+        if self.observer and directory not in self.watched_dirs and os.path.isdir(directory):
+            try:
+                self.observer.schedule(_EventHandler(self), directory, recursive=False)
+                self.watched_dirs.add(directory)
+            except OSError as ex:
+                # e.g., too many inotify watches, the directory is still polled
+                if self.verbose:
+                    print(f"Cannot watch '{directory}' for changes: {ex}")
+
+    def unwatch(self, path):
+        path = os.path.abspath(path)
+        self.events.pop(path, None)
+        self.stats.pop(path, None)
+
+    async def wait_for_change(self, path, timeout=None):
+        """
+        Wait until the file `path` changes, or `timeout` secs.
+        Returns True if the file changed (including since the previous call).
+        """
+        event = self.events[os.path.abspath(path)]
+        if not event.is_set():
+            try:
+                await asyncio.wait_for(event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return False
+        event.clear()
+        return True
+
+    async def poll_forever(self):
+        while True:
+            await asyncio.sleep(self.poll_interval_secs)
+            # stat can be slow on network filesystems, do not block the event loop
+            changed = await self.loop.run_in_executor(None, self._poll)
+            for path in changed:
+                self._notify(path)
+
+    def _poll(self):
+        changed = []
+        for path, prev in list(self.stats.items()):
+            st = _stat(path)
+            if st != prev:
+                self.stats[path] = st
+                changed.append(path)
+        return changed
+
+    def _notify(self, path):
+        event = self.events.get(path)
+        if event is not None:
+            event.set()
+
+    def _on_event(self, path):
+        # called from the thread of the observer
+        if path in self.events:
+            self.loop.call_soon_threadsafe(self._notify, path)
+
+
+class _EventHandler(FileSystemEventHandler):
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        self.watcher._on_event(os.path.abspath(event.src_path))
+        dest_path = getattr(event, "dest_path", None)
+        if dest_path:
+            self.watcher._on_event(os.path.abspath(dest_path))
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
@@ -35,6 +35,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={'watch': ['watchdog']},
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
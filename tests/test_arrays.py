@@ -0,0 +1,166 @@
+"""Tests for the submission of jobs as job arrays."""
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from autoexperiment.arrays import ARRAYS_FILENAME, ArrayBuilder, expand_job_ids, format_indices, get_resources, load_array_tasks
+from autoexperiment.backends import SchedulerError
+from autoexperiment.manager import ArraySubmitter
+
+SBATCH = """#!/bin/bash
+#SBATCH --job-name={name}
+#SBATCH --output=out/{name}.out
+#SBATCH --nodes={nodes}
+#SBATCH --time=01:00:00
+srun python train.py
+"""
+
+
+def make_job(script_dir, name, nodes=1):
+    sbatch_script = os.path.join(script_dir, f"{name}.sbatch")
+    jobdef = SimpleNamespace(
+        name=name,
+        sbatch_script=sbatch_script,
+        output_file=f"out/{name}.out",
+        cmd=f"sbatch {sbatch_script}",
+        params={"template": "template.sbatch"},
+    )
+    return jobdef, SBATCH.format(name=name, nodes=nodes)
+
+
+def build(script_dir, names, max_array_size=1000, nodes=None):
+    # the directory of the sbatch scripts, created by `build`
+    os.makedirs(script_dir, exist_ok=True)
+    builder = ArrayBuilder(max_array_size=max_array_size)
+    jobdefs = []
+    for name in names:
+        jobdef, sbatch = make_job(script_dir, name, (nodes or {}).get(name, 1))
+        assert builder.add(jobdef, sbatch)
+        jobdefs.append(jobdef)
+    builder.write()
+    return {name: (task.name, task.index) for name, task in load_array_tasks(jobdefs).items()}
+
+
+@pytest.mark.parametrize("indices, formatted", [
+    ([0, 1, 2, 5], "0-2,5"),
+    ([5, 0, 2, 1, 1], "0-2,5"),
+    ([3], "3"),
+    ([0, 2, 4], "0,2,4"),
+    ([], ""),
+])
+def test_format_indices(indices, formatted):
+    assert format_indices(indices) == formatted
+
+
+@pytest.mark.parametrize("job_id, job_ids", [
+    ("123", ["123"]),
+    ("123_4", ["123_4"]),
+    ("123_[0-2,5]", ["123_0", "123_1", "123_2", "123_5"]),
+    ("123_[0-3%2]", ["123_0", "123_1", "123_2", "123_3"]),
+    ("123_[1-7:3]", ["123_1", "123_4", "123_7"]),
+    ("123_[8]", ["123_8"]),
+])
+def test_expand_job_ids(job_id, job_ids):
+    assert expand_job_ids(job_id) == job_ids
+
+
+def test_get_resources():
+    assert get_resources(SBATCH.format(name="a", nodes=2)) == ("#SBATCH --nodes=2", "#SBATCH --time=01:00:00")
+
+
+def test_custom_commands_are_not_arrays(tmp_path):
+    jobdef, sbatch = make_job(str(tmp_path), "a")
+    jobdef.cmd = f"sbatch --dependency=singleton {jobdef.sbatch_script}"
+    assert not ArrayBuilder().add(jobdef, sbatch)
+
+
+def test_jobs_grouped_by_resources(tmp_path):
+    tasks = build(str(tmp_path), ["a", "b", "c"], nodes={"c": 2})
+    assert tasks["a"][0] == tasks["b"][0] != tasks["c"][0]
+    assert (tasks["a"][1], tasks["b"][1], tasks["c"][1]) == (0, 1, 0)
+
+
+def test_max_array_size(tmp_path):
+    tasks = build(str(tmp_path), ["a", "b", "c"], max_array_size=2)
+    assert tasks["a"][0] == tasks["b"][0] != tasks["c"][0]
+    assert tasks["c"][1] == 0
+
+
+def test_arrays_are_stable_across_builds(tmp_path):
+    script_dir = str(tmp_path)
+    first = build(script_dir, ["a", "b", "c", "d"], max_array_size=3)
+    # b is removed and e is added: the other jobs keep their array and index, e gets a new index
+    second = build(script_dir, ["a", "c", "d", "e"], max_array_size=3)
+    assert {name: second[name] for name in "acd"} == {name: first[name] for name in "acd"}
+    assert second["e"] == (first["d"][0], 1)
+    with open(os.path.join(script_dir, f"{first['a'][0]}.tasks")) as f:
+        lines = f.read().split("\n")
+    # the index of b is not reused
+    assert lines[1] == "\t"
+
+
+def test_arrays_without_tasks_anymore(tmp_path):
+    script_dir = str(tmp_path)
+    first = build(script_dir, ["a", "b"], nodes={"b": 2})
+    # the array of b has no task anymore
+    assert build(script_dir, ["a"]) == {"a": first["a"]}
+    with open(os.path.join(script_dir, f"{first['b'][0]}.tasks")) as f:
+        assert f.read() == "\t\n"
+    # the same jobs, with a custom submission command: there is no array anymore in the directory
+    builder = ArrayBuilder()
+    jobdef, sbatch = make_job(script_dir, "a")
+    jobdef.cmd = f"sbatch --dependency=singleton {jobdef.sbatch_script}"
+    assert not builder.add(jobdef, sbatch)
+    assert builder.write() == 0
+    assert not os.path.exists(os.path.join(script_dir, ARRAYS_FILENAME))
+    assert load_array_tasks([jobdef]) == {}
+    with open(os.path.join(script_dir, f"{first['a'][0]}.tasks")) as f:
+        assert f.read() == "\t\n"
+    # the indices are not reused
+    assert build(script_dir, ["c", "a"]) == {"c": (first["a"][0], 1), "a": (first["a"][0], 2)}
+
+
+def test_array_names_do_not_depend_on_the_jobs(tmp_path):
+    first = build(str(tmp_path / "first"), ["a", "b"])
+    second = build(str(tmp_path / "second"), ["c"])
+    assert first["a"][0] == second["c"][0]
+
+
+def test_submit_batch():
+    class Backend:
+        calls = []
+
+        async def submit_array(self, script, indices):
+            self.calls.append((script, indices))
+            return "42"
+
+    async def main():
+        submitter = ArraySubmitter(Backend(), delay_secs=0.01)
+        tasks = [SimpleNamespace(script="array_0.sbatch", index=index) for index in (0, 2)]
+        return await asyncio.gather(*(submitter.submit(task) for task in tasks))
+
+    assert asyncio.run(main()) == ["42_0", "42_2"]
+    assert Backend.calls == [("array_0.sbatch", [0, 2])]
+
+
+@pytest.mark.parametrize("error, result", [(SchedulerError("sbatch: error: invalid partition"), None), (ValueError("Cannot parse the job id"), ValueError)])
+def test_failed_submit_batch(error, result):
+    class Backend:
+        async def submit_array(self, script, indices):
+            raise error
+
+    async def main():
+        submitter = ArraySubmitter(Backend(), delay_secs=0.01)
+        tasks = [SimpleNamespace(script="array_0.sbatch", index=index) for index in (0, 1)]
+        results = await asyncio.wait_for(asyncio.gather(*(submitter.submit(task) for task in tasks), return_exceptions=True), timeout=1)
+        assert submitter.pending == {}
+        return results
+
+    results = asyncio.run(main())
+    if result is None:
+        # the tasks are submitted again later
+        assert results == [None, None]
+    else:
+        assert all(isinstance(r, result) for r in results)
@@ -0,0 +1,101 @@
+"""Tests for the scheduler backends: the parsing of the snapshots of `squeue`, and the simulated cluster."""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from autoexperiment.backends import parse_queue_snapshot
+from autoexperiment.simulator import SIM_PENDING, SIM_RUNNING, SimulatedBackend
+
+
+def test_parse_queue_snapshot():
+    data = "\n".join([
+        "12|train_a|RUNNING",
+        # names can contain '|'
+        "13|a|b|PENDING",
+        "",
+        # pending tasks of a job array are grouped
+        "14_[0-2,5%2]|array_0123456789ab_0|PENDING",
+        "14_3|array_0123456789ab_0|RUNNING  ",
+    ])
+    states, names = parse_queue_snapshot(data)
+    assert states == {"12": "RUNNING", "13": "PENDING", "14_0": "PENDING", "14_1": "PENDING", "14_2": "PENDING", "14_5": "PENDING", "14_3": "RUNNING"}
+    assert names["13"] == "a|b"
+    assert names["14_5"] == "array_0123456789ab_0"
+    assert parse_queue_snapshot("") == ({}, {})
+
+
+def make_job(tmp_path, name):
+    return SimpleNamespace(name=name, output_file=str(tmp_path / f"{name}.out"))
+
+
+def test_simulated_jobs_run_until_finished(tmp_path):
+    backend = SimulatedBackend(queue_delay_secs=0.02, run_secs=0.05, write_interval_secs=0.01)
+    job = make_job(tmp_path, "a")
+
+    async def main():
+        job_id = await backend.submit(job)
+        assert (await backend.query_many())[0] == {job_id: SIM_PENDING}
+        await asyncio.sleep(0.03)
+        assert (await backend.query_many())[0] == {job_id: SIM_RUNNING}
+        assert await backend.lookup_by_name(["a", "b"]) == {"a": [job_id]}
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+            backend.step()
+        return await backend.query_many()
+
+    assert asyncio.run(main()) == ({}, {})
+    lines = open(job.output_file).read().splitlines()
+    assert lines[0].startswith("Job ") and lines[-1] == "FINISHED JOB"
+    # `lookup_by_name` queries the whole queue as well
+    assert backend.stats() == {"calls": {"submit": 1, "query_many": 4}, "events": {}, "finished": 1}
+
+
+def test_simulated_interruptions(tmp_path):
+    backend = SimulatedBackend(queue_delay_secs=0, run_secs=10, time_limit_secs=0.02)
+
+    async def main():
+        job_id = await backend.submit(make_job(tmp_path, "a"))
+        backend.step()
+        assert backend.jobs[job_id].state == SIM_RUNNING
+        time.sleep(0.03)
+        # killed at the time limit, the manager has to resubmit it
+        assert await backend.query_many() == ({}, {})
+        job_id = await backend.submit(make_job(tmp_path, "a"))
+        await backend.cancel([job_id])
+        assert job_id not in backend.jobs
+
+    asyncio.run(main())
+    assert backend.events == {"timeout": 1}
+    assert len(backend.restart_latencies) == 1
+
+
+def test_simulated_hung_jobs(tmp_path):
+    backend = SimulatedBackend(queue_delay_secs=0, run_secs=0.01, write_interval_secs=0, hang_prob=1)
+    job = make_job(tmp_path, "a")
+
+    async def main():
+        job_id = await backend.submit(job)
+        for _ in range(3):
+            time.sleep(0.01)
+            backend.step()
+        # still in the queue, without writing anything
+        return (await backend.query_many())[0][job_id]
+
+    assert asyncio.run(main()) == SIM_RUNNING
+    assert open(job.output_file).read().splitlines() == ["Job 1 started"]
+    assert backend.events == {"hang": 1}
+
+
+def test_simulated_arrays(tmp_path):
+    script = tmp_path / "array_0123456789ab_0.sbatch"
+    (tmp_path / "array_0123456789ab_0.tasks").write_text("".join(f"job{i}\t{tmp_path}/job{i}.out\n" for i in range(4)))
+    backend = SimulatedBackend()
+
+    async def main():
+        array_id = await backend.submit_array(str(script), [1, 3])
+        return array_id, await backend.query_many()
+
+    array_id, (states, names) = asyncio.run(main())
+    assert set(states) == {f"{array_id}_1", f"{array_id}_3"}
+    assert set(names.values()) == {"array_0123456789ab_0"}
+    assert backend.jobs[f"{array_id}_3"].output_file == f"{tmp_path}/job3.out"
@@ -0,0 +1,89 @@
+"""Tests for the helpers of the command line interface."""
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from autoexperiment.cli import MANIFEST_FILENAME, _filter_jobs, _load_manifest, _run_commands, _save_manifest, build
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_run_commands_in_order(capfd, jobs):
+    # the first commands finish last
+    cmds = ["sleep 0.3; echo a", "sleep 0.1; echo b; echo error b >&2", "echo c; exit 3"]
+    assert list(_run_commands(cmds, jobs=jobs, verbose=0)) == [0, 0, 3]
+    out, err = capfd.readouterr()
+    assert out == "a\nb\nc\n"
+    assert err == "error b\n"
+
+
+def test_run_commands_signal(capfd):
+    assert list(_run_commands(["kill -9 $$", "true"], jobs=2, verbose=0)) == [-9, 0]
+
+
+def test_filter_jobs(capfd):
+    jobdefs = [SimpleNamespace(name=f"job{i}", params={"i": i}) for i in range(6)]
+    kept = _filter_jobs(jobdefs, "test {i} -lt 2 || exit $(( {i} < 5 ? 1 : 127 ))", jobs=2)
+    assert [jobdef.name for jobdef in kept] == ["job0", "job1"]
+    out, _ = capfd.readouterr()
+    assert out.splitlines() == [
+        "Filter command kept 2 of 6 job(s).",
+        "  exit code 1: 3 job(s) excluded (job2, job3, job4)",
+        "  exit code 127: 1 job(s) excluded (job5)",
+    ]
+
+
+CONFIG = """
+template: {template}
+sbatch_script: sbatch/{{name}}.sbatch
+output_file: out/{{name}}.out
+cmd: sbatch {{sbatch_script}}
+name: job_{{lr}}
+lr: [{lrs}]
+"""
+
+
+def write_config(tmp_path, lrs):
+    (tmp_path / "config.yaml").write_text(CONFIG.format(template=tmp_path / "template.sbatch", lrs=", ".join(lrs)))
+
+
+def run_build(tmp_path, capsys):
+    build(str(tmp_path / "config.yaml"), fix=[], verbose=1, no_sweep_cache=True)
+    return capsys.readouterr().out.splitlines()
+
+
+def test_manifest(tmp_path):
+    assert _load_manifest(str(tmp_path)) == {}
+    _save_manifest(str(tmp_path), {"a.sbatch": "1234"})
+    assert os.path.exists(tmp_path / MANIFEST_FILENAME)
+    assert _load_manifest(str(tmp_path)) == {"a.sbatch": "1234"}
+
+
+def test_build_only_writes_changed_scripts(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "template.sbatch").write_text("#!/bin/bash\n#SBATCH --job-name={name}\necho {lr}\n")
+    write_config(tmp_path, ["0.1", "0.2"])
+    assert run_build(tmp_path, capsys)[-1] == "2 sbatch script(s) written, 0 unchanged, 0 orphan(s)."
+    assert sorted(_load_manifest("sbatch")) == ["job_0.1.sbatch", "job_0.2.sbatch"]
+    mtime = os.stat("sbatch/job_0.1.sbatch").st_mtime_ns
+    assert run_build(tmp_path, capsys)[-1] == "0 sbatch script(s) written, 2 unchanged, 0 orphan(s)."
+    assert os.stat("sbatch/job_0.1.sbatch").st_mtime_ns == mtime
+    # edited by hand, the manifest is unchanged
+    with open("sbatch/job_0.2.sbatch", "a") as f:
+        f.write("echo edited\n")
+    assert run_build(tmp_path, capsys)[-1] == "1 sbatch script(s) written, 1 unchanged, 0 orphan(s)."
+    assert "edited" not in open("sbatch/job_0.2.sbatch").read()
+
+
+def test_build_reports_orphans(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "template.sbatch").write_text("#!/bin/bash\n#SBATCH --job-name={name}\necho {lr}\n")
+    write_config(tmp_path, ["0.1", "0.2", "0.3"])
+    run_build(tmp_path, capsys)
+    os.remove("sbatch/job_0.3.sbatch")
+    write_config(tmp_path, ["0.1"])
+    out = run_build(tmp_path, capsys)
+    assert "Orphan sbatch script, not generated by this build: 'sbatch/job_0.2.sbatch'" in out
+    assert out[-1] == "0 sbatch script(s) written, 1 unchanged, 1 orphan(s)."
+    # the scripts removed are forgotten, the orphans are kept
+    assert sorted(_load_manifest("sbatch")) == ["job_0.1.sbatch", "job_0.2.sbatch"]
@@ -0,0 +1,76 @@
+"""Tests for `CommandRunner`."""
+import asyncio
+import os
+import time
+from subprocess import CalledProcessError, TimeoutExpired
+
+import pytest
+
+from autoexperiment.manager import CommandRunner
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # killed processes can stay zombies until their new parent reaps them
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_output_and_return_codes():
+    async def main():
+        runner = CommandRunner()
+        assert await runner.run("echo a; exit 3") == (3, b"a\n")
+        assert await runner.check_output("echo b") == b"b\n"
+        assert await runner.call("false") == 1
+        with pytest.raises(CalledProcessError):
+            await runner.check_output("exit 2")
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("cancel", [False, True])
+def test_timeout_kills_the_process_group(tmp_path, monkeypatch, cancel):
+    killed = []
+    killpg = os.killpg
+
+    def record_killpg(pgid, sig):
+        killed.append(pgid)
+        killpg(pgid, sig)
+
+    monkeypatch.setattr(os, "killpg", record_killpg)
+    pid_file = tmp_path / "pid"
+
+    async def main():
+        runner = CommandRunner(timeout_secs=None if cancel else 0.2)
+        # the shell waits for a child, which has to be killed as well
+        task = asyncio.ensure_future(runner.run(f"sleep 30 & echo $! > {pid_file}; wait"))
+        if cancel:
+            await asyncio.sleep(0.2)
+            task.cancel()
+        with pytest.raises(asyncio.CancelledError if cancel else TimeoutExpired):
+            await task
+
+    asyncio.run(main())
+    assert len(killed) == 1
+    child_pid = int(pid_file.read_text())
+    for _ in range(50):
+        if not is_running(child_pid):
+            break
+        time.sleep(0.01)
+    assert not is_running(child_pid)
+
+
+def test_max_concurrent(tmp_path):
+    running = tmp_path / "running"
+    running.mkdir()
+    counts = tmp_path / "counts"
+    cmd = f"touch {running}/$$; ls {running} | wc -l >> {counts}; sleep 0.1; rm {running}/$$"
+
+    async def main():
+        runner = CommandRunner(max_concurrent=2)
+        return await asyncio.gather(*[runner.call(cmd) for _ in range(6)])
+
+    assert asyncio.run(main()) == [0] * 6
+    assert max(int(count) for count in counts.read_text().split()) == 2
@@ -0,0 +1,32 @@
+"""Tests for the built-in conditions."""
+import pytest
+
+from autoexperiment.conditions import evaluate_builtin
+
+
+def test_builtin_conditions(tmp_path):
+    checkpoints = tmp_path / "checkpoints"
+    checkpoints.mkdir()
+    for name in ("epoch_1.pt", "epoch_2.pt", "imagenet1k.json"):
+        (checkpoints / name).write_text("")
+    (tmp_path / "job.out").write_text("epoch 1\nloss: 0.5\nepoch 2\n")
+    assert evaluate_builtin(f' count("{checkpoints}/*.pt") - count("{checkpoints}/*.json") > 0') == 1
+    assert evaluate_builtin(f'count("{tmp_path}/**/*.pt")') == 2
+    assert evaluate_builtin(f'exists("{tmp_path}/job.out") and not exists("{tmp_path}/missing")') == 1
+    assert evaluate_builtin(f'lines("{tmp_path}/job.out", regex="^epoch")') == 2
+    assert evaluate_builtin(f'max(lines("{tmp_path}/missing"), 1)') == 1
+
+
+@pytest.mark.parametrize("expr", [
+    "__import__('os').system('true')",
+    "().__class__.__bases__[0].__subclasses__()",
+    "count.__globals__",
+    "open('/etc/passwd')",
+    "eval('1')",
+    "sqrt(4)",
+    "count(*['*'])",
+    "[1 for _ in 'a']",
+])
+def test_builtin_conditions_are_restricted(expr):
+    with pytest.raises(ValueError, match="Cannot evaluate built-in condition"):
+        evaluate_builtin(expr)
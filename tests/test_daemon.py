@@ -0,0 +1,207 @@
+"""Tests for the control API of the daemon."""
+import asyncio
+import os
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+from autoexperiment.backends import SchedulerError
+from autoexperiment.daemon import JOB_PAUSED, ControlError, Daemon, _check_socket, send_command
+
+
+def make_daemon(socket_path, **kwargs):
+    return Daemon("config.yaml", load_job_defs=list, build_job_defs=lambda jobdefs: None, socket_path=socket_path, verbose=0, **kwargs)
+
+
+def control(tmp_path, requests, **kwargs):
+    """Send `requests` (list of (cmd, args)) to a daemon serving its control API, returns the results or errors"""
+    socket_path = str(tmp_path / "daemon.sock")
+
+    async def main():
+        daemon = make_daemon(socket_path, **kwargs)
+        daemon.lock = asyncio.Lock()
+        server = await asyncio.start_unix_server(daemon._handle_client, path=socket_path)
+        results = []
+        try:
+            for cmd, args in requests:
+                try:
+                    results.append(await send_command(socket_path, cmd, args))
+                except ControlError as ex:
+                    results.append(ex)
+        finally:
+            server.close()
+        return results
+
+    return asyncio.run(main())
+
+
+def test_status_and_set(tmp_path):
+    status, limits = control(tmp_path, [("status", []), ("set", ["max_jobs=4", "max_nodes=none"])], max_jobs=2, max_nodes=8)
+    assert (status["jobs"], status["max_jobs"], status["max_nodes"]) == (0, 2, 8)
+    assert limits == {"max_jobs": 4, "max_nodes": None}
+
+
+@pytest.mark.parametrize("cmd, args, error", [
+    ("status", ["model"], "AssertionError: Invalid param format"),
+    ("set", ["max_jobs=many"], "Invalid value for max_jobs: 'many'"),
+    ("set", ["max_time=1"], "Cannot set 'max_time'"),
+    ("add", [], "add requires at least one filter"),
+    ("restart", [], "Unknown command 'restart'"),
+    ("remove", ["model~("], "error:"),
+])
+def test_errors_are_returned(tmp_path, cmd, args, error):
+    result, status = control(tmp_path, [(cmd, args), ("status", [])])
+    assert isinstance(result, ControlError)
+    assert error in str(result)
+    # the daemon is still serving
+    assert status["jobs"] == 0
+
+
+def test_invalid_request(tmp_path):
+    socket_path = str(tmp_path / "daemon.sock")
+
+    async def main():
+        server = await asyncio.start_unix_server(make_daemon(socket_path)._handle_client, path=socket_path)
+        try:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+            writer.write(b"status\n")
+            response = await reader.readline()
+            writer.close()
+        finally:
+            server.close()
+        return response
+
+    assert b'"ok": false' in asyncio.run(main())
+
+
+def test_reloads_are_serialized(tmp_path):
+    class CountingDaemon(Daemon):
+        running = max_running = 0
+
+        async def _reload(self, force=False):
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(0.01)
+            self.running -= 1
+
+    async def main():
+        daemon = CountingDaemon("config.yaml", list, lambda jobdefs: None, str(tmp_path / "daemon.sock"))
+        daemon.lock = asyncio.Lock()
+        await asyncio.gather(daemon.reload(), daemon.execute("reload", []), daemon.reload())
+        return daemon.max_running
+
+    assert asyncio.run(main()) == 1
+
+
+class Backend:
+    """Scheduler that cannot be reached while `down`"""
+    def __init__(self):
+        self.down = False
+        self.calls = 0
+        self.cancelled = []
+
+    async def lookup_by_name(self, names):
+        self.calls += 1
+        if self.down:
+            raise SchedulerError("squeue failed")
+        return {}
+
+    async def cancel(self, job_ids):
+        self.cancelled.extend(job_ids)
+
+
+class Watcher:
+    def __init__(self):
+        self.watched = set()
+
+    def watch(self, path):
+        self.watched.add(path)
+
+    def unwatch(self, path):
+        self.watched.discard(path)
+
+
+def make_managed_daemon(tmp_path, names):
+    """A daemon managing the jobs `names`, with a manager watching their output files until they are cancelled"""
+    jobdefs = [SimpleNamespace(name=name, params={"name": name}, output_file=str(tmp_path / f"{name}.out")) for name in names]
+    daemon = Daemon("config.yaml", lambda: jobdefs, lambda jobdefs: None, str(tmp_path / "daemon.sock"), verbose=0)
+    daemon.reconcile_retry_secs = 0
+    daemon.lock = asyncio.Lock()
+    watcher = Watcher()
+
+    async def manage(jobdef, existing_job_id=None):
+        watcher.watch(jobdef.output_file)
+        await asyncio.Event().wait()
+
+    daemon.manager = SimpleNamespace(backend=Backend(), watcher=watcher, store=None, records={}, manage=manage)
+    return daemon
+
+
+def test_scheduler_errors_are_returned(tmp_path):
+    async def main():
+        daemon = make_managed_daemon(tmp_path, ["a", "b"])
+        backend = daemon.manager.backend
+        backend.down = True
+        # the jobs cannot be started, the reload fails instead of retrying forever
+        with pytest.raises(SchedulerError):
+            await daemon.reload()
+        assert backend.calls == daemon.reconcile_attempts
+        assert daemon.unstarted == {"a", "b"} and daemon.tasks == {}
+        with pytest.raises(SchedulerError):
+            await daemon.execute("remove", ["name=a"])
+        # the other commands are not blocked
+        assert daemon.status()["jobs_per_state"] == {"starting": 2}
+        # the jobs are started by the next reload
+        backend.down = False
+        await daemon.reload()
+        assert daemon.unstarted == set()
+        assert set(daemon.tasks) == {"b"}
+        for task in daemon.tasks.values():
+            task.cancel()
+
+    asyncio.run(main())
+
+
+def test_paused_jobs_are_unwatched(tmp_path):
+    async def main():
+        daemon = make_managed_daemon(tmp_path, ["a", "b"])
+        watched = daemon.manager.watcher.watched
+        await daemon.reload()
+        await asyncio.sleep(0)
+        assert len(watched) == 2
+        assert await daemon.execute("pause", ["name=a"]) == {"paused": ["a"]}
+        assert watched == {str(tmp_path / "b.out")}
+        assert daemon.status(["name=a"])["states"] == {"a": JOB_PAUSED}
+        await daemon.execute("resume", ["name=a"])
+        await asyncio.sleep(0)
+        assert len(watched) == 2
+        for task in daemon.tasks.values():
+            task.cancel()
+
+    asyncio.run(main())
+
+
+def test_check_socket(tmp_path):
+    socket_path = str(tmp_path / "daemon.sock")
+
+    async def main():
+        # no socket
+        await _check_socket(socket_path)
+        server = await asyncio.start_unix_server(lambda reader, writer: writer.close(), path=socket_path)
+        try:
+            with pytest.raises(ControlError, match="already listening"):
+                await _check_socket(socket_path)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(main())
+    # socket left by a daemon that was killed
+    socket_path = str(tmp_path / "killed.sock")
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(socket_path)
+    sock.close()
+    assert os.path.exists(socket_path)
+    asyncio.run(_check_socket(socket_path))
+    assert not os.path.exists(socket_path)
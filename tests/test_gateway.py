@@ -0,0 +1,158 @@
+"""Tests for `SubmissionGateway`."""
+import asyncio
+
+import pytest
+
+from autoexperiment.backends import SchedulerError
+from autoexperiment.manager import (
+    SUBMIT_ERROR_JOB,
+    SUBMIT_ERROR_LIMIT,
+    SUBMIT_ERROR_TRANSIENT,
+    SubmissionGateway,
+    classify_submit_error,
+)
+
+TRANSIENT_ERROR = "sbatch: error: Batch job submission failed: Socket timed out on send/recv operation"
+LIMIT_ERROR = "sbatch: error: QOSMaxSubmitJobPerUserLimit, Batch job submission failed: Job violates accounting/QOS policy"
+JOB_ERROR = "sbatch: error: Batch job submission failed: Invalid account or account/partition combination specified"
+
+# (initial delay, maximum delay) of each class of error, small enough for the tests
+BACKOFF_SECS = {SUBMIT_ERROR_TRANSIENT: (0.01, 0.04), SUBMIT_ERROR_LIMIT: (0.05, 0.1)}
+
+
+class FakeBackend:
+    """Backend whose submissions fail with the given errors (None for a success), then succeed"""
+    def __init__(self, errors=(), cancel_error=None):
+        self.errors = list(errors)
+        self.cancel_error = cancel_error
+        self.submitted = []
+        self.cancelled = []
+
+    async def submit(self, job):
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error if isinstance(error, Exception) else SchedulerError(error)
+        self.submitted.append(job)
+        return str(len(self.submitted))
+
+    async def cancel(self, job_ids):
+        if self.cancel_error is not None:
+            raise self.cancel_error
+        self.cancelled.append(list(job_ids))
+
+
+def make_gateway(backend, **kwargs):
+    kwargs.setdefault("backoff_secs", BACKOFF_SECS)
+    return SubmissionGateway(backend, seed=0, **kwargs)
+
+
+@pytest.mark.parametrize("message, error_class", [
+    (TRANSIENT_ERROR, SUBMIT_ERROR_TRANSIENT),
+    ("sbatch: error: Unable to contact slurm controller (connect failure)", SUBMIT_ERROR_TRANSIENT),
+    ("sbatch: error: Slurm temporarily unable to accept job, sleeping and retrying", SUBMIT_ERROR_TRANSIENT),
+    (LIMIT_ERROR, SUBMIT_ERROR_LIMIT),
+    ("sbatch: error: AssocMaxSubmitJobLimit", SUBMIT_ERROR_LIMIT),
+    (JOB_ERROR, SUBMIT_ERROR_JOB),
+    ("", SUBMIT_ERROR_JOB),
+])
+def test_classify_submit_error(message, error_class):
+    assert classify_submit_error(message) == error_class
+
+
+@pytest.mark.parametrize("error, error_class", [(TRANSIENT_ERROR, SUBMIT_ERROR_TRANSIENT), (LIMIT_ERROR, SUBMIT_ERROR_LIMIT)])
+def test_backoff_per_error_class(error, error_class):
+    async def main():
+        backend = FakeBackend([error, error, error])
+        gateway = make_gateway(backend)
+        assert await gateway.submit("job") == "1"
+        return gateway
+
+    gateway = asyncio.run(main())
+    initial_secs, max_secs = BACKOFF_SECS[error_class]
+    # the delay doubled after each failure, up to the maximum, and the pause ended with the success
+    assert gateway.delay_secs == min(initial_secs * 4, max_secs)
+    assert gateway.failures == 0
+
+
+def test_backoff_pauses_all_submissions():
+    async def main():
+        backend = FakeBackend([LIMIT_ERROR])
+        gateway = make_gateway(backend)
+        first = asyncio.ensure_future(gateway.submit("a"))
+        await asyncio.sleep(0.01)
+        # submitted during the pause, waits for its end
+        start = asyncio.get_event_loop().time()
+        assert await gateway.submit("b")
+        elapsed = asyncio.get_event_loop().time() - start
+        await first
+        return backend, elapsed
+
+    backend, elapsed = asyncio.run(main())
+    assert sorted(backend.submitted) == ["a", "b"]
+    assert elapsed >= BACKOFF_SECS[SUBMIT_ERROR_LIMIT][0] - 0.02
+
+
+def test_job_errors_are_not_retried():
+    async def main():
+        backend = FakeBackend([JOB_ERROR])
+        gateway = make_gateway(backend)
+        with pytest.raises(SchedulerError, match="Invalid account"):
+            await gateway.submit("job")
+        assert gateway.paused_until == 0
+        assert await gateway.submit("job") == "1"
+
+    asyncio.run(main())
+
+
+def test_max_attempts():
+    async def main():
+        backend = FakeBackend([TRANSIENT_ERROR] * 3)
+        gateway = make_gateway(backend, max_attempts=2)
+        with pytest.raises(SchedulerError, match="Socket timed out"):
+            await gateway.submit("job")
+        assert backend.errors == [TRANSIENT_ERROR]
+        assert gateway.failures == 2
+
+    asyncio.run(main())
+
+
+def test_failures_in_flight_do_not_increase_the_delay():
+    async def main():
+        backend = FakeBackend([TRANSIENT_ERROR] * 3)
+
+        async def submit(job):
+            # the three submissions are in flight when the first one fails
+            await asyncio.sleep(0.001)
+            return await FakeBackend.submit(backend, job)
+
+        backend.submit = submit
+        gateway = make_gateway(backend)
+        await asyncio.gather(*(gateway.submit(name) for name in "abc"))
+        return backend, gateway
+
+    backend, gateway = asyncio.run(main())
+    assert sorted(backend.submitted) == ["a", "b", "c"]
+    assert gateway.delay_secs == BACKOFF_SECS[SUBMIT_ERROR_TRANSIENT][0]
+
+
+def test_cancellations_are_batched():
+    async def main():
+        backend = FakeBackend()
+        gateway = make_gateway(backend, cancel_delay_secs=0.01, max_cancel_batch=3)
+        await asyncio.gather(gateway.cancel(["1", "2"]), gateway.cancel(["3"]), gateway.cancel(["4", "5"]))
+        return backend
+
+    backend = asyncio.run(main())
+    assert backend.cancelled == [["1", "2", "3"], ["4", "5"]]
+
+
+@pytest.mark.parametrize("error", [SchedulerError("scancel: error: Invalid job id specified"), FileNotFoundError("scancel")])
+def test_failed_cancellations_are_reported(error):
+    async def main():
+        gateway = make_gateway(FakeBackend(cancel_error=error), cancel_delay_secs=0.01)
+        results = await asyncio.wait_for(asyncio.gather(gateway.cancel(["1"]), gateway.cancel(["2"]), return_exceptions=True), timeout=1)
+        assert results == [error, error]
+        assert gateway.pending_cancels == []
+
+    asyncio.run(main())
@@ -0,0 +1,172 @@
+"""Tests for `JobLimitsManager`."""
+import asyncio
+from types import SimpleNamespace
+
+from autoexperiment.manager import JobLimitsManager
+
+
+def make_job(name, priority=0, **params):
+    return SimpleNamespace(name=name, priority=priority, params=params)
+
+
+async def start_waiting(limits, jobs, admitted):
+    """Make `jobs` wait for a slot, in order, the names of the admitted jobs are appended to `admitted`"""
+    tasks = []
+    for job in jobs:
+        task = asyncio.ensure_future(limits.wait_for_slot(job))
+        task.add_done_callback(lambda task, name=job.name: task.cancelled() or admitted.append(name))
+        tasks.append(task)
+    # let them start waiting, and the admitted ones finish
+    for _ in range(2):
+        await asyncio.sleep(0)
+    return tasks
+
+
+async def finish(limits, *names):
+    for name in names:
+        await limits.job_finished(SimpleNamespace(name=name))
+    for _ in range(2):
+        await asyncio.sleep(0)
+
+
+def test_cancelled_waiters_are_not_admitted():
+    async def main():
+        limits = JobLimitsManager(max_jobs=1)
+        a, b, c = make_job("a"), make_job("b"), make_job("c")
+        await limits.wait_for_slot(a)
+        task_b = asyncio.ensure_future(limits.wait_for_slot(b))
+        task_c = asyncio.ensure_future(limits.wait_for_slot(c))
+        await asyncio.sleep(0)
+        # b is admitted, then b and c are cancelled in the same tick (e.g. `ctl pause`)
+        await limits.job_finished(a)
+        task_b.cancel()
+        task_c.cancel()
+        results = await asyncio.gather(task_b, task_c, return_exceptions=True)
+        assert all(isinstance(result, asyncio.CancelledError) for result in results)
+        assert limits.admitted == {}
+        assert limits.jobs_submitted == 0
+        # the slot is free again
+        await asyncio.wait_for(limits.wait_for_slot(make_job("d")), timeout=1)
+        assert list(limits.admitted) == ["d"]
+
+    asyncio.run(main())
+
+
+def test_priority_then_arrival_order():
+    async def main():
+        limits = JobLimitsManager(max_jobs=1)
+        admitted = []
+        await start_waiting(limits, [make_job("first"), make_job("a"), make_job("b", priority=1), make_job("c"), make_job("d", priority=1)], admitted)
+        assert admitted == ["first"]
+        for name in ("first", "b", "d", "a"):
+            await finish(limits, name)
+        assert admitted == ["first", "b", "d", "a", "c"]
+
+    asyncio.run(main())
+
+
+def test_fair_share_between_groups():
+    async def main():
+        limits = JobLimitsManager(max_jobs=2, group_by="mode")
+        admitted = []
+        # the train jobs arrived first, but the eval group uses fewer nodes
+        jobs = [make_job("train0", mode="train", nodes=2), make_job("train1", mode="train"), make_job("train2", mode="train"), make_job("eval0", mode="eval")]
+        await start_waiting(limits, jobs, admitted)
+        assert admitted == ["train0", "train1"]
+        await finish(limits, "train1")
+        assert admitted == ["train0", "train1", "eval0"]
+        await finish(limits, "eval0")
+        assert admitted[-1] == "train2"
+
+    asyncio.run(main())
+
+
+def test_group_quotas_do_not_block_other_groups():
+    async def main():
+        limits = JobLimitsManager(max_jobs=10, group_by="mode", group_quotas={"train": 1})
+        admitted = []
+        await start_waiting(limits, [make_job("train0", mode="train"), make_job("train1", mode="train"), make_job("eval0", mode="eval")], admitted)
+        assert admitted == ["train0", "eval0"]
+        await finish(limits, "eval0")
+        assert admitted == ["train0", "eval0"]
+        await finish(limits, "train0")
+        assert admitted == ["train0", "eval0", "train1"]
+
+    asyncio.run(main())
+
+
+def test_max_nodes_blocks_the_next_jobs():
+    async def main():
+        limits = JobLimitsManager(max_nodes=4)
+        admitted = []
+        # big does not fit, the small jobs after it wait so that it is not starved
+        await start_waiting(limits, [make_job("a", nodes=3), make_job("big", nodes=4), make_job("small", nodes=1)], admitted)
+        assert admitted == ["a"]
+        assert limits.blocked
+        await finish(limits, "a")
+        assert admitted == ["a", "big"]
+        await finish(limits, "big")
+        assert admitted == ["a", "big", "small"]
+        assert limits.nodes_submitted == 1
+
+    asyncio.run(main())
+
+
+def test_job_larger_than_max_nodes_is_admitted_alone():
+    async def main():
+        limits = JobLimitsManager(max_nodes=4)
+        admitted = []
+        await start_waiting(limits, [make_job("huge", nodes=8), make_job("a", nodes=1)], admitted)
+        assert admitted == ["huge"]
+        await finish(limits, "huge")
+        assert admitted == ["huge", "a"]
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_does_not_block():
+    async def main():
+        limits = JobLimitsManager(max_jobs=1)
+        admitted = []
+        tasks = await start_waiting(limits, [make_job("a"), make_job("b", priority=1), make_job("c")], admitted)
+        # the job with the highest priority is removed while waiting
+        tasks[1].cancel()
+        await asyncio.sleep(0)
+        await finish(limits, "a")
+        assert admitted == ["a", "c"]
+        assert list(limits.admitted) == ["c"]
+        assert limits.waiters == {}
+
+    asyncio.run(main())
+
+
+def test_already_submitted_jobs_use_slots():
+    async def main():
+        limits = JobLimitsManager(max_jobs=1)
+        admitted = []
+        # e.g. found in the queue at startup
+        await limits.job_submitted(make_job("existing"))
+        await start_waiting(limits, [make_job("a")], admitted)
+        assert admitted == []
+        await finish(limits, "existing")
+        assert admitted == ["a"]
+
+    asyncio.run(main())
+
+
+def test_update_limits_admits_waiting_jobs():
+    async def main():
+        limits = JobLimitsManager(max_jobs=1)
+        admitted = []
+        await start_waiting(limits, [make_job("a"), make_job("b"), make_job("c")], admitted)
+        assert admitted == ["a"]
+        limits.update_limits(max_jobs=2)
+        for _ in range(2):
+            await asyncio.sleep(0)
+        assert admitted == ["a", "b"]
+        limits.update_limits(max_jobs=None)
+        for _ in range(2):
+            await asyncio.sleep(0)
+        assert admitted == ["a", "b", "c"]
+
+    asyncio.run(main())
@@ -0,0 +1,171 @@
+"""Tests for `LogWatcher`."""
+import asyncio
+import os
+import time
+
+from autoexperiment.manager import WATCH_DONE, WATCH_FROZEN, WATCH_RECHECK, LogWatcher, watch_running_job
+
+
+def append(path, text):
+    with open(path, "a") as f:
+        f.write(text)
+
+
+def test_scan_reads_appended_bytes_only(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    assert not watcher.scan()
+    append(path, "epoch 1\n")
+    assert not watcher.scan()
+    assert watcher.offset == watcher.line_offset == len("epoch 1\n")
+    append(path, "epoch 2\nFINISHED JOB\n")
+    assert watcher.scan()
+    assert watcher.offset == path.stat().st_size
+
+
+def test_termination_str_split_across_scans(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    append(path, "epoch 1\nFINISHED")
+    assert not watcher.scan()
+    # the incomplete line is kept until the rest of it is written
+    assert watcher.line_offset == len("epoch 1\n")
+    append(path, " JOB\n")
+    assert watcher.scan()
+
+
+def test_small_chunks(tmp_path):
+    path = tmp_path / "job.out"
+    append(path, "x" * 100 + "\nFINISHED JOB\n")
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    watcher.chunk_size = 7
+    assert watcher.scan()
+
+
+def test_rotation_by_truncation(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    append(path, "epoch 1\nepoch 2\n")
+    assert not watcher.scan()
+    # the job is restarted and its output file rewritten, smaller than the scanned offset
+    path.write_text("FINISHED JOB\n")
+    assert watcher.scan()
+
+
+def test_rotation_by_rewrite(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    append(path, "run 1: epoch 1\n")
+    assert not watcher.scan()
+    # same size, but different first bytes
+    path.write_text("FINISHED JOB\n\n\n")
+    assert watcher.scan()
+
+
+def test_rotation_by_inode(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    append(path, "epoch 1\n")
+    assert not watcher.scan()
+    inode = watcher.inode
+    new_path = tmp_path / "job.out.new"
+    new_path.write_text("epoch 1\nFINISHED JOB\n")
+    os.replace(new_path, path)
+    assert watcher.scan()
+    assert watcher.inode != inode
+
+
+def test_found_is_forgotten_on_rotation(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    append(path, "FINISHED JOB\n")
+    assert watcher.scan()
+    path.write_text("run 2\n")
+    assert not watcher.scan()
+
+
+def test_restore_position(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    append(path, "epoch 1\nepoch")
+    watcher.scan()
+    position = watcher.position()
+    assert position[1] == len("epoch 1\n")
+    append(path, " 2\nFINISHED JOB\n")
+    restored = LogWatcher(str(path), "FINISHED JOB")
+    restored.restore(*position)
+    assert restored.scan()
+    assert restored.offset == path.stat().st_size
+
+
+def test_restore_position_of_rotated_file(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    append(path, "epoch 1\nepoch 2\nepoch 3\n")
+    watcher.scan()
+    position = watcher.position()
+    path.write_text("FINISHED JOB\n")
+    restored = LogWatcher(str(path), "FINISHED JOB")
+    restored.restore(*position)
+    assert restored.scan()
+
+
+def test_progress(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path))
+    assert watcher.progress() is None
+    append(path, "epoch 1\n")
+    progress = watcher.progress()
+    assert progress == watcher.progress()
+    append(path, "epoch 2\n")
+    assert watcher.progress() != progress
+
+
+def test_progress_changed_at(tmp_path):
+    path = tmp_path / "job.out"
+    watcher = LogWatcher(str(path))
+    append(path, "epoch 1\n")
+    progress = watcher.progress()
+    assert watcher.progress_changed_at(progress, now=10) == 10
+    assert watcher.progress_changed_at(progress, now=20) == 10
+    append(path, "epoch 2\n")
+    assert watcher.progress_changed_at(watcher.progress(), now=30) == 30
+
+
+class OutputWatcher:
+    """No change notification, waits until the timeout"""
+    async def wait_for_change(self, path, timeout=None):
+        await asyncio.sleep(timeout)
+        return False
+
+
+def test_freeze_ignores_the_clock_of_the_file_server(tmp_path):
+    path = tmp_path / "job.out"
+    append(path, "epoch 1\n")
+    # the clock of the file server is one hour late
+    mtime = time.time() - 3600
+    os.utime(path, (mtime, mtime))
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+
+    def watch(running_since):
+        return asyncio.run(watch_running_job(watcher, OutputWatcher(), running_since, freeze_secs=0.2, recheck_secs=0.1))
+
+    assert watch(time.time()) == WATCH_RECHECK
+    # the file was not seen to change for more than `freeze_secs`
+    time.sleep(0.2)
+    assert watch(time.time()) == WATCH_FROZEN
+
+
+class WritingWatcher:
+    """The job writes the termination string, then the change is notified"""
+    async def wait_for_change(self, path, timeout=None):
+        append(path, "FINISHED JOB\n")
+        return True
+
+
+def test_termination_str_found_on_change(tmp_path):
+    path = tmp_path / "job.out"
+    append(path, "epoch 1\n")
+    watcher = LogWatcher(str(path), "FINISHED JOB")
+    result = asyncio.run(watch_running_job(watcher, WritingWatcher(), time.time(), freeze_secs=60, recheck_secs=60))
+    assert result == WATCH_DONE
@@ -0,0 +1,95 @@
+"""Tests for the metrics of the manager, and their Prometheus and JSON outputs."""
+import asyncio
+import json
+
+from autoexperiment.metrics import PREFIX, Metrics
+
+
+def make_metrics():
+    registry = Metrics()
+    registry.inc("job_restarts_total")
+    registry.inc("job_restarts_total", 2)
+    registry.inc("scheduler_errors_total", op="submit")
+    registry.set("event_loop_lag_last_seconds", 0.5)
+    registry.observe("scheduler_call_seconds", 0.002, op="query_many")
+    registry.observe("scheduler_call_seconds", 20, op="query_many")
+    registry.observe("scheduler_call_seconds", 1000, op="query_many")
+    registry.set_job_state("a", "running")
+    registry.set_job_state("b", "running")
+    registry.set_job_state("c", "finished")
+    return registry
+
+
+def test_to_prometheus():
+    lines = make_metrics().to_prometheus().splitlines()
+    assert lines.count(f"# TYPE {PREFIX}job_restarts_total counter") == 1
+    assert f"{PREFIX}job_restarts_total 3" in lines
+    assert f'{PREFIX}scheduler_errors_total{{op="submit"}} 1' in lines
+    assert f"{PREFIX}event_loop_lag_last_seconds 0.5" in lines
+    assert f'{PREFIX}jobs{{state="running"}} 2' in lines
+    assert f"# TYPE {PREFIX}scheduler_call_seconds histogram" in lines
+    # buckets are cumulative
+    assert f'{PREFIX}scheduler_call_seconds_bucket{{op="query_many",le="0.005"}} 1' in lines
+    assert f'{PREFIX}scheduler_call_seconds_bucket{{op="query_many",le="30"}} 2' in lines
+    assert f'{PREFIX}scheduler_call_seconds_bucket{{op="query_many",le="+Inf"}} 3' in lines
+    assert f'{PREFIX}scheduler_call_seconds_count{{op="query_many"}} 3' in lines
+
+
+def test_labels_are_escaped():
+    registry = Metrics()
+    registry.inc("errors_total", cmd='echo "a\\b"\n')
+    assert f'{PREFIX}errors_total{{cmd="echo \\"a\\\\b\\"\\n"}} 1' in registry.to_prometheus().splitlines()
+
+
+def test_json(tmp_path):
+    path = str(tmp_path / "metrics.json")
+    make_metrics().write_json(path)
+    with open(path) as f:
+        data = json.load(f)
+    assert data["jobs_per_state"] == {"running": 2, "finished": 1}
+    assert {"name": "scheduler_errors_total", "labels": {"op": "submit"}, "value": 1} in data["counters"]
+    histogram, = data["histograms"]
+    assert (histogram["count"], histogram["max"], histogram["buckets"]["+Inf"]) == (3, 1000, 1)
+    assert histogram["mean"] == (0.002 + 20 + 1000) / 3
+
+
+def test_merge():
+    registry = make_metrics()
+    worker = Metrics()
+    worker.inc("job_restarts_total", 4)
+    worker.inc("jobs_submitted_total", op="array")
+    worker.set_job_state("d", "running")
+    # the snapshots are sent as JSON by the workers
+    registry.merge(1, json.loads(json.dumps(worker.snapshot())))
+    registry.merge(2, json.loads(json.dumps(worker.snapshot())))
+    worker.inc("job_restarts_total")
+    # the last snapshot of a source replaces the previous one
+    registry.merge(2, json.loads(json.dumps(worker.snapshot())))
+    counters = registry.all_counters()
+    assert counters[("job_restarts_total", ())] == 3 + 4 + 5
+    assert counters[("jobs_submitted_total", (("op", "array"),))] == 2
+    assert registry.jobs_per_state() == {"running": 4, "finished": 1}
+    # the counters of the registry itself are unchanged
+    assert registry.counters[("job_restarts_total", ())] == 3
+    assert f"{PREFIX}job_restarts_total 12" in registry.to_prometheus().splitlines()
+
+
+def test_serve():
+    async def main():
+        registry = make_metrics()
+        server = await registry.serve(0)
+        port = server.sockets[0].getsockname()[1]
+        responses = []
+        try:
+            for path in ("/metrics", "/json"):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(f"GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n".encode())
+                responses.append((await reader.read()).decode())
+                writer.close()
+        finally:
+            server.close()
+        return responses
+
+    prometheus, json_response = asyncio.run(main())
+    assert prometheus.startswith("HTTP/1.0 200 OK") and f"{PREFIX}job_restarts_total 3" in prometheus
+    assert json.loads(json_response.split("\r\n\r\n", 1)[1])["jobs_per_state"] == {"running": 2, "finished": 1}
@@ -0,0 +1,82 @@
+"""Tests for `QueuePoller`, the shared snapshot of the queue."""
+import asyncio
+import time
+
+from autoexperiment.backends import SchedulerError
+from autoexperiment.manager import JOB_STATE_RUNNING, QueuePoller
+
+
+class Backend:
+    """Returns the snapshots `snapshots` (dict job id -> state, or an exception to raise), one per call"""
+    def __init__(self, *snapshots):
+        self.snapshots = list(snapshots)
+
+    async def query_many(self):
+        snapshot = self.snapshots.pop(0)
+        if isinstance(snapshot, Exception):
+            raise snapshot
+        return snapshot, {job_id: f"job{job_id}" for job_id in snapshot}
+
+
+def test_get_state():
+    async def main():
+        queue = QueuePoller(Backend({"1": "PENDING", "2": JOB_STATE_RUNNING}))
+        waiting = asyncio.ensure_future(queue.get_state(1))
+        await asyncio.sleep(0)
+        # no snapshot yet
+        assert not waiting.done()
+        await queue.poll()
+        return await waiting, await queue.get_state("2"), await queue.get_state("3")
+
+    assert asyncio.run(main()) == ("PENDING", JOB_STATE_RUNNING, None)
+
+
+def test_not_before():
+    async def main():
+        queue = QueuePoller(Backend({}, {"1": "PENDING"}))
+        await queue.poll()
+        # e.g. the job was just submitted, the current snapshot may not show it
+        waiting = asyncio.ensure_future(queue.get_state("1", not_before=time.time()))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        await queue.poll()
+        return await asyncio.wait_for(waiting, timeout=1)
+
+    assert asyncio.run(main()) == "PENDING"
+
+
+def test_failed_poll_keeps_the_previous_snapshot():
+    async def main():
+        queue = QueuePoller(Backend({"1": JOB_STATE_RUNNING}, SchedulerError("squeue failed"), {}))
+        await queue.poll()
+        updated_at, started_after = queue.updated_at, queue.get_started_after("1")
+        waiting = asyncio.ensure_future(queue.get_state("1", not_before=time.time()))
+        await queue.poll()
+        await asyncio.sleep(0.01)
+        # the failed poll does not count as a new snapshot
+        assert (queue.updated_at, queue.get_started_after("1")) == (updated_at, started_after)
+        assert await queue.get_state("1") == JOB_STATE_RUNNING
+        assert not waiting.done()
+        await queue.poll()
+        return await asyncio.wait_for(waiting, timeout=1)
+
+    assert asyncio.run(main()) is None
+
+
+def test_started_after():
+    async def main():
+        queue = QueuePoller(Backend({"1": JOB_STATE_RUNNING, "2": "PENDING"}, {"1": JOB_STATE_RUNNING, "2": JOB_STATE_RUNNING}, {"2": "COMPLETING"}))
+        await queue.poll()
+        first_at = queue.updated_at
+        # already running in the first snapshot
+        assert queue.get_started_after("1") == first_at
+        assert queue.get_started_after("2") is None
+        await asyncio.sleep(0.01)
+        await queue.poll()
+        # started between the two snapshots
+        assert queue.get_started_after("1") == queue.get_started_after("2") == first_at
+        assert queue.updated_at > first_at
+        await queue.poll()
+        assert queue.started_after == {}
+
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+"""Tests for `reconcile_jobs`, which finds the SLURM jobs already launched for the jobs."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from autoexperiment.backends import SchedulerBackend, SchedulerError
+from autoexperiment.manager import reconcile_jobs
+
+
+class Backend(SchedulerBackend):
+    """Queue with the jobs `names` (job id -> name), which cannot be reached for the first `failures` calls"""
+    def __init__(self, names, failures=0):
+        self.names = names
+        self.failures = failures
+        self.calls = 0
+
+    async def query_many(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise SchedulerError("squeue failed")
+        return {job_id: "RUNNING" for job_id in self.names}, dict(self.names)
+
+
+def make_job(name, array_task=None):
+    return SimpleNamespace(name=name, array_task=array_task)
+
+
+def test_reconcile_jobs():
+    backend = Backend({"1": "a", "2": "other"})
+    assert asyncio.run(reconcile_jobs([make_job("a"), make_job("b")], backend)) == {"a": "1", "b": None}
+    assert backend.calls == 1
+
+
+def test_duplicate_names(capsys):
+    backend = Backend({"1": "a", "2": "a", "3": "b"})
+    existing_job_ids = asyncio.run(reconcile_jobs([make_job("a"), make_job("b")], backend))
+    # the job is not managed
+    assert existing_job_ids == {"b": "3"}
+    assert "Found duplicate jobs with same name: 'a': ['1', '2']" in capsys.readouterr().out
+
+
+def test_array_tasks(capsys):
+    array = "array_0123456789ab_0"
+    backend = Backend({"10_0": array, "10_2": array, "10_12": array, "11_3": array, "12_3": array})
+    jobs = [make_job(f"job{index}", SimpleNamespace(name=array, index=index)) for index in range(4)]
+    existing_job_ids = asyncio.run(reconcile_jobs(jobs, backend))
+    # matched on the index of the task, e.g. task 2 is not task 12
+    assert existing_job_ids == {"job0": "10_0", "job1": None, "job2": "10_2"}
+    # task 3 is in the queue twice
+    assert "'job3': ['11_3', '12_3']" in capsys.readouterr().out
+
+
+def test_retries():
+    backend = Backend({"1": "a"}, failures=2)
+    assert asyncio.run(reconcile_jobs([make_job("a")], backend, retry_secs=0)) == {"a": "1"}
+    assert backend.calls == 3
+    backend = Backend({"1": "a"}, failures=2)
+    with pytest.raises(SchedulerError):
+        asyncio.run(reconcile_jobs([make_job("a")], backend, max_attempts=2, retry_secs=0))
+    assert backend.calls == 2
@@ -0,0 +1,164 @@
+"""Tests for the sharded manager: the split of the jobs and of the snapshots, and the protocol between the coordinator and the workers."""
+import asyncio
+import socket
+from types import SimpleNamespace
+
+from autoexperiment.manager import JOB_STATE_RUNNING, JobLimitsManager, QueuePoller
+from autoexperiment.sharding import RemoteLimits, RemoteQueue, RemoteStore, ShardClient, ShardCoordinator, get_shard, get_shard_key
+from autoexperiment.store import JOB_RUNNING, JOB_SUBMITTED, StateStore
+
+
+class Backend:
+    def __init__(self, states, names):
+        self.states = states
+        self.names = names
+
+    async def query_many(self):
+        return dict(self.states), dict(self.names)
+
+
+def make_job(name, **params):
+    return SimpleNamespace(name=name, params=params, priority=0)
+
+
+async def settle():
+    # let the messages go through the socket and be handled
+    await asyncio.sleep(0.05)
+
+
+class Connection:
+    """A coordinator serving a single worker (shard 0) in the same event loop"""
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+
+    async def __aenter__(self):
+        parent_sock, child_sock = socket.socketpair()
+        self.serving = asyncio.ensure_future(self.coordinator.serve(0, parent_sock))
+        reader, self.writer = await asyncio.open_connection(sock=child_sock)
+        self.client = ShardClient(reader, self.writer, RemoteQueue())
+        self.reading = asyncio.ensure_future(self.client.read_forever())
+        await settle()
+        return self.client
+
+    async def __aexit__(self, *exc_info):
+        self.reading.cancel()
+        self.writer.close()
+        await asyncio.wait_for(self.serving, timeout=1)
+
+
+def test_get_shard():
+    names = [f"job{i}" for i in range(1000)]
+    shards = [get_shard(name, 4) for name in names]
+    # stable across processes and sessions, see `zlib.crc32`
+    assert shards[:4] == [get_shard(name, 4) for name in names[:4]]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(shards.count(shard) > 200 for shard in range(4))
+    assert get_shard(None, 4) in range(4)
+
+
+def test_tasks_of_an_array_share_a_shard():
+    task = make_job("job1")
+    task.array_task = SimpleNamespace(name="array_0123456789ab_0")
+    assert get_shard_key(task) == "array_0123456789ab_0"
+    assert get_shard_key(make_job("job1")) == "job1"
+
+
+def test_split_snapshot():
+    names = {str(i): f"job{i}" for i in range(20)}
+    states = {job_id: JOB_STATE_RUNNING if int(job_id) % 2 else "PENDING" for job_id in names}
+
+    async def main():
+        queue = QueuePoller(Backend(states, names))
+        await queue.poll()
+        return ShardCoordinator(queue, 3)._split_snapshot()
+
+    snapshots = asyncio.run(main())
+    for shard, (shard_states, started_after) in snapshots.items():
+        assert all(get_shard(names[job_id], 3) == shard for job_id in shard_states)
+        assert set(started_after) == {job_id for job_id, state in shard_states.items() if state == JOB_STATE_RUNNING}
+    assert sum(len(shard_states) for shard_states, _ in snapshots.values()) == 20
+
+
+def test_snapshot_sent_to_the_worker():
+    async def main():
+        queue = QueuePoller(Backend({"1": JOB_STATE_RUNNING, "2": "PENDING"}, {"1": "a", "2": "b"}))
+        await queue.poll()
+        async with Connection(ShardCoordinator(queue, 1)) as client:
+            return await client.queue.get_state("1"), await client.queue.get_state("2"), client.queue.get_started_after("1")
+
+    state_1, state_2, started_after = asyncio.run(main())
+    assert (state_1, state_2) == (JOB_STATE_RUNNING, "PENDING")
+    assert started_after is not None
+
+
+def test_acquire_submitted_finished():
+    async def main():
+        limits_manager = JobLimitsManager(max_jobs=1)
+        coordinator = ShardCoordinator(QueuePoller(None), 1, limits_manager=limits_manager)
+        async with Connection(coordinator) as client:
+            limits = RemoteLimits(client)
+            a, b, c = make_job("a"), make_job("b"), make_job("c")
+            await asyncio.wait_for(limits.wait_for_slot(a), timeout=1)
+            assert coordinator.admitted[0] == {"a"}
+            waiting = asyncio.ensure_future(limits.wait_for_slot(b))
+            await settle()
+            assert not waiting.done()
+            # e.g. b is paused while waiting: it does not get the slot released by a
+            waiting.cancel()
+            await settle()
+            assert coordinator.acquiring[0] == {}
+            assert client.pending == {}
+            await limits.job_finished(a)
+            await asyncio.wait_for(limits.wait_for_slot(c), timeout=1)
+            await limits.job_submitted(c)
+            await settle()
+            assert list(limits_manager.admitted) == ["c"]
+            assert coordinator.admitted[0] == {"c"}
+        # the slots of a worker that stopped are released
+        assert limits_manager.admitted == {}
+        assert limits_manager.jobs_submitted == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_after_the_slot_was_granted():
+    async def main():
+        limits_manager = JobLimitsManager(max_jobs=1)
+        coordinator = ShardCoordinator(QueuePoller(None), 1, limits_manager=limits_manager)
+        connection = Connection(coordinator)
+        async with connection as client:
+            limits = RemoteLimits(client)
+            # the answers of the coordinator are not read for now
+            connection.reading.cancel()
+            waiting = asyncio.ensure_future(limits.wait_for_slot(make_job("a")))
+            await settle()
+            # granted at the coordinator, but the job is cancelled before the answer is handled
+            assert coordinator.admitted[0] == {"a"}
+            waiting.cancel()
+            connection.reading = asyncio.ensure_future(client.read_forever())
+            await settle()
+            assert limits_manager.admitted == {}
+            await asyncio.wait_for(limits.wait_for_slot(make_job("b")), timeout=1)
+
+    asyncio.run(main())
+
+
+def test_store_updates_written_by_the_coordinator(tmp_path):
+    path = str(tmp_path / "state.db")
+
+    async def main():
+        store = StateStore(path, flush_interval_secs=3600)
+        coordinator = ShardCoordinator(QueuePoller(None), 1, store=store)
+        async with Connection(coordinator) as client:
+            remote = RemoteStore(client, path)
+            remote.record("a", JOB_SUBMITTED, job_id=12, attempts=0, restarts=0, digest="d")
+            remote.record("a", JOB_RUNNING, job_id="12")
+            remote.record_log_position("a", 1234, 10, b"\x00head")
+            remote.close()
+            await settle()
+        store.close()
+
+    asyncio.run(main())
+    record = StateStore(path).load()["a"]
+    assert (record.state, record.job_id, record.digest) == (JOB_RUNNING, "12", "d")
+    assert (record.log_inode, record.log_offset, record.log_head) == (1234, 10, b"\x00head")
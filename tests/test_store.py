@@ -0,0 +1,54 @@
+"""Tests for `StateStore`."""
+import sqlite3
+from types import SimpleNamespace
+
+from autoexperiment.manager import skip_finished_jobs
+from autoexperiment.store import JOB_FINISHED, JOB_RUNNING, JOB_SUBMITTED, StateStore
+
+
+def count_rows(path, table):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_updates_are_buffered(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = StateStore(path, flush_interval_secs=3600)
+    store.record("a", JOB_SUBMITTED, job_id=1, attempts=0, digest="d1")
+    store.record("a", JOB_RUNNING)
+    store.record_log_position("a", 1234, 10, b"head")
+    store.record("b", JOB_SUBMITTED, job_id=2)
+    assert count_rows(path, "jobs") == 0
+    store.flush()
+    assert count_rows(path, "jobs") == 2
+    assert count_rows(path, "transitions") == 3
+    store.close()
+    records = StateStore(path).load()
+    a = records["a"]
+    # fields that are not given are left unchanged
+    assert (a.state, a.job_id, a.attempts, a.digest) == (JOB_RUNNING, "1", 0, "d1")
+    assert (a.log_inode, a.log_offset, a.log_head) == (1234, 10, b"head")
+    assert records["b"].digest is None
+
+
+def test_same_state_is_not_a_transition(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = StateStore(path, flush_interval_secs=0)
+    for _ in range(3):
+        store.record("a", JOB_RUNNING)
+    store.record("a", JOB_FINISHED)
+    assert count_rows(path, "transitions") == 2
+    assert store.load()["a"].finished_at is not None
+    store.close()
+
+
+def test_records_of_changed_scripts_are_ignored(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    for name in "abc":
+        store.record(name, JOB_FINISHED, digest="old")
+    jobs = [SimpleNamespace(name="a", script_digest="old"), SimpleNamespace(name="b", script_digest="new"), SimpleNamespace(name="c", script_digest=None)]
+    jobs, records = skip_finished_jobs(jobs, store)
+    # b changed, c was not built with a digest
+    assert [job.name for job in jobs] == ["b"]
+    assert sorted(records) == ["a", "c"]
+    store.close()
@@ -0,0 +1,77 @@
+"""Tests for the cache of the expanded sweeps."""
+import os
+
+from omegaconf import OmegaConf
+
+from autoexperiment.sweep_cache import SweepCache
+from autoexperiment.template import iter_job_defs
+
+
+def make_config(**params):
+    cfg = {
+        "template": "template.sbatch",
+        "sbatch_script": "sbatch/{name}.sbatch",
+        "output_file": "out/{name}.out",
+        "cmd": "sbatch {sbatch_script}",
+        "name": "{model}_{lr}",
+        "model": ["RN50", "ViT-B"],
+        "lr": [0.1, 0.01],
+    }
+    cfg.update(params)
+    return OmegaConf.create(cfg)
+
+
+def expand(cfg):
+    return list(iter_job_defs(cfg, verbose=0, compact=True, unique_names=False))
+
+
+def make_cache(tmp_path, monkeypatch, cfg):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "template.sbatch").write_text("#!/bin/bash\n#SBATCH --job-name={name}\n")
+    cache = SweepCache(str(tmp_path / "config.sweep"))
+    cache.save(cfg, expand(cfg))
+    return cache
+
+
+def test_hit(tmp_path, monkeypatch):
+    cfg = make_config()
+    cache = make_cache(tmp_path, monkeypatch, cfg)
+    jobdefs = cache.load(make_config())
+    expected = expand(cfg)
+    assert [jobdef.name for jobdef in jobdefs] == [jobdef.name for jobdef in expected]
+    assert [jobdef.params for jobdef in jobdefs] == [jobdef.params for jobdef in expected]
+
+
+def test_miss(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert SweepCache(str(tmp_path / "config.sweep")).load(make_config()) is None
+    (tmp_path / "config.sweep").write_bytes(b"not a pickle")
+    assert SweepCache(str(tmp_path / "config.sweep")).load(make_config()) is None
+
+
+def test_invalidated_by_the_config(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch, make_config())
+    # e.g. a --fix override
+    assert cache.load(make_config(lr=[0.1])) is None
+
+
+def test_invalidated_by_the_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATASET", "laion")
+    cache = make_cache(tmp_path, monkeypatch, make_config(data="/data/${oc.env:DATASET}"))
+    assert cache.load(make_config(data="/data/${oc.env:DATASET}")) is not None
+    monkeypatch.setenv("DATASET", "datacomp")
+    assert cache.load(make_config(data="/data/${oc.env:DATASET}")) is None
+
+
+def test_invalidated_by_the_templates(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch, make_config())
+    stat = os.stat(tmp_path / "template.sbatch")
+    os.utime(tmp_path / "template.sbatch", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.load(make_config()) is None
+
+
+def test_invalidated_by_the_working_directory(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch, make_config())
+    (tmp_path / "other").mkdir()
+    monkeypatch.chdir(tmp_path / "other")
+    assert cache.load(make_config()) is None
@@ -0,0 +1,241 @@
+"""Tests for the expansion of the sweeps, the filters on the params, the `expr(...)` params and the templates."""
+import os
+
+import pytest
+from omegaconf import OmegaConf
+
+from autoexperiment.template import (
+    CompactJobDef, CompiledTemplate, ExpressionError, ParamResolver, ParamTable, TemplateCache, compile_expr, iter_job_defs, parse_param_filter,
+)
+
+
+def make_config(**params):
+    cfg = {
+        "template": "template.sbatch",
+        "sbatch_script": "sbatch/{name}.sbatch",
+        "output_file": "out/{name}.out",
+        "cmd": "sbatch {sbatch_script}",
+        "name": "{model}_{lr}",
+    }
+    cfg.update(params)
+    return OmegaConf.create(cfg)
+
+
+def test_iter_job_defs_renders_on_demand(tmp_path):
+    (tmp_path / "template.sbatch").write_text("#SBATCH --job-name={name}\necho {lr}\n")
+    cfg = make_config(template=str(tmp_path / "template.sbatch"), model=["RN50", "ViT-B"], lr=[0.1, 0.01])
+    jobdefs = iter_job_defs(cfg)
+    first = next(jobdefs)
+    # the sbatch script is not kept in the job definition, it is rendered when needed
+    assert (first.name, first.config) == ("RN50_0.1", "")
+    assert first.render() == "#SBATCH --job-name=RN50_0.1\necho 0.1\n"
+    assert [jobdef.name for jobdef in jobdefs] == ["RN50_0.01", "ViT-B_0.1", "ViT-B_0.01"]
+    assert next(iter_job_defs(cfg, render=True)).config == first.render()
+    # duplicate names are found while the sweep is expanded
+    with pytest.raises(ValueError, match="Job names must be unique"):
+        list(iter_job_defs(make_config(model=["RN50", "ViT-B"], lr=[0.1], name="{lr}")))
+
+
+def test_resolve_references_and_expressions():
+    params = ParamResolver().resolve({"lr": 0.1, "batch_size": 512, "scaled_lr": "expr({lr} * {batch_size} / 256)", "name": "lr{scaled_lr}"})
+    assert params["scaled_lr"] == pytest.approx(0.2)
+    assert params["name"] == "lr0.2"
+
+
+def test_resolve_missing_param():
+    with pytest.raises(ValueError, match=r"references undefined param\(s\): \['dataset'\]"):
+        ParamResolver().resolve({"name": "{dataset}_{lr}", "lr": 0.1})
+
+
+def test_resolve_cycle():
+    with pytest.raises(ValueError, match="Cycle in the definition of params: a -> b -> a"):
+        ParamResolver().resolve({"a": "{b}", "b": "{a}"})
+
+
+def test_resolve_keeps_non_param_placeholders():
+    params = {"cmd": "awk '{print $1}'", "nodes": "{0000000..0139827}", "braces": "{"}
+    assert ParamResolver().resolve(params) == params
+
+
+@pytest.mark.parametrize("spec, matching, not_matching", [
+    ("model=ViT-B", ["ViT-B"], ["ViT-L", "ViT-B-16", None]),
+    ("model=ViT-*", ["ViT-B", "ViT-L-14"], ["RN50", None]),
+    ("model=RN50,ViT-?", ["RN50", "ViT-B"], ["ViT-B-16"]),
+    ("lr=0.001..0.01", [0.001, 0.005, "0.01"], [0.0001, 0.1, "abc", True, None]),
+    ("epochs=10..", [10, 100], [9]),
+    ("epochs=..10", [-1, 10], [11]),
+    ("model~ViT-[BL]-.*", ["ViT-B-16", "ViT-L-14"], ["ViT-H-14", "xViT-B-16"]),
+    ("version=1.2.3..4", ["1.2.3..4"], ["2"]),
+])
+def test_parse_param_filter(spec, matching, not_matching):
+    _, predicate = parse_param_filter(spec)
+    for value in matching:
+        assert predicate(value), value
+    for value in not_matching:
+        assert not predicate(value), value
+
+
+def test_compact_job_defs_equal_job_defs(tmp_path):
+    (tmp_path / "template.sbatch").write_text(
+        "#!/bin/bash\n#SBATCH --job-name={name}\n#SBATCH --output={output_file}\necho {tag} {quoted} {lr:.1e} {{literal}}\n"
+    )
+    cfg = make_config(
+        template=str(tmp_path / "template.sbatch"),
+        # a branch with a different layout
+        model=[{"RN50": {"width": [2]}}, {"ViT-B": {"depth": [12]}}],
+        lr=[0.1, 0.01],
+        logs="/logs",
+        # nested lazy params
+        run_dir="{logs}/{name}",
+        output_file="{run_dir}/slurm.out",
+        # format specs and conversions, of plain and of lazy params
+        tag="{lr:.3f}_{name:>12}",
+        quoted="{model!r} {run_dir!r}",
+        # escaped braces
+        cmd="sbatch {sbatch_script} --args '{{a}}'",
+        scaled_lr="expr({lr} * 2)",
+    )
+    jobdefs = list(iter_job_defs(cfg))
+    compact_jobdefs = list(iter_job_defs(cfg, compact=True))
+    table = compact_jobdefs[0].table
+    assert len(table.layouts) == 2
+    assert "run_dir" in table.lazy[0] and "scaled_lr" not in table.lazy[0]
+    assert len(compact_jobdefs) == len(jobdefs) == 4
+    for compact_jobdef, jobdef in zip(compact_jobdefs, jobdefs):
+        assert compact_jobdef == jobdef
+        assert compact_jobdef.params == jobdef.params
+        assert compact_jobdef.render() == jobdef.render()
+        assert (compact_jobdef.output_file, compact_jobdef.cmd) == (jobdef.output_file, jobdef.cmd)
+        assert compact_jobdef.param("tag") == jobdef.params["tag"]
+    assert jobdefs[0].params["quoted"] == "'RN50' '/logs/RN50_0.1'"
+    assert jobdefs[0].params["cmd"] == "sbatch sbatch/RN50_0.1.sbatch --args '{a}'"
+
+
+def test_param_table():
+    table = ParamTable()
+    offsets = [
+        table.add({"model": "RN50", "lr": 0.1, "name": "{model}_{lr}", "path": "{name}/{{x}}"}, lazy=["name", "path"]),
+        table.add({"model": "ViT", "lr": 0.1, "name": "{model}_{lr}", "path": "{name}/{{x}}"}, lazy=["name", "path"]),
+        table.add({"model": "RN50", "lr": 1, "sizes": [1, 2]}),
+    ]
+    table.freeze()
+    assert table.rows.typecode == "I"
+    # layouts and values are stored once
+    assert len(table.layouts) == 2
+    assert table.values["model"] == ["RN50", "ViT"]
+    assert table.values["lr"] == [0.1, 1]
+    assert table.values["path"] == ["{name}/{{x}}"]
+    # the lazy params referenced by a template are inlined
+    template, deps = table._inline(offsets[0], 0, "{name}/{{x}}")
+    assert (template, sorted(deps)) == ("{model}_{lr}/{{x}}", ["lr", "model"])
+    assert table.to_dict(offsets[1]) == {"model": "ViT", "lr": 0.1, "name": "ViT_0.1", "path": "ViT_0.1/{x}"}
+    assert table.get(offsets[0], "path") == "RN50_0.1/{x}"
+    assert table.get(offsets[2], "name", "default") == "default"
+    assert table.get(offsets[2], "sizes") == [1, 2]
+    jobdef = CompactJobDef(table, offsets[2], "c")
+    # the default of the fields of `JobDef`
+    assert jobdef.termination_str == ""
+    # a copy of the params
+    jobdef.params["lr"] = 2
+    assert jobdef.param("lr") == 1
+
+
+def test_parse_param_filter_invalid():
+    with pytest.raises(AssertionError):
+        parse_param_filter("model")
+
+
+def test_where_selects_jobs():
+    cfg = make_config(model=["RN50", "ViT-B", "ViT-L"], lr=[0.001, 0.01, 0.1])
+    where = dict(parse_param_filter(spec) for spec in ("model=ViT-*", "lr=..0.01"))
+    names = [jobdef.name for jobdef in iter_job_defs(cfg, where=where)]
+    assert names == ["ViT-B_0.001", "ViT-B_0.01", "ViT-L_0.001", "ViT-L_0.01"]
+
+
+def test_where_prunes_branches():
+    # the branches of `model` define different params, a filter on `depth` skips the branches without it
+    cfg = make_config(model=[{"ViT": {"depth": [12, 24]}}, {"RN50": {"width": [1, 2]}}], lr=[0.1], name="{model}_{lr}_{depth}")
+    where = dict([parse_param_filter("depth=24")])
+    assert [jobdef.name for jobdef in iter_job_defs(cfg, where=where)] == ["ViT_0.1_24"]
+
+
+def test_where_on_dynamic_values():
+    # values referencing other params are only filtered once resolved
+    cfg = make_config(model=["RN50", "ViT-B"], lr=[0.1], run="{model}-run")
+    where = dict([parse_param_filter("run=ViT-*")])
+    assert [jobdef.params["run"] for jobdef in iter_job_defs(cfg, where=where)] == ["ViT-B-run"]
+
+
+def test_expression():
+    expression = compile_expr("expr(max({lr} * {batch_size} / 256, 0.1) if {warmup} else round(sqrt(16)))")
+    assert expression.names == ["lr", "batch_size", "warmup"]
+    assert expression.evaluate({"lr": "0.1", "batch_size": 1024, "warmup": True}) == pytest.approx(0.4)
+    assert expression.evaluate({"lr": 0.1, "batch_size": 1024, "warmup": False}) == 4
+
+
+def test_expression_textual():
+    # the placeholders with a format spec are formatted before compiling the expression
+    assert compile_expr("expr('{lr:.3f}')").textual
+
+
+@pytest.mark.parametrize("text, error", [
+    ("expr(().__class__)", "unsupported syntax"),
+    ("expr({lr}.real)", "unsupported syntax"),
+    ("expr('a'[0])", "unsupported syntax"),
+    ("expr(__import__('os'))", "unknown function"),
+    ("expr(open('/etc/passwd'))", "unknown function"),
+    ("expr(max.__call__(1))", "unknown function"),
+    ("expr((lambda: 1)())", "unknown function"),
+    ("expr(max(*[1, 2]))", "argument unpacking is not allowed"),
+    ("expr(lr * 2)", "unknown name"),
+    ("expr([x for x in 'ab'])", "unsupported syntax"),
+    ("expr('a' * 10 ** 9)", None),
+    ("expr(1 +)", "invalid syntax"),
+])
+def test_expression_rejects(text, error):
+    if error is None:
+        # allowed syntax, rejected at evaluation
+        with pytest.raises(TypeError):
+            compile_expr(text).evaluate({})
+        return
+    with pytest.raises(ExpressionError, match=error):
+        compile_expr(text)
+
+
+@pytest.mark.parametrize("text", [
+    "#SBATCH --job-name={name}\necho {lr:.2f} {model!r} {{literal}}\n",
+    # rendered with `str.format`
+    "echo {sizes[0]} {lr:{width}}\n",
+])
+def test_compiled_template(text):
+    params = {"name": "a", "lr": 0.1, "model": "RN50", "sizes": [1, 2], "width": 6}
+    template = CompiledTemplate(text)
+    assert template.render(params) == text.format(**params)
+    assert template.simple == ("[" not in text)
+
+
+def test_template_cache_invalidation(tmp_path):
+    path = str(tmp_path / "template.sbatch")
+    with open(path, "w") as f:
+        f.write("echo {a}\n")
+    cache = TemplateCache(check_interval_secs=0)
+    template = cache.get(path)
+    assert cache.get(path) is template
+    with open(path, "w") as f:
+        f.write("echo {b}\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.get(path).fields == {"b"}
+    # the modification time is only checked every `check_interval_secs`
+    cache = TemplateCache(check_interval_secs=3600)
+    template = cache.get(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2000))
+    assert cache.get(path) is template
+
+
+def test_undefined_template_fields_are_warned(tmp_path):
+    path = tmp_path / "template.sbatch"
+    path.write_text("#SBATCH --job-name={name}\necho {model} {lr} {dataset}\n")
+    cfg = make_config(model=["RN50"], lr=[0.1], template=str(path))
+    with pytest.warns(UserWarning, match=r"references fields that are not defined by any param: \['dataset'\]"):
+        assert len(list(iter_job_defs(cfg))) == 1
@@ -0,0 +1,41 @@
+"""Tests for the time limits of the jobs, read from their sbatch scripts."""
+from types import SimpleNamespace
+
+import pytest
+
+from autoexperiment.manager import get_time_limit_secs, parse_slurm_time
+
+
+@pytest.mark.parametrize("value, secs", [
+    ("30", 30 * 60),
+    ("30:15", 30 * 60 + 15),
+    ("01:30:00", 90 * 60),
+    ("2-0", 2 * 24 * 3600),
+    ("1-12", 36 * 3600),
+    ("1-12:30", 36 * 3600 + 30 * 60),
+    ("1-00:00:10", 24 * 3600 + 10),
+    ("UNLIMITED", None),
+    ("infinite", None),
+    ("1:2:3:4", None),
+    ("", None),
+])
+def test_parse_slurm_time(value, secs):
+    assert parse_slurm_time(value) == secs
+
+
+@pytest.mark.parametrize("line, secs", [
+    ("#SBATCH --time=02:00:00", 7200),
+    ("#SBATCH --time 10", 600),
+    ("#SBATCH -t 1-0", 86400),
+    ("#SBATCH -t5", 300),
+    ("# SBATCH --time=02:00:00", None),
+    ("#SBATCH --nodes=1", None),
+])
+def test_get_time_limit_secs(tmp_path, line, secs):
+    path = tmp_path / "job.sbatch"
+    path.write_text(f"#!/bin/bash\n#SBATCH --job-name=job\n{line}\nsrun python train.py\n")
+    assert get_time_limit_secs(SimpleNamespace(sbatch_script=str(path))) == secs
+
+
+def test_get_time_limit_secs_without_script(tmp_path):
+    assert get_time_limit_secs(SimpleNamespace(sbatch_script=str(tmp_path / "missing.sbatch"))) is None
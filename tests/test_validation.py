@@ -0,0 +1,92 @@
+"""Tests for the validation of the jobs of a sweep."""
+from types import SimpleNamespace
+
+import pytest
+
+from autoexperiment.validation import MAX_SHOWN_PROBLEMS, SweepValidator, ValidationError, validate_job_defs
+
+
+def make_job(name, output_file=None, sbatch_script=None, sbatch=None):
+    jobdef = SimpleNamespace(
+        name=name,
+        output_file=output_file or f"out/{name}.out",
+        sbatch_script=sbatch_script or f"sbatch/{name}.sbatch",
+        params={"template": "template.sbatch"},
+    )
+    sbatch = f"#!/bin/bash\n#SBATCH --job-name={name}\nsrun python train.py\n" if sbatch is None else sbatch
+    jobdef.render = lambda: sbatch
+    return jobdef
+
+
+def errors_of(jobdefs, render=True, **kwargs):
+    with pytest.raises(ValidationError) as info:
+        validate_job_defs(jobdefs, render=render, **kwargs)
+    return [kind for kind, _ in info.value.errors]
+
+
+def test_valid_jobs():
+    assert validate_job_defs([make_job("a"), make_job("b")], render=True) == []
+
+
+def test_duplicates():
+    jobdefs = [
+        make_job("a"),
+        make_job("a"),
+        make_job("b", output_file="out/a.out"),
+        make_job("c", sbatch_script="sbatch/a.sbatch"),
+    ]
+    assert errors_of(jobdefs) == ["duplicate name", "duplicate output_file", "duplicate sbatch_script"]
+
+
+def test_names():
+    assert errors_of([make_job("a" * 11)], render=False, max_name_length=10) == ["name too long"]
+    assert errors_of([make_job("a\nb")], render=False) == ["invalid name"]
+
+
+@pytest.mark.parametrize("line, error", [
+    ("#SBATCH --job-name=a", None),
+    ("#SBATCH --job-name a", None),
+    ("#SBATCH -J a", None),
+    ("#SBATCH -Ja", None),
+    ("#SBATCH --job-name='a'", None),
+    ("#SBATCH --nodes=1", "missing --job-name"),
+    ("# SBATCH --job-name=a", "missing --job-name"),
+    ("#SBATCH --job-name=b", "wrong --job-name"),
+])
+def test_job_name_in_script(line, error):
+    jobdef = make_job("a", sbatch=f"#!/bin/bash\n{line}\nsrun python train.py\n")
+    if error is None:
+        assert validate_job_defs([jobdef], render=True) == []
+    else:
+        assert errors_of([jobdef]) == [error]
+
+
+def test_render_errors():
+    jobdef = make_job("a")
+
+    def render():
+        raise KeyError("lr")
+
+    jobdef.render = render
+    assert errors_of([jobdef]) == ["render error"]
+
+
+def test_unresolved_placeholders_are_warnings():
+    jobdef = make_job("a", output_file="out/{seed}.out", sbatch="#!/bin/bash\n#SBATCH --job-name=a\necho {lr} ${HOME}\n")
+    warnings = validate_job_defs([jobdef], render=True)
+    assert len(warnings) == 2
+    assert "{seed}" in warnings[0] and "{lr}" in warnings[1]
+    assert "HOME" not in warnings[1]
+
+
+def test_all_problems_are_reported_at_once():
+    validator = SweepValidator()
+    for _ in range(MAX_SHOWN_PROBLEMS + 5):
+        validator.add(make_job("a"))
+    validator.add(make_job("b" * 300))
+    with pytest.raises(ValidationError) as info:
+        validator.check()
+    message = str(info.value)
+    assert message.startswith(f"{MAX_SHOWN_PROBLEMS + 5} problem(s) found in the jobs:")
+    assert "... and 4 more job(s) with: duplicate name" in message
+    assert "is longer than 255 characters" in message